@@ -46,22 +46,22 @@ def analyse_trip_locations():
     jfk_trips = 0
     
     for date in datelist:
-        trips = db_trip.find_pickup_dt(date, date+timedelta(hours=1))
+        trips = db_trip.find_pickup_dt(date, date+timedelta(hours=1), as_batch=True)
         print("%s  :  %d" % (date, len(trips)))
         
-        for trip in trips:
-            if(trip.isValid()==Trip.VALID):
-                valid_trips += 1
-                if(nyc_map.get_nearest_node(trip.fromLat, trip.fromLon)==None or
-                    nyc_map.get_nearest_node(trip.toLat, trip.toLon)==None):
-                    
-                    bad_region_trips += 1
-                    
-                    if(jfk(trip.fromLat, trip.fromLon) or jfk(trip.toLat, trip.toLon)):
-                        jfk_trips += 1
-                    
-                    
-                        
+        #Snap both ends of all valid trips at once - unmatched ends are outside of the map
+        valid = trips.get_error_codes()==Trip.VALID
+        valid_trips += valid.sum()
+        (origins, _) = nyc_map.match_points(trips.fromLat[valid], trips.fromLon[valid])
+        (dests, _) = nyc_map.match_points(trips.toLat[valid], trips.toLon[valid])
+        bad_region = (origins < 0) | (dests < 0)
+        bad_region_trips += bad_region.sum()
+        
+        bad = valid.nonzero()[0][bad_region]
+        for (fromLat, fromLon, toLat, toLon) in zip(trips.fromLat[bad], trips.fromLon[bad],
+                                                  trips.toLat[bad], trips.toLon[bad]):
+            if(jfk(fromLat, fromLon) or jfk(toLat, toLon)):
+                jfk_trips += 1
         
         print ("Bad trips : %d / %d = %f" % (bad_region_trips, valid_trips, float(bad_region_trips)/valid_trips))
         perc = 0.0
@@ -2,22 +2,29 @@
 """
 Contains functions for loading and saving the arcflags of Links
 into the database
+
+The flags of one datetime are stored as two rows, one per direction.  Each row holds
+the packed bit matrix of a PackedArcFlags as a single bytea blob, along with the
+(begin_node_id, end_node_id) of every row of the matrix, so that the flags can be
+matched to the Links of any Map.
 Created on Fri Jan  9 15:08:51 2015
 @author: Brian Donovan (briandonovan100@gmail.com)
 """
 
 
 import db_functions.db_main as db_main
+from psycopg2 import Binary
+import numpy as np
 
 # Creates the table which stores arcflag data
 def create_arc_flag_table():
     
     sql = """CREATE TABLE arc_flags (
-        begin_node_id BIGINT, 
-        end_node_id BIGINT,
         datetime TIMESTAMP,
-        arc_flag_forward varchar(200),
-        arc_flag_backward varchar(200));"""  #___________________HERE______________________
+        direction varchar(8),
+        num_regions INTEGER,
+        link_keys BYTEA,
+        flags BYTEA);"""
     try:
         db_main.execute(sql)
         sql = "CREATE INDEX idx_af_datetime ON arc_flags using BTREE (datetime);"
@@ -60,96 +67,71 @@ def get_available_dates():
     return dates
 
 
-# Saves traffic conditions (link-by-link arcflags) from a Map object into the
-# database.  If there are already arcflags saved for the given time, they will
-# be overwritten.
+# Saves the arcflags of a Map object into the database.  If there are already
+# arcflags saved for the given time, they will be overwritten.
 # Params:
-    # road_map - a Map object, which contains the arcflags on its Links
+    # road_map - a Map object, which contains the arcflags (see Map.arc_flags)
     # datetime - the time at which these traffic conditions occur
 def save_arc_flags(road_map, datetime):
-    date_str = "'" + str(datetime) + "'"
-    
+    graph = road_map.graph
+    arc_flags = road_map.arc_flags
+
     # First remove any existing arcflags for the given datetime
-    delete_arc_flags(datetime)  
-    
-    # Next, add one row with the default speed.  This will have nodes 0, 0
-    # The default speed will be saved in the arcflag field
-    sql = "INSERT INTO arc_flags VALUES(0, 0, %s, 0, 0);" % (date_str) #___________________HERE______________________
-    db_main.execute(sql)
-    
-    
-    BULK_SIZE=1000
-    # Create a prepared statement
-    db_main.execute("PREPARE af_plan (BIGINT, BIGINT, TIMESTAMP, varchar(200), varchar(200)) AS "
-    "INSERT INTO arc_flags VALUES($1, $2, $3, $4, $5);") #___________________HERE______________________
-    
-    sqls = []
-    
-    # Loop through the Links and create a bunch of EXECUTE statements
-    for link in road_map.links:
-        sql = "EXECUTE af_plan(%d, %d, %s, %s, %s);" % (
-            link.origin_node_id, link.connecting_node_id, date_str, "\'" + link.get_forward_arcflags_hex() + "\'", "\'" + link.get_backward_arcflags_hex() + "\'") #___________________HERE______________________
-        sqls.append(sql)
-        if(len(sqls) >= BULK_SIZE):
-            # Concatenate EXECUTE statements and run them
-            final_sql = "\n".join(sqls)
-            sqls = []
-            db_main.execute(final_sql)
-            db_main.commit()
-    
-    # Run the last few EXECUTE statements if necessary
-    if(len(sqls) > 1):
-        final_sql = "\n".join(sqls)
-        db_main.execute(final_sql)
-        db_main.commit()
-    
-    # Clean up the prepared statement
-    db_main.execute("DEALLOCATE af_plan;")
+    delete_arc_flags(datetime)
+
+    # One (begin_node_id, end_node_id) pair per row of the flag matrices
+    link_keys = np.empty((graph.num_links, 2), dtype="<i8")
+    link_keys[:, 0] = graph.node_ids[graph.link_origin]
+    link_keys[:, 1] = graph.node_ids[graph.link_dest]
+
+    # The matrices are passed to psycopg2 as buffers, without any conversion
+    sql = "INSERT INTO arc_flags VALUES(%s, %s, %s, %s, %s);"
+    for (direction, flags) in [("forward", arc_flags.forward),
+                               ("backward", arc_flags.backward)]:
+        db_main.execute(sql, (datetime, direction, arc_flags.num_regions,
+                              Binary(link_keys.data),
+                              Binary(np.ascontiguousarray(flags).data)))
     db_main.commit()
 
 
-
-# Helper method, which 
+# Helper method, which runs the query for the arcflags at a given time
 def get_arc_flags_cursor(datetime):
     # Execute the query
-    sql = "SELECT * FROM arc_flags where datetime=%s ORDER BY (begin_node_id, end_node_id);"
+    sql = "SELECT direction, num_regions, link_keys, flags FROM arc_flags where datetime=%s;"
     cur = db_main.execute(sql, (datetime,))
     return cur
 
 
 
-# Loads traffic conditions (link-by-link arcflags) from the database and applies them onto
-# of a Map object.  After this is called, Link.time, Link.speed, and Link.num_trips
-# will be set for every Link in the Map.
+# Loads arcflags from the database into a Map object.  After this is called,
+# road_map.arc_flags will hold the flags of every Link in the Map.  Links that have no
+# saved flags get none.
 # Params:
     # road_map - a Map object, to be modified
-    # datetime - Traffic conditions for this date/time will be loaded
+    # datetime - arcflags for this date/time will be loaded
 def load_arc_flags(road_map, datetime):
-      
-    
+    graph = road_map.graph
+
     # Execute the query
     cur = get_arc_flags_cursor(datetime)
-    
-    i = 0
-    # Iterate through the cursor returned by the query
-    for (begin_node_id, end_node_id, datetime, forward_arcs, backward_arcs) in cur:
-        
-        # If there is a default entry, it will be the first one
-        # Set all of the links using this entry
-        # if(begin_node_id==0 and end_node_id==0):
-            # In this case, the travel_time field holds the speed
-            # road_map.set_all_link_speeds(travel_time)
-                
-        i += 1
-        # Find the appropriate Link in the road_map and set the relevant attributes
-        if((begin_node_id, end_node_id) in road_map.links_by_node_id):
-            link = road_map.links_by_node_id[begin_node_id, end_node_id]
-            link.decode_forward_arcflags_hex(forward_arcs, road_map.total_region_count) #___________________HERE______________________
-            link.decode_backward_arcflags_hex(backward_arcs, road_map.total_region_count) #___________________HERE______________________
-            # link.speed = link.length / travel_time
+    road_map.assign_link_arc_flags()
+    arc_flags = road_map.arc_flags
+
+    for (direction, num_regions, link_keys, flags) in cur:
+        if(num_regions != road_map.total_region_count):
+            raise Exception("The arcflags at %s have %d regions, but the map has %d." % (
+                str(datetime), num_regions, road_map.total_region_count))
+        link_keys = np.frombuffer(link_keys, dtype="<i8").reshape(-1, 2)
+        flags = np.frombuffer(flags, dtype=np.uint8).reshape(len(link_keys), -1)
+
+        # Match the saved rows to the Links of this Map
+        link_ids = graph.get_link_indices(link_keys[:, 0], link_keys[:, 1])
+        found = link_ids >= 0
+        if(direction == "forward"):
+            arc_flags.forward[link_ids[found]] = flags[found]
+        else:
+            arc_flags.backward[link_ids[found]] = flags[found]
     cur.close()
-    
-    #print("Loaded " + str(i) + " records.")
 
 
 
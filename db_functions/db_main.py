@@ -58,6 +58,22 @@ def execute(sql, args=None):
     cur.execute(sql, args)
     return cur
 
+# Bulk-loads rows into a table with COPY, which is much faster than INSERTs
+# Params:
+    # f - a file-like object, with one row per line in the text format of COPY
+        # (tab-separated columns)
+    # table - the name of the table
+    # columns - optional list of the column names in f
+# Returns:
+    # the Cursor object that was used
+def copy_from(f, table, columns=None):
+    global db_con
+    if(db_con==None):
+        raise Exception("Database is not connected.  Cannot copy into table " + table)
+    cur = db_con.cursor()
+    cur.copy_from(f, table, columns=columns)
+    return cur
+
 def commit():
     db_con.commit()
 
@@ -9,6 +9,11 @@ Created on Fri Jan  9 15:08:51 2015
 
 
 import db_main
+from cStringIO import StringIO
+import numpy as np
+
+# The columns of the travel_times table, in the order of the COPY rows
+TRAVEL_TIME_COLUMNS = ("begin_node_id", "end_node_id", "datetime", "travel_time", "num_trips")
 
 # Creates the table which stores travel time data
 def create_travel_time_table():
@@ -61,55 +66,63 @@ def get_available_dates():
     return dates
 
 
-# Saves traffic conditions (link-by-link travel times) from a Map object into the
-# database.  If there are already travel times saved for the given time, they will
-# be overwritten.
+# Formats the travel times of a Map object as rows for the travel_times table, in the
+# text format of COPY.  Only Links with num_trips > 0 are included, after one row with
+# the default speed, which has nodes 0, 0 and the speed in the travel time field.
 # Params:
     # road_map - a Map object, which contains the travel times on its Links
     # datetime - the time at which these traffic conditions occur
-def save_travel_times(road_map, datetime):
-    date_str = "'" + str(datetime) + "'"
-    
-    # First remove any existing travel times for the given datetime
-    delete_travel_times(datetime)  
-    
-    # Next, add one row with the default speed.  This will have nodes 0, 0
-    # The default speed will be saved in the travel time field
+# Returns:
+    # a string with one line per row
+def get_travel_time_rows(road_map, datetime):
+    date_str = str(datetime)
+    lines = []
     default_speed = road_map.get_default_speed()
     if(default_speed!=None):
-        sql = "INSERT INTO travel_times VALUES(0, 0, %s, %f, 0);" % (date_str, default_speed)
-        db_main.execute(sql)
-    
-    
-    BULK_SIZE=5000
-    # Create a prepared statement
-    db_main.execute("PREPARE tt_plan (BIGINT, BIGINT, TIMESTAMP, REAL, INTEGER) AS "
-    "INSERT INTO travel_times VALUES($1, $2, $3, $4, $5);")
-    
-    sqls = []
-    
-    # Loop through the Links and create a bunch of EXECUTE statements
-    for link in road_map.links:
-        if(link.num_trips > 0):
-            sql = "EXECUTE tt_plan(%d, %d, %s, %f, %d);" % (
-                link.origin_node_id, link.connecting_node_id, date_str, link.time, link.num_trips)
-            sqls.append(sql)
-        if(len(sqls) >= BULK_SIZE):
-            # Concatenate EXECUTE statements and run them
-            final_sql = "\n".join(sqls)
-            sqls = []
-            db_main.execute(final_sql)
-            db_main.commit()
-    
-    # Run the last few EXECUTE statements if necessary
-    if(len(sqls) > 1):
-        final_sql = "\n".join(sqls)
-        db_main.execute(final_sql)
+        lines.append("0\t0\t%s\t%r\t0" % (date_str, default_speed))
+
+    road_map.copy_link_times_to_graph()
+    graph = road_map.graph
+    used = np.flatnonzero(graph.link_num_trips > 0)
+    begin_node_ids = graph.node_ids[graph.link_origin[used]].tolist()
+    end_node_ids = graph.node_ids[graph.link_dest[used]].tolist()
+    travel_times = graph.link_time[used].tolist()
+    num_trips = graph.link_num_trips[used].astype(np.int64).tolist()
+    row_format = "%d\t%d\t" + date_str + "\t%r\t%d"
+    lines.extend(row_format % row for row in
+                 zip(begin_node_ids, end_node_ids, travel_times, num_trips))
+    lines.append("")
+    return "\n".join(lines)
+
+
+# Saves travel times for several datetimes in one transaction, with a single DELETE
+# and a single COPY.  Any travel times already saved for these datetimes will be
+# overwritten.
+# Params:
+    # batch - a list of (datetime, rows) tuples, where rows was returned by
+        # get_travel_time_rows()
+    # commit - commit the transaction.  If False, the caller must commit.
+def save_travel_time_batch(batch, commit=True):
+    if(len(batch) == 0):
+        return
+    datetimes = tuple(datetime for (datetime, _) in batch)
+    db_main.execute("DELETE FROM travel_times where datetime IN %s;", (datetimes,))
+    buf = StringIO("".join(rows for (_, rows) in batch))
+    db_main.copy_from(buf, "travel_times", columns=TRAVEL_TIME_COLUMNS)
+    if(commit):
         db_main.commit()
-    
-    # Clean up the prepared statement
-    db_main.execute("DEALLOCATE tt_plan;")
-    db_main.commit()
+
+
+# Saves traffic conditions (link-by-link travel times) from a Map object into the
+# database.  If there are already travel times saved for the given time, they will
+# be overwritten.  The rows are streamed in with a single COPY.
+# Params:
+    # road_map - a Map object, which contains the travel times on its Links
+    # datetime - the time at which these traffic conditions occur
+    # commit - commit the transaction.  If False, the caller must commit, so that
+        # many datetimes can be saved in one transaction.
+def save_travel_times(road_map, datetime, commit=True):
+    save_travel_time_batch([(datetime, get_travel_time_rows(road_map, datetime))], commit)
 
 
 
@@ -122,43 +135,61 @@ def get_travel_times_cursor(datetime):
 
 
 
+# Fetches the travel times of one datetime as arrays, in a single round trip
+# Params:
+    # datetime - Traffic conditions for this date/time will be loaded
+# Returns:
+    # begin_node_ids, end_node_ids - int64 arrays with the nodes of each row
+    # travel_times - a float64 array.  The default row (nodes 0, 0) holds a speed instead.
+    # num_trips - a float64 array
+def load_travel_time_arrays(datetime):
+    sql = """SELECT begin_node_id, end_node_id, travel_time, num_trips
+        FROM travel_times where datetime=%s;"""
+    cur = db_main.execute(sql, (datetime,))
+    rows = cur.fetchall()
+    cur.close()
+
+    # Node ids are far below 2**53, so they survive the trip through float64
+    table = np.array(rows, dtype=np.float64).reshape(len(rows), 4)
+    return (table[:, 0].astype(np.int64), table[:, 1].astype(np.int64),
+            table[:, 2], table[:, 3])
+
+
 # Loads traffic conditions (link-by-link travel times) from the database and applies them onto
-# of a Map object.  After this is called, Link.time, Link.speed, and Link.num_trips
-# will be set for every Link in the Map.
+# of a Map object.  After this is called, Link.time and Link.num_trips will be set for
+# every Link in the Map, as well as road_map.graph.link_time and link_num_trips.
+# Links without a row of their own get the default speed if one was saved, and keep their
+# previous time otherwise.  Their num_trips is always 0.
 # Params:
     # road_map - a Map object, to be modified
     # datetime - Traffic conditions for this date/time will be loaded
 def load_travel_times(road_map, datetime):
-    
-      
-    
-    # Execute the query
-    cur = get_travel_times_cursor(datetime)
-    
-    for link in road_map.links:
-        link.num_trips = 0
-    
-    i = 0
-    # Iterate through the cursor returned by the query
-    for (begin_node_id, end_node_id, datetime, travel_time, num_trips) in cur:
-        
-        # If there is a default entry, it will be the first one
-        # Set all of the links using this entry
-        if(begin_node_id==0 and end_node_id==0):
-            # In this case, the travel_time field holds the speed
-            road_map.set_all_link_speeds(travel_time)
-                
-            
-        i += 1
-        # Find the appropriate Link in the road_map and set the relevant attributes
-        if((begin_node_id, end_node_id) in road_map.links_by_node_id):
-            link = road_map.links_by_node_id[begin_node_id, end_node_id]
-            link.time = travel_time
-            link.speed = link.length / travel_time
-            link.num_trips = num_trips
-    cur.close()
-    
-    #print("Loaded " + str(i) + " records.")
+    (begin_node_ids, end_node_ids, travel_times, num_trips) = load_travel_time_arrays(datetime)
+    graph = road_map.graph
+
+    is_default = (begin_node_ids == 0) & (end_node_ids == 0)
+    if(is_default.any()):
+        # In this case, the travel_time field holds the speed
+        default_speed = travel_times[np.flatnonzero(is_default)[0]]
+        link_time = graph.link_length / default_speed
+    else:
+        road_map.copy_link_times_to_graph()
+        link_time = graph.link_time
+
+    # Translate the (begin_node_id, end_node_id) pairs with the sorted key index of
+    # the graph, and drop rows for links which are not in this Map
+    link_ids = graph.get_link_indices(begin_node_ids, end_node_ids)
+    found = (link_ids >= 0) & ~is_default
+    link_ids = link_ids[found]
+
+    link_time[link_ids] = travel_times[found]
+    link_num_trips = np.zeros(graph.num_links)
+    link_num_trips[link_ids] = num_trips[found]
+    graph.link_time = link_time
+    graph.link_num_trips = link_num_trips
+    road_map.copy_graph_times_to_links()
+    
+    #print("Loaded " + str(len(link_ids)) + " records.")
 
 
 def drop_link_counts_table():
@@ -10,35 +10,57 @@ Created on Tuesday Jan 13 12:56:56 2015
 """
 
 import db_main
-from traffic_estimation.Trip import Trip
+from traffic_estimation.TripBatch import TripBatch
+
+
+#The columns that a TripBatch is built from.  The database converts the times to
+#seconds since 1970, which is much faster than building datetime objects in Python.
+BATCH_COLUMNS = """medallion,
+	EXTRACT(EPOCH FROM pickup_datetime)::float8,
+	EXTRACT(EPOCH FROM dropoff_datetime)::float8,
+	pickup_longitude, pickup_latitude, dropoff_longitude, dropoff_latitude,
+	trip_distance"""
+
+#Reads all of the rows of a query on the trip table at once, into a TripBatch
+#If as_batch is False, the TripBatch is turned into a list of Trip objects
+def fetch_trips(cur, as_batch):
+	rows = cur.fetchall()
+	cur.close()
+	if(len(rows) == 0):
+		batch = TripBatch([], [], [], [], [], [], [], [])
+	else:
+		batch = TripBatch(*zip(*rows))
+	if(as_batch):
+		return batch
+	return batch.get_trips()
 
 
 #Fetch trips from database with pickup_datetime between two datetimes
-def find_pickup_dt(dt1, dt2):
-	SQL = """SELECT * FROM trip
+def find_pickup_dt(dt1, dt2, as_batch=False):
+	SQL = "SELECT " + BATCH_COLUMNS + """ FROM trip
 	WHERE %s <= pickup_datetime 
 	AND pickup_datetime <= %s
 	ORDER BY pickup_datetime, dropoff_datetime"""
 	cur = db_main.execute(SQL, (str(dt1), str(dt2)))
-	return [Trip(record) for record in cur]
+	return fetch_trips(cur, as_batch)
 	
 #Fetch trips from database with dropoff_datetime between two datetimes
-def find_dropoff_dt(dt1, dt2):
-	SQL = """SELECT * FROM trip
+def find_dropoff_dt(dt1, dt2, as_batch=False):
+	SQL = "SELECT " + BATCH_COLUMNS + """ FROM trip
 	WHERE %s <= dropoff_datetime 
 	AND dropoff_datetime <= %s
 	ORDER BY pickup_datetime, dropoff_datetime"""
 	cur = db_main.execute(SQL, (str(dt1), str(dt2)))
-	return [Trip(record) for record in cur]
+	return fetch_trips(cur, as_batch)
 
 #Fetch trips from database with day_of_week and hours_of_day of interest
-def find_dow_hod(dow, hod):
-	SQL = """SELECT * FROM trip
+def find_dow_hod(dow, hod, as_batch=False):
+	SQL = "SELECT " + BATCH_COLUMNS + """ FROM trip
 	WHERE day_of_week = %s
 	AND hours_of_day = %s
 	ORDER BY pickup_datetime, dropoff_datetime"""
 	cur = db_main.execute(SQL, (dow, hod))
-	return [Trip(record) for record in cur]
+	return fetch_trips(cur, as_batch)
 			
 
 
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Tests the travel time and arc flag writers/readers in db_functions against an in-memory
+stand-in for PostgreSQL, so they can be checked without a database server.  The
+stand-in connection is installed as db_main.db_con, records every statement, and
+understands just enough SQL to answer the queries that these modules run.  A small
+grid map is written to a temporary directory, so no map files are needed either.
+
+Run it with:  python db_standin_test.py
+"""
+import csv
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from random import Random
+
+import numpy as np
+from db_functions import db_main, db_travel_times, db_arc_flags
+from routing.Map import Map
+
+
+# A cursor of the stand-in database.  Statements are run against the tables of the
+# connection, and the results of a SELECT can be read with fetchall() or by iterating.
+class StandInCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.results = []
+
+    def execute(self, sql, args=None):
+        self.connection.log.append(("execute", sql, args))
+        words = sql.split()
+        table = self.connection.tables[words[words.index("FROM") + 1 if "FROM" in words
+                                             else words.index("INTO") + 1]]
+        if(words[0] == "DELETE"):
+            # DELETE FROM table where datetime=%s  or  where datetime IN %s
+            if(" IN " in sql):
+                datetimes = set(str(d) for d in args[0])
+            else:
+                datetimes = set([str(args[0])])
+            table[:] = [row for row in table if row["datetime"] not in datetimes]
+        elif(words[0] == "INSERT"):
+            # INSERT INTO arc_flags VALUES(datetime, direction, num_regions, keys, flags)
+            (date, direction, num_regions, link_keys, flags) = args
+            # psycopg2.Binary() keeps the wrapped buffer in .adapted
+            table.append({"datetime": str(date), "direction": direction,
+                          "num_regions": num_regions,
+                          "link_keys": str(getattr(link_keys, "adapted", link_keys)),
+                          "flags": str(getattr(flags, "adapted", flags))})
+        elif(words[0] == "SELECT"):
+            # SELECT col, col, ... FROM table where datetime=%s;
+            columns = [c.strip(",") for c in words[1:words.index("FROM")]]
+            self.results = [tuple(row[c] for c in columns) for row in table
+                            if row["datetime"] == str(args[0])]
+        else:
+            raise Exception("The stand-in database cannot run " + sql)
+
+    def copy_from(self, f, table, columns=None):
+        data = f.read()
+        self.connection.log.append(("copy_from", table, columns))
+        converters = {"begin_node_id": int, "end_node_id": int, "datetime": str,
+                      "travel_time": float, "num_trips": int}
+        for line in data.splitlines():
+            values = line.split("\t")
+            self.connection.tables[table].append(
+                dict((c, converters[c](v)) for (c, v) in zip(columns, values)))
+
+    def fetchall(self):
+        return list(self.results)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        pass
+
+
+# A connection to the stand-in database, with the travel_times and arc_flags tables
+class StandInConnection:
+    def __init__(self):
+        self.tables = {"travel_times": [], "arc_flags": []}
+        self.log = []
+
+    def cursor(self):
+        return StandInCursor(self)
+
+    def commit(self):
+        self.log.append(("commit",))
+
+    def rollback(self):
+        self.log.append(("rollback",))
+
+
+# Writes a small grid road map in the CSV format of Map(), with one-way streets on
+# some rows, and loads it
+# Params:
+    # directory - where to write nodes.csv and links.csv
+    # size - the number of nodes on each side of the grid
+# Returns:
+    # a Map
+def make_grid_map(directory, size=12, region_kd_size=20):
+    random = Random(1)
+    node_id = lambda i, j: 1000 * (i + 1) + j
+    nodes_fn = os.path.join(directory, "nodes.csv")
+    links_fn = os.path.join(directory, "links.csv")
+    with open(nodes_fn, "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(["node_id", "is_complete", "num_in_links", "num_out_links",
+                         "osm_traffic_controller", "longitude", "latitude", "osm_changeset",
+                         "birth_timestamp", "death_timestamp", "region_id"])
+        for i in range(size):
+            for j in range(size):
+                writer.writerow([node_id(i, j), True, 0, 0, "null",
+                                 -74.0 + .002 * j + random.uniform(-.0003, .0003),
+                                 40.7 + .002 * i + random.uniform(-.0003, .0003),
+                                 1, 1, 4, -1])
+    with open(links_fn, "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(["link_id", "begin_node_id", "end_node_id", "begin_angle",
+                         "end_angle", "street_length", "osm_name", "osm_class",
+                         "osm_way_id", "startX", "startY", "endX", "endY", "osm_changeset",
+                         "birth_timestamp", "death_timestamp"])
+        pairs = []
+        for i in range(size):
+            for j in range(size):
+                if(j + 1 < size):
+                    if(i % 3 != 1):
+                        pairs.append((node_id(i, j), node_id(i, j + 1)))
+                    if(i % 3 != 0):
+                        pairs.append((node_id(i, j + 1), node_id(i, j)))
+                if(i + 1 < size):
+                    pairs.append((node_id(i, j), node_id(i + 1, j)))
+                    pairs.append((node_id(i + 1, j), node_id(i, j)))
+        for (k, (begin, end)) in enumerate(pairs):
+            writer.writerow([k, begin, end, 0, 0, random.uniform(150, 260), "st",
+                             "residential", 7, 0, 0, 0, 0, 1, 1, 4])
+    return Map(nodes_fn, links_fn, region_kd_size=region_kd_size)
+
+
+# Gives the Links of a Map random travel times, and trips on about half of them
+def set_random_travel_times(road_map, seed):
+    random = Random(seed)
+    for link in road_map.links:
+        link.time = link.length / random.uniform(3, 15)
+        link.num_trips = random.choice([0, 0, 1, 4])
+
+
+# Checks that save_travel_times() writes each datetime with one DELETE, one COPY and one
+# commit, and that load_travel_times() reads back the same times
+# Returns:
+    # the number of failed checks
+def test_save_travel_times(road_map):
+    num_failures = 0
+    db_main.db_con = connection = StandInConnection()
+    date = datetime(2012, 3, 4, 5)
+
+    set_random_travel_times(road_map, 1)
+    saved_times = [link.time for link in road_map.links]
+    saved_trips = [link.num_trips for link in road_map.links]
+    db_travel_times.save_travel_times(road_map, date)
+    statements = [entry[0] for entry in connection.log]
+    if(statements != ["execute", "copy_from", "commit"] or
+            not connection.log[0][1].startswith("DELETE")):
+        print("save_travel_times() ran " + str(statements))
+        num_failures += 1
+
+    # Saving again overwrites the rows, and a batch writes several datetimes at once
+    del connection.log[:]
+    other_date = datetime(2012, 3, 4, 6)
+    db_travel_times.save_travel_time_batch(
+        [(d, db_travel_times.get_travel_time_rows(road_map, d)) for d in [date, other_date]])
+    statements = [entry[0] for entry in connection.log]
+    if(statements != ["execute", "copy_from", "commit"]):
+        print("save_travel_time_batch() ran " + str(statements))
+        num_failures += 1
+    num_rows = 1 + sum(1 for trips in saved_trips if trips > 0)
+    if(len(connection.tables["travel_times"]) != 2 * num_rows):
+        print("Expected %d rows, found %d" % (2 * num_rows,
+                                                len(connection.tables["travel_times"])))
+        num_failures += 1
+
+    # Only the links with trips are saved, but the others get the default speed
+    set_random_travel_times(road_map, 2)
+    db_travel_times.load_travel_times(road_map, date)
+    default_speed = float(road_map.links[0].length) / saved_times[0]
+    for (link, time, trips) in zip(road_map.links, saved_times, saved_trips):
+        expected = time if trips > 0 else link.length / default_speed
+        if(abs(link.time - expected) > 1e-9 * expected or link.num_trips != trips):
+            num_failures += 1
+    print("test_save_travel_times : %d failures" % num_failures)
+    return num_failures
+
+
+# Checks load_travel_times() with and without the default speed row, against the rows
+# that are in the table
+# Returns:
+    # the number of failed checks
+def test_load_travel_times(road_map):
+    num_failures = 0
+    db_main.db_con = connection = StandInConnection()
+    table = connection.tables["travel_times"]
+    date = "2012-03-04 05:00:00"
+    random = Random(3)
+    rows = {}
+    for link in road_map.links:
+        if(random.random() < .3):
+            rows[link.origin_node.node_id, link.connecting_node.node_id] = (
+                random.uniform(10, 100), random.randint(1, 9))
+    for ((begin, end), (time, trips)) in rows.items():
+        table.append({"begin_node_id": begin, "end_node_id": end, "datetime": date,
+                      "travel_time": time, "num_trips": trips})
+    # A row for a link which is not in the map is ignored
+    table.append({"begin_node_id": 1, "end_node_id": 2, "datetime": date,
+                  "travel_time": 5.0, "num_trips": 1})
+
+    for default_speed in [None, 6.5]:
+        if(default_speed is not None):
+            table.append({"begin_node_id": 0, "end_node_id": 0, "datetime": date,
+                          "travel_time": default_speed, "num_trips": 0})
+        set_random_travel_times(road_map, 4)
+        previous_times = [link.time for link in road_map.links]
+        db_travel_times.load_travel_times(road_map, date)
+        for (link, previous_time) in zip(road_map.links, previous_times):
+            key = (link.origin_node.node_id, link.connecting_node.node_id)
+            if(key in rows):
+                (expected_time, expected_trips) = rows[key]
+            elif(default_speed is None):
+                (expected_time, expected_trips) = (previous_time, 0)
+            else:
+                (expected_time, expected_trips) = (link.length / default_speed, 0)
+            graph_time = road_map.graph.link_time[link.link_id]
+            if(link.time != expected_time or graph_time != expected_time or
+                    link.num_trips != expected_trips):
+                num_failures += 1
+    print("test_load_travel_times : %d failures" % num_failures)
+    return num_failures
+
+
+# Checks that save_arc_flags() and load_arc_flags() give back the same flag matrices
+# Returns:
+    # the number of failed checks
+def test_arc_flags(road_map):
+    num_failures = 0
+    db_main.db_con = connection = StandInConnection()
+    date = datetime(2012, 3, 4, 5)
+
+    set_random_travel_times(road_map, 5)
+    road_map.assign_node_regions()
+    saved = road_map.compute_arc_flags()
+    (forward, backward) = (saved.forward.copy(), saved.backward.copy())
+    db_arc_flags.save_arc_flags(road_map, date)
+    # Saving again overwrites the rows
+    db_arc_flags.save_arc_flags(road_map, date)
+    if(len(connection.tables["arc_flags"]) != 2):
+        print("Expected 2 rows, found %d" % len(connection.tables["arc_flags"]))
+        num_failures += 1
+
+    road_map.assign_link_arc_flags()
+    db_arc_flags.load_arc_flags(road_map, date)
+    if(not (np.array_equal(road_map.arc_flags.forward, forward) and
+            np.array_equal(road_map.arc_flags.backward, backward))):
+        print("The loaded arc flags are different")
+        num_failures += 1
+    print("test_arc_flags : %d failures" % num_failures)
+    return num_failures
+
+
+if(__name__ == "__main__"):
+    directory = tempfile.mkdtemp()
+    try:
+        road_map = make_grid_map(directory)
+        num_failures = (test_save_travel_times(road_map) + test_load_travel_times(road_map) +
+                        test_arc_flags(road_map))
+    finally:
+        shutil.rmtree(directory)
+        db_main.db_con = None
+    print("Total failures : %d" % num_failures)
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized ArcFlags preprocessing on an ArrayGraph.
+
+The arc flags of a region come from the shortest path trees of its boundary nodes: a
+link gets the forward flag of the region if it is on a shortest path from some node to
+one of the region's boundary nodes, and the backward flag if it is on a shortest path
+from one of the boundary nodes to some node.  Links which touch the region always get
+both flags.
+
+Instead of storing a vector of boundary times on every Node (see DijkstrasAlgorithm),
+all of the labels live in one (num_nodes x num_boundary_nodes) array, and the tree
+links live in an array of the same shape.  The trees can be computed with one
+multi-source search which relaxes whole frontiers of labels at once
+(multi_source_labels()), or with one plain Dijkstra search per boundary node
+(single_source_labels()).
+"""
+import numpy as np
+from ArraySearch import shortest_path_tree
+from ArrayGraph import attach_graph
+
+
+# Finds the boundary nodes of all regions - nodes which have a link to or from another
+# region
+# Params:
+    # graph - an ArrayGraph, with node_region_id set (see Map.assign_node_regions())
+# Returns:
+    # a sorted array of node indices
+def get_all_boundary_nodes(graph):
+    region = graph.node_region_id
+    crossing = region[graph.link_origin] != region[graph.link_dest]
+    return np.unique(np.concatenate((graph.link_origin[crossing], graph.link_dest[crossing])))
+
+
+# Finds the boundary nodes of one region
+# Params:
+    # graph - an ArrayGraph, with node_region_id set (see Map.assign_node_regions())
+    # region_id - the region
+# Returns:
+    # a sorted array of node indices
+def get_boundary_nodes(graph, region_id):
+    boundary_nodes = get_all_boundary_nodes(graph)
+    return boundary_nodes[graph.node_region_id[boundary_nodes] == region_id]
+
+
+# Counts the boundary nodes of every region.  The preprocessing cost of a region grows
+# with its number of boundary nodes.
+# Params:
+    # graph - an ArrayGraph, with node_region_id set (see Map.assign_node_regions())
+    # num_regions - the number of regions
+# Returns:
+    # an array with one count per region
+def count_boundary_nodes(graph, num_regions):
+    boundary_nodes = get_all_boundary_nodes(graph)
+    return np.bincount(graph.node_region_id[boundary_nodes], minlength=num_regions)
+
+
+# Relaxes every link out of the nodes whose labels changed in the last round, for all
+# of the sources at once, until no label changes (a Bellman-Ford search restricted to
+# the frontier).  Each round is a handful of array operations over the whole frontier,
+# so there is no per-node Python work.
+# Params:
+    # labels - the (num_nodes x k) label array, updated in place
+    # sources - the node indices whose labels are initially finite
+    # times, neighbors, owner - one entry per CSR entry: the link time, the node that
+        # the label comes from, and the node that receives it.  Sorted by owner.
+# Returns:
+    # the number of link relaxations (one per link per round)
+def relax_frontier(labels, sources, times, neighbors, owner):
+    changed = np.zeros(len(labels), dtype=bool)
+    changed[sources] = True
+    num_relaxed = 0
+    while(True):
+        entries = np.flatnonzero(changed[neighbors])
+        if(len(entries) == 0):
+            break
+        num_relaxed += len(entries)
+
+        # The best proposed labels of every receiving node
+        receivers = owner[entries]
+        proposed = labels[neighbors[entries]] + times[entries]
+        starts = np.flatnonzero(np.concatenate(([True], receivers[1:] != receivers[:-1])))
+        proposed = np.minimum.reduceat(proposed, starts, axis=0)
+        receivers = receivers[starts]
+
+        current = labels[receivers]
+        improved = (proposed < current).any(axis=1)
+        receivers = receivers[improved]
+        labels[receivers] = np.minimum(current[improved], proposed[improved])
+        changed[:] = False
+        changed[receivers] = True
+    return num_relaxed
+
+
+# Computes the shortest path trees of many sources at once, with relax_frontier().  The
+# tree link of every node is then a link whose relaxation gives exactly its label (the
+# last such link in CSR order).
+# Params:
+    # graph - an ArrayGraph
+    # sources - an array of node indices, one per tree
+    # link_time - the travel time of every link.  Uses graph.link_time if None.  Links
+        # whose time is not positive are ignored
+    # backward - compute the trees towards the sources instead of away from them
+    # max_columns - the sources are processed in chunks of this many, to bound the size
+        # of the temporary arrays
+# Returns:
+    # labels - labels[v, i] is the travel time from sources[i] to v (or from v to
+        # sources[i] if backward)
+    # preds - preds[v, i] is the link that reaches v in the tree of sources[i] (or the
+        # link that leaves v if backward), -1 for the source and unreachable nodes
+    # num_relaxed - the number of link relaxations
+def multi_source_labels(graph, sources, link_time=None, backward=False, max_columns=64):
+    if(link_time is None):
+        link_time = graph.link_time
+    # Labels are pulled along the links into a node, so a forward search groups the
+    # links by their dest, and a backward search by their origin
+    if(backward):
+        (offsets, link_ids, neighbors) = (graph.forward_offsets, graph.forward_link_ids,
+                                          graph.forward_neighbors)
+    else:
+        (offsets, link_ids, neighbors) = (graph.backward_offsets, graph.backward_link_ids,
+                                          graph.backward_neighbors)
+    times = link_time[link_ids]
+    times = np.where(times > 0, times, np.inf)[:, np.newaxis]
+    owner = np.repeat(np.arange(graph.num_nodes), np.diff(offsets))
+    entry_ids = np.arange(len(link_ids))[:, np.newaxis]
+    nonempty = np.flatnonzero(np.diff(offsets) > 0)
+
+    sources = np.asarray(sources, dtype=np.int64)
+    labels = np.empty((graph.num_nodes, len(sources)))
+    labels.fill(np.inf)
+    preds = np.empty((graph.num_nodes, len(sources)), dtype=np.int32)
+    preds.fill(-1)
+    num_relaxed = 0
+    for lo in xrange(0, len(sources), max_columns):
+        chunk = sources[lo:lo + max_columns]
+        chunk_labels = labels[:, lo:lo + len(chunk)]
+        chunk_labels[chunk, np.arange(len(chunk))] = 0.0
+        num_relaxed += relax_frontier(chunk_labels, chunk, times, neighbors, owner)
+        labels[:, lo:lo + len(chunk)] = chunk_labels
+
+        if(len(nonempty) > 0):
+            proposed = chunk_labels[neighbors] + times
+            tight = (proposed == chunk_labels[owner]) & (proposed < np.inf)
+            last = np.maximum.reduceat(np.where(tight, entry_ids, -1),
+                                       offsets[nonempty], axis=0)
+            preds[nonempty, lo:lo + len(chunk)] = np.where(
+                last >= 0, link_ids[np.maximum(last, 0)], -1)
+
+    return labels, preds, num_relaxed
+
+
+# Computes the same trees as multi_source_labels(), with one plain Dijkstra search per
+# source (see ArraySearch.shortest_path_tree()).  The third return value is the number
+# of node expansions.
+def single_source_labels(graph, sources, link_time=None, backward=False):
+    if(link_time is None):
+        link_time = graph.link_time
+    link_time = np.where(link_time > 0, link_time, np.inf)
+
+    labels = np.empty((graph.num_nodes, len(sources)))
+    preds = np.empty((graph.num_nodes, len(sources)), dtype=np.int32)
+    num_expanded = 0
+    for (i, source) in enumerate(sources):
+        (dist, pred, order) = shortest_path_tree(graph, source, link_time, backward=backward)
+        labels[:, i] = dist
+        preds[:, i] = pred
+        num_expanded += len(order)
+    return labels, preds, num_expanded
+
+
+# Computes how fast every link would have to become before it could be on a shortest
+# path of some tree.  A link whose time is at most its slack is on a shortest path
+# (tight), and a link whose time drops below its slack creates a new one.  Times that
+# change without crossing the slack leave the trees alone (see Map.update_arc_flags()).
+# Params:
+    # graph - an ArrayGraph
+    # labels - the labels returned by multi_source_labels() or single_source_labels()
+    # backward - whether the labels are towards the sources
+    # max_links - links are processed in chunks of this many, to bound memory
+# Returns:
+    # a float32 array with one slack per link.  -inf if the link cannot reach any tree.
+def link_slack(graph, labels, backward, max_links=65536):
+    # The label along the link is pulled from the end that is closer to the sources
+    if(backward):
+        (near, far) = (graph.link_dest, graph.link_origin)
+    else:
+        (near, far) = (graph.link_origin, graph.link_dest)
+    slack = np.empty(graph.num_links, dtype=np.float32)
+    for lo in xrange(0, graph.num_links, max_links):
+        near_labels = labels[near[lo:lo + max_links]]
+        far_labels = labels[far[lo:lo + max_links]]
+        differences = np.where(near_labels < np.inf, far_labels - near_labels, -np.inf)
+        slack[lo:lo + max_links] = differences.max(axis=1)
+    return slack
+
+
+# Computes the arc flags of one region
+# Params:
+    # graph - an ArrayGraph, with node_region_id set (see Map.assign_node_regions())
+    # region_id - the region
+    # link_time - the travel time of every link.  Uses graph.link_time if None
+    # method - "multi" for multi_source_labels(), or "single" for single_source_labels()
+    # with_slack - also return the slack of every link (see link_slack())
+# Returns:
+    # forward_flags - a boolean array with one entry per link, the column of this region
+        # in the forward arc flags
+    # backward_flags - the same for the backward arc flags
+    # forward_slack, backward_slack - only if with_slack.  The slack of every link in
+        # the trees into and out of the region.
+def region_arc_flags(graph, region_id, link_time=None, method="multi", with_slack=False):
+    if(method == "multi"):
+        compute_labels = multi_source_labels
+    elif(method == "single"):
+        compute_labels = single_source_labels
+    else:
+        raise Exception("Unknown ArcFlags preprocessing method: " + str(method))
+
+    # Links which touch the region are always flagged
+    region = graph.node_region_id
+    forward_flags = ((region[graph.link_origin] == region_id) |
+                     (region[graph.link_dest] == region_id))
+    backward_flags = forward_flags.copy()
+    forward_slack = np.empty(graph.num_links, dtype=np.float32)
+    forward_slack.fill(-np.inf)
+    backward_slack = forward_slack.copy()
+
+    boundary_nodes = get_boundary_nodes(graph, region_id)
+    if(len(boundary_nodes) > 0):
+        # Links on shortest paths into the region
+        (labels, preds, _) = compute_labels(graph, boundary_nodes, link_time, backward=True)
+        forward_flags[preds[preds >= 0]] = True
+        if(with_slack):
+            forward_slack = link_slack(graph, labels, backward=True)
+        # Links on shortest paths out of the region
+        (labels, preds, _) = compute_labels(graph, boundary_nodes, link_time, backward=False)
+        backward_flags[preds[preds >= 0]] = True
+        if(with_slack):
+            backward_slack = link_slack(graph, labels, backward=False)
+
+    if(with_slack):
+        return forward_flags, backward_flags, forward_slack, backward_slack
+    return forward_flags, backward_flags
+
+
+# Computes the arc flags of one region in a worker process.  The worker attaches to a
+# shared snapshot of the graph, so it only receives the travel times.
+# Params: Note that this is passed as a single tuple, for use with Pool.map()
+    # graph_fn - a snapshot file written by Map.get_shared_snapshot()
+    # link_time - the travel time of every link
+    # region_id - the region
+    # method - see region_arc_flags()
+    # with_slack - also compute the slack of every link
+# Returns:
+    # region_id - the region
+    # forward_bits - the forward flag column of the region, packed with np.packbits()
+    # backward_bits - the same for the backward flags
+    # slack - (forward_slack, backward_slack) if with_slack, otherwise None
+def region_arc_flags_task((graph_fn, link_time, region_id, method, with_slack)):
+    graph = attach_graph(graph_fn)
+    columns = region_arc_flags(graph, region_id, link_time, method, with_slack)
+    slack = columns[2:] if with_slack else None
+    return region_id, np.packbits(columns[0]), np.packbits(columns[1]), slack
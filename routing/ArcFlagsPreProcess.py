@@ -6,6 +6,7 @@ from Map import Map
 from db_functions import db_arc_flags
 from db_functions import db_main
 from datetime import datetime
+from multiprocessing import Pool
 from traffic_estimation import plot_estimates
 import cluster_kd
 
@@ -25,54 +26,44 @@ class ArcFlagsPreProcess:
             final_string += str(hex(value_to_hex))[-1:]
         return final_string
 
+    # Params:
+        # region_size - the approximate number of trips per region
+        # num_cpus - the regions are computed in parallel on this many processes
     @staticmethod
-    def run(region_size = 250):
+    def run(region_size = 250, num_cpus = 1):
         # nyc_map = Map("nyc_map4/nodes.csv", "nyc_map4/links.csv",
         #               lookup_kd_size=1, region_kd_size=region_size,
         #               limit_bbox=Map.reasonable_nyc_bbox)
         # nyc_map.assign_node_regions()
         nyc_map = cluster_kd.createMap(region_size)
-        nyc_map.assign_link_arc_flags()
 
         #nyc_map.save_region("../nyc_map4/region.csv")
         #get_correct_nodes(nyc_map, "../speeds_per_hour/" + map_file, None)
 
-        i = 0
         print nyc_map.total_region_count
-        for region_id in range(nyc_map.total_region_count):
-            # print "Next Region!"
-
-            boundary_nodes = nyc_map.get_region_boundary_nodes(region_id)
-
-            # Does a multi-origin bidirectional dijkstra search to get an
-            # arcflag tree
-            warmstart = True
-            use_domination_value = False
-            DijkstrasAlgorithm.bidirectional_dijkstra(boundary_nodes,
-                                                      nyc_map,
-                                                      warmstart,
-                                                      use_domination_value)
-            #####################################################################
-            # DRAW ARC_FLAGS USING THIS
-            # pace_dict = {}
-            # for link in nyc_map.links:
-            #     if link.backward_arc_flags_vector[i] == True:
-            #         pace_dict[(link.origin_node_id, link.connecting_node_id)] = 5
-            #     else:
-            #         pace_dict[(link.origin_node_id, link.connecting_node_id)] = -5
-            # plot_estimates.plot_speed(nyc_map, "Backward Arc Flags Region: " + str(i), "Backward"+str(i), pace_dict)
-
-            # pace_dict = {}
-            # for link in nyc_map.links:
-            #     if link.forward_arc_flags_vector[i] == True:
-            #         pace_dict[(link.origin_node_id, link.connecting_node_id)] = 5
-            #     else:
-            #         pace_dict[(link.origin_node_id, link.connecting_node_id)] = -5
-
-            # plot_estimates.plot_speed(nyc_map, "Forward Arc Flags Region: " + str(i), "Forward"+str(i), pace_dict)
-
-            #####################################################################
-            i += 1
+        # Computes the arc flags of all regions on the array graph.  The old
+        # per-region search was:
+        # DijkstrasAlgorithm.bidirectional_dijkstra(boundary_nodes, nyc_map,
+        #                                           warmstart, use_domination_value)
+        start_time = timeit.default_timer()
+        if(num_cpus > 1):
+            pool = Pool(num_cpus)
+            nyc_map.compute_arc_flags(pool=pool)
+            pool.terminate()
+        else:
+            nyc_map.compute_arc_flags()
+        print "Computed arc flags in " + str(timeit.default_timer() - start_time) + " seconds"
+        #####################################################################
+        # DRAW ARC_FLAGS USING THIS
+        # for i in range(nyc_map.total_region_count):
+        #     pace_dict = {}
+        #     for link in nyc_map.links:
+        #         if nyc_map.arc_flags.get_flag(link.link_id, i, backward=True):
+        #             pace_dict[(link.origin_node_id, link.connecting_node_id)] = 5
+        #         else:
+        #             pace_dict[(link.origin_node_id, link.connecting_node_id)] = -5
+        #     plot_estimates.plot_speed(nyc_map, "Backward Arc Flags Region: " + str(i), "Backward"+str(i), pace_dict)
+        #####################################################################
 
 
         d = datetime(2012,3,5,2)
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+A compact, array-based representation of a road network.  Nodes and Links are
+identified by dense integer indices, and all of their attributes live in NumPy
+arrays.  Adjacency is stored in compressed sparse row (CSR) form, for both the
+forward graph and the backward graph.
+
+The indices are shared with the Map that the graph was built from - node index i
+is Map.nodes[i] (also stored as Node.node_index) and link index j is Map.links[j]
+(also stored as Link.link_id).  This makes it cheap to move back and forth between
+the object representation and the arrays.
+"""
+import numpy as np
+import snapshot
+
+
+# Meters per degree of latitude and longitude (assume NYC is "flat enough").
+# These are the same constants used by Node.location and Map.get_nearest_node()
+LAT_METERS = 111194.86461
+LON_METERS = 84253.1418965
+
+
+# Builds one direction of CSR adjacency.
+# Params:
+    # keys - for each link, the index of the node that the link is attached to
+    # num_nodes - the total number of nodes in the graph
+# Returns:
+    # offsets - the links of node i are link_ids[offsets[i]:offsets[i+1]]
+    # link_ids - link indices, grouped by node
+def build_csr(keys, num_nodes):
+    link_ids = np.argsort(keys, kind='mergesort').astype(np.int32)
+    counts = np.bincount(keys, minlength=num_nodes)
+    offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets, link_ids
+
+
+# ArrayGraphs which this process has attached to, by filename (see attach_graph())
+_attached_graphs = {}
+
+
+# Attaches to the graph that is stored in a snapshot file (see Map.get_shared_snapshot()).
+# The arrays are memory-mapped read-only, so every process on the machine which attaches
+# to the same file shares one physical copy of them.  The graph is only loaded once per
+# process - later calls return the same object.
+# Params:
+    # filename - a snapshot file written by Map.save_snapshot()
+    # prefix - the prefix of the graph arrays in the snapshot
+# Returns:
+    # an ArrayGraph
+def attach_graph(filename, prefix="graph_"):
+    if(filename not in _attached_graphs):
+        arrays, _ = snapshot.load_snapshot(filename, mmap=True)
+        _attached_graphs[filename] = ArrayGraph.from_arrays(arrays, prefix=prefix)
+    return _attached_graphs[filename]
+
+
+# A road network stored as flat NumPy arrays.
+# Node attributes (indexed by node index):
+    # node_ids - the original (OSM) node ids
+    # node_lat, node_lon - coordinates in degrees
+    # node_region_id - the region of each node (see Map.assign_node_regions())
+# Link attributes (indexed by link index):
+    # link_origin, link_dest - node indices of the two ends of the link
+    # link_length - length in meters
+    # link_time - travel time in seconds
+    # link_num_trips - the number of trips which used this link
+# Adjacency:
+    # forward_offsets, forward_link_ids, forward_neighbors - the outgoing links of node
+        # i are forward_link_ids[forward_offsets[i]:forward_offsets[i+1]], and they lead
+        # to the nodes forward_neighbors[forward_offsets[i]:forward_offsets[i+1]]
+    # backward_offsets, backward_link_ids, backward_neighbors - same for the incoming links
+class ArrayGraph(object):
+
+    # Params:
+        # node_ids, node_lat, node_lon, node_region_id - one entry per node
+        # link_origin, link_dest - node indices (not node ids) of each link's ends
+        # link_length, link_time, link_num_trips - one entry per link
+    def __init__(self, node_ids, node_lat, node_lon, node_region_id,
+                 link_origin, link_dest, link_length, link_time,
+                 link_num_trips=None):
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        self.node_lat = np.asarray(node_lat, dtype=np.float64)
+        self.node_lon = np.asarray(node_lon, dtype=np.float64)
+        self.node_region_id = np.asarray(node_region_id, dtype=np.int32)
+
+        self.link_origin = np.asarray(link_origin, dtype=np.int32)
+        self.link_dest = np.asarray(link_dest, dtype=np.int32)
+        self.link_length = np.asarray(link_length, dtype=np.float64)
+        self.link_time = np.array(link_time, dtype=np.float64)
+        if(link_num_trips is None):
+            self.link_num_trips = np.zeros(len(self.link_origin), dtype=np.float64)
+        else:
+            self.link_num_trips = np.array(link_num_trips, dtype=np.float64)
+
+        self.num_nodes = len(self.node_ids)
+        self.num_links = len(self.link_origin)
+
+        self.build_adjacency()
+        self.build_lookups()
+
+    # Builds an ArrayGraph that mirrors the Nodes and Links of a Map.  The Map's
+    # Nodes must already have their node_index set (see Map.build_graph())
+    # Params:
+        # road_map - a Map object
+    # Returns:
+        # a new ArrayGraph
+    @staticmethod
+    def from_map(road_map):
+        nodes = road_map.nodes
+        links = road_map.links
+        n = len(nodes)
+        m = len(links)
+        return ArrayGraph(
+            np.fromiter((node.node_id for node in nodes), np.int64, n),
+            np.fromiter((node.lat for node in nodes), np.float64, n),
+            np.fromiter((node.long for node in nodes), np.float64, n),
+            np.fromiter((node.region_id for node in nodes), np.int32, n),
+            np.fromiter((link.origin_node.node_index for link in links), np.int32, m),
+            np.fromiter((link.connecting_node.node_index for link in links), np.int32, m),
+            np.fromiter((link.length for link in links), np.float64, m),
+            np.fromiter((link.time for link in links), np.float64, m),
+            np.fromiter((link.num_trips for link in links), np.float64, m))
+
+    # The names of all of the arrays that make up an ArrayGraph
+    ARRAY_NAMES = ["node_ids", "node_lat", "node_lon", "node_region_id",
+                   "link_origin", "link_dest", "link_length", "link_time",
+                   "link_num_trips",
+                   "forward_offsets", "forward_link_ids", "forward_neighbors",
+                   "backward_offsets", "backward_link_ids", "backward_neighbors",
+                   "node_id_order", "sorted_node_ids",
+                   "link_key_order", "sorted_link_keys"]
+
+    # Returns all of the arrays of this graph, including the adjacency and lookup
+    # arrays, as a dictionary.  The dictionary can be passed to from_arrays()
+    # Params:
+        # prefix - a prefix for the names (useful when saving other arrays alongside)
+    def to_arrays(self, prefix=""):
+        return dict((prefix + name, getattr(self, name)) for name in ArrayGraph.ARRAY_NAMES)
+
+    # Rebuilds an ArrayGraph from the output of to_arrays().  Nothing is recomputed,
+    # so the arrays may be read-only (e.g. memory-mapped).  The travel times, trip
+    # counts and region ids are always copied, so they can be modified.
+    # Params:
+        # arrays - a dictionary of arrays
+        # prefix - the prefix that was passed to to_arrays()
+    # Returns:
+        # a new ArrayGraph
+    @staticmethod
+    def from_arrays(arrays, prefix=""):
+        graph = ArrayGraph.__new__(ArrayGraph)
+        for name in ArrayGraph.ARRAY_NAMES:
+            setattr(graph, name, arrays[prefix + name])
+        graph.link_time = np.array(graph.link_time, dtype=np.float64)
+        graph.link_num_trips = np.array(graph.link_num_trips, dtype=np.float64)
+        graph.node_region_id = np.array(graph.node_region_id, dtype=np.int32)
+        graph.num_nodes = len(graph.node_ids)
+        graph.num_links = len(graph.link_origin)
+        return graph
+
+    # Builds the forward and backward CSR adjacency arrays from link_origin and link_dest
+    def build_adjacency(self):
+        self.forward_offsets, self.forward_link_ids = build_csr(
+            self.link_origin, self.num_nodes)
+        self.forward_neighbors = self.link_dest[self.forward_link_ids]
+
+        self.backward_offsets, self.backward_link_ids = build_csr(
+            self.link_dest, self.num_nodes)
+        self.backward_neighbors = self.link_origin[self.backward_link_ids]
+
+    # Builds sorted key arrays, which are used to translate node ids and
+    # (begin_node_id, end_node_id) pairs into indices without any dicts
+    def build_lookups(self):
+        self.node_id_order = np.argsort(self.node_ids, kind='mergesort')
+        self.sorted_node_ids = self.node_ids[self.node_id_order]
+
+        link_keys = (self.link_origin.astype(np.int64) * self.num_nodes
+                     + self.link_dest)
+        self.link_key_order = np.argsort(link_keys, kind='mergesort')
+        self.sorted_link_keys = link_keys[self.link_key_order]
+
+    # Translates node ids into node indices
+    # Params:
+        # node_ids - an array-like of node ids
+    # Returns:
+        # an array of node indices, which is -1 wherever the node id is unknown
+    def get_node_indices(self, node_ids):
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        if(self.num_nodes == 0):
+            return np.repeat(-1, len(node_ids))
+        pos = np.searchsorted(self.sorted_node_ids, node_ids)
+        pos = np.minimum(pos, self.num_nodes - 1)
+        found = self.sorted_node_ids[pos] == node_ids
+        return np.where(found, self.node_id_order[pos], -1)
+
+    # Translates (begin_node_id, end_node_id) pairs into link indices
+    # Params:
+        # begin_node_ids - an array-like of node ids where the links start
+        # end_node_ids - an array-like of node ids where the links end
+    # Returns:
+        # an array of link indices, which is -1 wherever there is no such link
+    def get_link_indices(self, begin_node_ids, end_node_ids):
+        begin = self.get_node_indices(begin_node_ids)
+        end = self.get_node_indices(end_node_ids)
+        if(self.num_links == 0):
+            return np.repeat(-1, len(begin))
+        keys = begin * self.num_nodes + end
+        pos = np.searchsorted(self.sorted_link_keys, keys)
+        pos = np.minimum(pos, self.num_links - 1)
+        found = ((self.sorted_link_keys[pos] == keys) & (begin >= 0) & (end >= 0))
+        return np.where(found, self.link_key_order[pos], -1)
+
+    # The outgoing links of a node
+    # Params:
+        # i - a node index
+    # Returns:
+        # an array of link indices
+    def get_forward_links(self, i):
+        return self.forward_link_ids[self.forward_offsets[i]:self.forward_offsets[i + 1]]
+
+    # The incoming links of a node
+    # Params:
+        # i - a node index
+    # Returns:
+        # an array of link indices
+    def get_backward_links(self, i):
+        return self.backward_link_ids[self.backward_offsets[i]:self.backward_offsets[i + 1]]
+
+    # Node coordinates in meters, using the same flat-earth approximation as Node.location
+    # Returns:
+        # x - latitude in meters, y - longitude in meters
+    def get_node_locations(self):
+        return self.node_lat * LAT_METERS, self.node_lon * LON_METERS
+
+    # Finds the maximum speed of any link in the graph
+    # Params:
+        # link_time - optional travel times to use instead of self.link_time
+    def get_max_speed(self, link_time=None):
+        if(link_time is None):
+            link_time = self.link_time
+        if(self.num_links == 0):
+            return 0.0
+        return float(np.max(self.link_length / link_time))
+
+    # Approximate number of bytes held by the arrays of this graph
+    def get_memory_usage(self):
+        return sum(value.nbytes for value in self.__dict__.values()
+                   if isinstance(value, np.ndarray))
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+Shortest path searches which run directly on an ArrayGraph, without touching any
+Node or Link objects.  All of the search state lives in local dictionaries, so
+nothing needs to be reset afterwards.  Since a search only needs the graph arrays
+and a vector of link travel times, it can run in a worker process which has
+attached to a shared, memory-mapped graph (see ArrayGraph.attach_graph()).
+"""
+import heapq
+from math import sqrt
+import numpy as np
+from ArrayGraph import attach_graph, LAT_METERS, LON_METERS
+
+# The same discount that BiDirectionalSearch uses for the A* heuristic
+HEURISTIC_DISCOUNT = .75
+
+# An origin needs at least this many distinct destinations before it is routed with
+# one shortest path tree (see route_from_origin()).  A single destination is found
+# faster with a bidirectional search.
+MIN_TREE_DESTINATIONS = 2
+
+
+# Uses bidirectional Dijkstra (or A*) search to find the shortest path between two nodes.
+# The search stops as soon as the smallest keys of the two queues add up to at least
+# the best path found so far, which guarantees that this path is the shortest one.
+# For A*, the two searches use the average potentials
+# p_f(v) = (dist(v, dest) - dist(origin, v)) / (2 * max_speed) and p_b(v) = -p_f(v),
+# which keep this stopping rule exact.
+# With landmark_bounds (ALT), the euclidean distances are replaced by the landmark lower
+# bounds on the travel times to dest and from origin.  These are admissible without any
+# discount, so the path is always the shortest one.
+# Params:
+    # graph - an ArrayGraph
+    # origin - the node index at the beginning of the path
+    # dest - the node index at the end of the path
+    # link_time - the travel time of every link.  Uses graph.link_time if None
+    # use_astar - use the euclidean distance heuristic to guide the search
+    # max_speed - maximum speed on any link in the graph, used for the A* heuristic
+    # landmark_bounds - Landmarks.node_bounds, computed with the same link times.  If
+        # given, the landmark heuristic is used instead of the euclidean one
+# Returns:
+    # path - a list of link indices on the shortest path, in order, or None if no
+        # such path exists
+    # num_expanded - the number of nodes that were expanded during the search
+def bidirectional_search(graph, origin, dest, link_time=None, use_astar=False,
+                         max_speed=1.0, landmark_bounds=None):
+    if(origin == dest):
+        return [], 0
+    (path, _, _, num_expanded) = candidate_search(graph, [origin], [0.0], [dest], [0.0],
+                                                  link_time, use_astar, max_speed,
+                                                  landmark_bounds)
+    return path, num_expanded
+
+
+# The same search as bidirectional_search(), but with several candidate origins and
+# destinations, each with a head start (for example the time to reach the node from a
+# GPS point that lies between streets).  The forward queue is seeded with every origin
+# at its start time, and the backward queue with every destination at its end time, so
+# one search finds the best (origin, path, destination) combination.  This is the same
+# as one search between a virtual source with a link to every origin and a virtual
+# target with a link from every destination.  The heuristics use the smallest bound
+# over the candidates, which keeps them consistent.
+# Params:
+    # graph - an ArrayGraph
+    # origins - a list of candidate node indices for the beginning of the path
+    # origin_times - the time that is added before each origin
+    # dests - a list of candidate node indices for the end of the path
+    # dest_times - the time that is added after each destination
+    # link_time, use_astar, max_speed, landmark_bounds - see bidirectional_search()
+# Returns:
+    # path - a list of link indices on the best path, in order, or None if no
+        # candidate origin can reach a candidate destination
+    # origin - the node index where the path begins (-1 if there is no path)
+    # dest - the node index where the path ends (-1 if there is no path)
+    # num_expanded - the number of nodes that were expanded during the search
+def candidate_search(graph, origins, origin_times, dests, dest_times, link_time=None,
+                     use_astar=False, max_speed=1.0, landmark_bounds=None):
+    if(link_time is None):
+        link_time = graph.link_time
+    origin_times = [float(t) for t in origin_times]
+    dest_times = [float(t) for t in dest_times]
+
+    if(landmark_bounds is not None):
+        bound_to_dest = landmark_bound_function(landmark_bounds, dests, dest_times, True)
+        bound_from_origin = landmark_bound_function(landmark_bounds, origins, origin_times,
+                                                    False)
+        potentials = {}
+
+        def potential(v):
+            if(v not in potentials):
+                bounds = landmark_bounds[v]
+                potentials[v] = (bound_to_dest(bounds) - bound_from_origin(bounds)) * .5
+            return potentials[v]
+    elif(use_astar):
+        node_lat = graph.node_lat
+        node_lon = graph.node_lon
+        # The head starts are converted to distances, so that they are discounted along
+        # with the euclidean distances
+        to_meters = max_speed / HEURISTIC_DISCOUNT
+        origin_points = [(float(node_lat[o]) * LAT_METERS, float(node_lon[o]) * LON_METERS,
+                          t * to_meters) for (o, t) in zip(origins, origin_times)]
+        dest_points = [(float(node_lat[d]) * LAT_METERS, float(node_lon[d]) * LON_METERS,
+                        t * to_meters) for (d, t) in zip(dests, dest_times)]
+        scale = HEURISTIC_DISCOUNT / (2 * max_speed)
+
+        def potential(v):
+            x = node_lat[v] * LAT_METERS
+            y = node_lon[v] * LON_METERS
+            to_dest = min([sqrt((x - d_x) ** 2 + (y - d_y) ** 2) + extra
+                           for (d_x, d_y, extra) in dest_points])
+            from_origin = min([sqrt((x - o_x) ** 2 + (y - o_y) ** 2) + extra
+                               for (o_x, o_y, extra) in origin_points])
+            return float(to_dest - from_origin) * scale
+    else:
+        def potential(v):
+            return 0.0
+
+    forward_time = {}
+    backward_time = {}
+    for (origin, time) in zip(origins, origin_times):
+        if(time < forward_time.get(origin, float('inf'))):
+            forward_time[origin] = time
+    for (dest, time) in zip(dests, dest_times):
+        if(time < backward_time.get(dest, float('inf'))):
+            backward_time[dest] = time
+    forward_pred = dict.fromkeys(forward_time, -1)
+    backward_pred = dict.fromkeys(backward_time, -1)
+    forward_expanded = set()
+    backward_expanded = set()
+    forward_pq = [(time + potential(node), node)
+                  for (node, time) in forward_time.iteritems()]
+    backward_pq = [(time - potential(node), node)
+                   for (node, time) in backward_time.iteritems()]
+    heapq.heapify(forward_pq)
+    heapq.heapify(backward_pq)
+
+    # A candidate may be both an origin and a destination
+    best_full_time = float('inf')
+    center_node = -1
+    for (node, time) in forward_time.iteritems():
+        if(node in backward_time and time + backward_time[node] < best_full_time):
+            best_full_time = time + backward_time[node]
+            center_node = node
+
+    while(len(forward_pq) > 0 and len(backward_pq) > 0):
+        # No path through an unexpanded node can beat the best one found so far
+        if(forward_pq[0][0] + backward_pq[0][0] >= best_full_time):
+            break
+
+        # Expand the search whose next node is closer
+        if(forward_pq[0][0] <= backward_pq[0][0]):
+            (pq, times, preds, expanded, other_times) = (
+                forward_pq, forward_time, forward_pred, forward_expanded, backward_time)
+            (offsets, link_ids, neighbors, sign) = (
+                graph.forward_offsets, graph.forward_link_ids, graph.forward_neighbors, 1)
+        else:
+            (pq, times, preds, expanded, other_times) = (
+                backward_pq, backward_time, backward_pred, backward_expanded, forward_time)
+            (offsets, link_ids, neighbors, sign) = (
+                graph.backward_offsets, graph.backward_link_ids, graph.backward_neighbors, -1)
+
+        (_, node) = heapq.heappop(pq)
+        # Skip stale queue entries, left over from earlier relaxations of this node
+        if(node in expanded):
+            continue
+        expanded.add(node)
+        node_time = times[node]
+
+        lo = offsets[node]
+        hi = offsets[node + 1]
+        for (link, neighbor, time) in zip(link_ids[lo:hi].tolist(),
+                                          neighbors[lo:hi].tolist(),
+                                          link_time[link_ids[lo:hi]].tolist()):
+            proposed_time = node_time + time
+            if(proposed_time < times.get(neighbor, float('inf'))):
+                times[neighbor] = proposed_time
+                preds[neighbor] = link
+                heapq.heappush(pq, (proposed_time + sign * potential(neighbor), neighbor))
+
+                # Keep track of the best complete path seen so far
+                if(neighbor in other_times and
+                        proposed_time + other_times[neighbor] < best_full_time):
+                    best_full_time = proposed_time + other_times[neighbor]
+                    center_node = neighbor
+
+    num_expanded = len(forward_expanded) + len(backward_expanded)
+    if(center_node == -1):
+        return None, -1, -1, num_expanded
+    path = reconstruct_path(graph, center_node, forward_pred, backward_pred)
+    if(len(path) == 0):
+        return path, center_node, center_node, num_expanded
+    return (path, int(graph.link_origin[path[0]]), int(graph.link_dest[path[-1]]),
+            num_expanded)
+
+
+# Builds a function which gives the landmark lower bound on the travel time between a
+# node and the closest of some candidate nodes, including their head starts (see
+# candidate_search()).  A single candidate gets a faster function.
+# Params:
+    # landmark_bounds - Landmarks.node_bounds
+    # candidates - a list of node indices
+    # extra_times - the head start of every candidate
+    # to_candidates - bound the time from the node to the candidates if True, or from
+        # the candidates to the node if False
+# Returns:
+    # a function which takes the landmark_bounds row of a node
+def landmark_bound_function(landmark_bounds, candidates, extra_times, to_candidates):
+    if(len(candidates) == 1):
+        candidate_bounds = landmark_bounds[candidates[0]]
+        extra_time = extra_times[0]
+        if(to_candidates):
+            return lambda bounds: (max(float((bounds - candidate_bounds).max()), 0.0) +
+                                   extra_time)
+        return lambda bounds: (max(float((candidate_bounds - bounds).max()), 0.0) +
+                               extra_time)
+
+    candidate_bounds = landmark_bounds[candidates]
+    extra_times = np.array(extra_times)
+    if(to_candidates):
+        return lambda bounds: float((np.maximum((bounds - candidate_bounds).max(axis=1), 0.0) +
+                                     extra_times).min())
+    return lambda bounds: float((np.maximum((candidate_bounds - bounds).max(axis=1), 0.0) +
+                                 extra_times).min())
+
+
+# A full Dijkstra search from one node, which finds the travel time to (or from) every
+# other node.
+# Params:
+    # graph - an ArrayGraph
+    # source - the node index where the search begins
+    # link_time - the travel time of every link.  Uses graph.link_time if None
+    # backward - search the reversed graph, which finds the travel times to source
+    # targets - if given, the search stops as soon as all of these node indices have been
+        # settled.  The times (and tree) are then only final for the settled nodes
+# Returns:
+    # dist - the travel time from source to every node (inf if unreachable)
+    # pred - the link that reached each node on the shortest path tree (-1 for source
+        # and for unreachable nodes)
+    # order - node indices, in the order they were settled
+def shortest_path_tree(graph, source, link_time=None, backward=False, targets=None):
+    if(link_time is None):
+        link_time = graph.link_time
+    if(backward):
+        (offsets, link_ids, neighbors) = (graph.backward_offsets, graph.backward_link_ids,
+                                          graph.backward_neighbors)
+    else:
+        (offsets, link_ids, neighbors) = (graph.forward_offsets, graph.forward_link_ids,
+                                          graph.forward_neighbors)
+    offsets = offsets.tolist()
+    neighbors = neighbors.tolist()
+    times = link_time[link_ids].tolist()
+    link_ids = link_ids.tolist()
+
+    inf = float('inf')
+    dist = [inf] * graph.num_nodes
+    pred = [-1] * graph.num_nodes
+    order = []
+    dist[source] = 0.0
+    pq = [(0.0, source)]
+    targets_left = None
+    if(targets is not None):
+        targets_left = set(targets)
+        targets_left.discard(source)
+        if(len(targets_left) == 0):
+            pq = []
+            order.append(source)
+    while(len(pq) > 0):
+        (node_time, node) = heapq.heappop(pq)
+        if(node_time > dist[node]):
+            continue
+        order.append(node)
+        if(targets_left is not None and node in targets_left):
+            targets_left.remove(node)
+            if(len(targets_left) == 0):
+                break
+        for i in xrange(offsets[node], offsets[node + 1]):
+            proposed_time = node_time + times[i]
+            neighbor = neighbors[i]
+            if(proposed_time < dist[neighbor]):
+                dist[neighbor] = proposed_time
+                pred[neighbor] = link_ids[i]
+                heapq.heappush(pq, (proposed_time, neighbor))
+
+    return (np.array(dist, dtype=np.float64), np.array(pred, dtype=np.int64),
+            np.array(order, dtype=np.int64))
+
+
+# Finds the shortest paths from one origin to many destinations, by growing a single
+# shortest path tree from the origin until all of the destinations are settled.
+# Params:
+    # graph - an ArrayGraph
+    # origin - the node index where all of the paths begin
+    # dests - a list of node indices where the paths end
+    # link_time - the travel time of every link.  Uses graph.link_time if None
+    # use_astar - if there are fewer than MIN_TREE_DESTINATIONS distinct destinations,
+        # they are routed with bidirectional_search() instead - this is passed on to it
+    # max_speed - passed on to bidirectional_search()
+# Returns:
+    # a list of paths, one per destination (see bidirectional_search())
+def route_from_origin(graph, origin, dests, link_time=None, use_astar=False, max_speed=1.0):
+    if(len(set(dests)) < MIN_TREE_DESTINATIONS):
+        return [bidirectional_search(graph, origin, dest, link_time, use_astar, max_speed)[0]
+                for dest in dests]
+
+    (dist, pred, _) = shortest_path_tree(graph, origin, link_time, targets=dests)
+    link_origin = graph.link_origin
+    paths = []
+    for dest in dests:
+        if(dist[dest] == float('inf')):
+            paths.append(None)
+            continue
+        path = []
+        node = dest
+        while(node != origin):
+            link = int(pred[node])
+            path.append(link)
+            node = int(link_origin[link])
+        path.reverse()
+        paths.append(path)
+    return paths
+
+
+# Uses the predecessor links left by bidirectional_search() to build the path
+# Params:
+    # graph - an ArrayGraph
+    # center_node - the node where the best forward and backward paths meet
+    # forward_pred - maps nodes to the link that reached them from the origin
+    # backward_pred - maps nodes to the link that reached them from the destination
+# Returns:
+    # path - a list of link indices on the shortest path, in order
+def reconstruct_path(graph, center_node, forward_pred, backward_pred):
+    first_part = []
+    node = center_node
+    while(forward_pred[node] != -1):
+        link = forward_pred[node]
+        first_part.append(link)
+        node = int(graph.link_origin[link])
+
+    second_part = []
+    node = center_node
+    while(backward_pred[node] != -1):
+        link = backward_pred[node]
+        second_part.append(link)
+        node = int(graph.link_dest[link])
+
+    return list(reversed(first_part)) + second_part
+
+
+# Routes a chunk of trips, usually in a worker process.  The worker attaches to a
+# shared snapshot of the graph, so it only needs to receive the travel times and the
+# origin/destination node indices.
+# Params: Note that this is passed as a single tuple, for use with Pool.map()
+    # graph_fn - a snapshot file written by Map.get_shared_snapshot()
+    # link_time - the travel time of every link
+    # origins - node indices where the trips begin
+    # dests - node indices where the trips end
+    # use_astar - use the euclidean distance heuristic to guide the search
+    # max_speed - maximum speed on any link in the graph, used for the A* heuristic
+    # landmark_bounds - Landmarks.node_bounds for the ALT heuristic, or None
+# Returns:
+    # a list of paths, one per trip (see bidirectional_search())
+def route_chunk((graph_fn, link_time, origins, dests, use_astar, max_speed,
+                 landmark_bounds)):
+    graph = attach_graph(graph_fn)
+    paths = []
+    for i in xrange(len(origins)):
+        (path, _) = bidirectional_search(graph, origins[i], dests[i], link_time,
+                                         use_astar, max_speed, landmark_bounds)
+        paths.append(path)
+    return paths
+
+
+# Routes a chunk of origin groups in a worker process (see route_from_origin()).
+# Params: Note that this is passed as a single tuple, for use with Pool.map()
+    # graph_fn - a snapshot file written by Map.get_shared_snapshot()
+    # link_time - the travel time of every link
+    # groups - a list of (origin, dests) tuples of node indices
+    # use_astar, max_speed - see route_from_origin()
+# Returns:
+    # a list with one list of paths per group
+def route_origin_chunk((graph_fn, link_time, groups, use_astar, max_speed)):
+    graph = attach_graph(graph_fn)
+    return [route_from_origin(graph, origin, dests, link_time, use_astar, max_speed)
+            for (origin, dests) in groups]
@@ -2,6 +2,8 @@ from Node import *
 #from Map import Map
 #from Queue import PriorityQueue
 import heapq
+import threading
+from math import sqrt
 from random import randint
 from datetime import datetime
 import timeit
@@ -9,6 +11,94 @@ import timeit
 HEURISTIC_DISCOUNT = .75
 
 
+# The per-node state of a search (times, predecessor links and expansion flags), kept
+# in lists which are indexed by Node.node_index instead of on the Node objects.
+# Rather than resetting every node that a search touched, each search gets a new epoch.
+# An entry only counts if its stamp matches the current epoch - otherwise the node is
+# unvisited.  The lists are reused (and grown as needed) from one search to the next.
+class SearchState(object):
+
+    def __init__(self):
+        self.epoch = 0
+        self.stamp = []
+        self.forward_time = []
+        self.backward_time = []
+        self.forward_predecessor_link = []
+        self.backward_predecessor_link = []
+        self.was_forward_expanded = []
+        self.was_backward_expanded = []
+
+    # Makes room for more nodes
+    # Params:
+        # num_nodes - the number of entries needed (at least 1 + the largest node_index)
+    def grow(self, num_nodes):
+        if(len(self.stamp) < num_nodes):
+            extra = num_nodes - len(self.stamp)
+            self.stamp.extend([0] * extra)
+            self.forward_time.extend([float('Inf')] * extra)
+            self.backward_time.extend([float('Inf')] * extra)
+            self.forward_predecessor_link.extend([None] * extra)
+            self.backward_predecessor_link.extend([None] * extra)
+            self.was_forward_expanded.extend([False] * extra)
+            self.was_backward_expanded.extend([False] * extra)
+
+    # Starts a new search, which makes every node unvisited
+    # Params:
+        # num_nodes - the number of nodes the search is expected to touch
+    def new_search(self, num_nodes):
+        self.grow(num_nodes)
+        self.epoch += 1
+
+    # Makes sure that a node's entries belong to the current search.  Must be called
+    # before the entries of a node are read.
+    # Params:
+        # i - the node_index of the node
+    def visit(self, i):
+        if(i >= len(self.stamp)):
+            self.grow(i + 1)
+        if(self.stamp[i] != self.epoch):
+            self.stamp[i] = self.epoch
+            self.forward_time[i] = float('Inf')
+            self.backward_time[i] = float('Inf')
+            self.forward_predecessor_link[i] = None
+            self.backward_predecessor_link[i] = None
+            self.was_forward_expanded[i] = False
+            self.was_backward_expanded[i] = False
+
+
+# Owns all of the mutable state of the queries that run with it, so that queries with
+# different contexts never interfere.  A context can be reused for any number of
+# queries, but only for one query at a time - each thread should have its own (see
+# get_query_context()).
+# Attributes:
+    # state - the SearchState that the queries are kept in
+    # num_expanded - the number of nodes expanded by the last query
+class QueryContext(object):
+
+    def __init__(self):
+        self.state = SearchState()
+        self.num_expanded = 0
+
+
+# One QueryContext per thread, for queries that are not given a context
+_thread_contexts = threading.local()
+
+
+# Returns the QueryContext of the current thread (creating it if needed)
+def get_query_context():
+    if(not hasattr(_thread_contexts, "context")):
+        _thread_contexts.context = QueryContext()
+    return _thread_contexts.context
+
+
+# Returns the number of entries that a SearchState should start with (the lists are
+# grown later if a search reaches a node with a larger node_index)
+def get_num_nodes(curr_map, *nodes):
+    if(curr_map is not None):
+        return len(curr_map.nodes)
+    return max(node.node_index for node in nodes) + 1
+
+
 # Uses bidirectional search to find the shortest path between start_node and end_node
 # Params:
 # start_node - the node at the beginning of the path
@@ -16,6 +106,8 @@ HEURISTIC_DISCOUNT = .75
 # use_astar - use euclidean distance heuristic to guide the search using A*
 # use_arcflags - if arcflags are pre-computed on the links, search can be drastically improved
 # max_speed - maximum speed on any link in the graph. used for the A* heuristic
+# curr_map - the Map which the nodes belong to (used to size the search state)
+# context - the QueryContext to run the search in.  Uses the current thread's context if None
 # Returns:
 # path - a list of Links on the shortest path, in order, or None if no such path exists
 def bidirectional_search(
@@ -24,48 +116,52 @@ def bidirectional_search(
         use_astar=False,
         use_arcflags=False,
         max_speed=1.0,
-        curr_map=None):
+        curr_map=None,
+        context=None):
+    if(context is None):
+        context = get_query_context()
+
     # Step 1 - perform the actual dijkstra search
-    (center_node,
-     forward_pq,
-     forward_expanded,
-     backward_pq,
-     backward_expanded,
-     paths_expanded) = bidirectional_dijkstra(start_node,
-                                                 end_node,
-                                                 use_astar,
-                                                 use_arcflags,
-                                                 max_speed, 
-                                                 curr_map)
+    (center_node, paths_expanded) = bidirectional_dijkstra(start_node,
+                                                           end_node,
+                                                           use_astar,
+                                                           use_arcflags,
+                                                           max_speed,
+                                                           curr_map,
+                                                           context)
 
     if(center_node==None):
         return None
-    # Step 2 - reconstruct the path, using the pointers left on the node objects
-    path = reconstruct_path(center_node)
+    # Step 2 - reconstruct the path, using the pointers left in the search state
+    path = reconstruct_path(center_node, context)
 
     # create a text file for comparing edges explored to length of trip for performance reasons
     # if use_arcflags == True and use_astar == True:
     #     f = open("data.txt", 'a+')
     #     f.write(str(len(path)) + "\t" + str(paths_expanded) + "\n")
 
-    # Step 3 - clean up (reset pointers and time costs on node objects)
-    # Note that we only need to do this on nodes touched by the search
-    cleanup(forward_pq, forward_expanded, backward_pq, backward_expanded)
+    # No clean up is needed - the next search starts a new epoch
     return path
 
-# Helper method - you should probably call bidirectiona_search() instead, since that also cleans up after
-# Runs a forward and backward dijkstra algorithms, stopping when they meet.  Leaves pointers and partial
-# distances on the node objects touched by the search. These can be used to quickly construct the path by reconstruct_path()
+# Helper method - you should probably call bidirectional_search() instead, since that also builds the path
+# Runs a forward and backward dijkstra algorithms, until they have found the shortest path.  Leaves pointers
+# and partial distances in the SearchState. These can be used to quickly construct the path by reconstruct_path()
+# The best path seen so far (mu) is updated whenever an edge is relaxed to a node that the other search has
+# already reached.  The search stops once the smallest keys of the two queues add up to at least mu - no path
+# through an unexpanded node can be shorter, so mu is then the shortest path.
 # For more information about bidirectional A* search heuristics and stop criteria, see:
 # "A Fast Algorithm for Finding Better Routes by AI Search Techniques", Ikeda et al., 1994
+# "Computing the Shortest Path: A* Search Meets Graph Theory", Goldberg and Harrelson, 2005
 # Params:
     # start_node - the node at the beginning of the path
     # end_node - the node at the end of the path
     # use_astar - use euclidean distance heuristic to guide the search using A*
     # use_arcflags - if arcflags are pre-computed on the links, search can be drastically improved
     # max_speed - maximum speed on any link in the graph, used for the A* heuristic
+    # curr_map - the Map which the nodes belong to (used to size the search state)
+    # context - the QueryContext to run the search in
 # Returns:
-    # path - a list of Links on the shortest path, in order
+    # center_node - the node on the shortest path where the forward and backward searches met, or None
     # num_expanded - the number of nodes that were expanded during hte search
 
 
@@ -74,110 +170,135 @@ def bidirectional_dijkstra(
         end_node,
         use_astar=False,
         use_arcflags=False,
-        max_speed=1.0, curr_map=None):
-    
+        max_speed=1.0, curr_map=None, context=None):
+    if(context is None):
+        context = get_query_context()
+    state = context.state
+    state.new_search(get_num_nodes(curr_map, start_node, end_node))
+    visit = state.visit
+    forward_time = state.forward_time
+    backward_time = state.backward_time
+    forward_predecessor_link = state.forward_predecessor_link
+    backward_predecessor_link = state.backward_predecessor_link
+    was_forward_expanded = state.was_forward_expanded
+    was_backward_expanded = state.was_backward_expanded
+
+    # for bidirectional A*, we must consider both the forward cost and backward cost, in order to guarantee
+    # admissibility.  We take half of their difference as in
+    # "A Fast Algorithm for Finding Better Routes by AI Search Techniques", Ikeda et al., 1994
+    # The backward search uses the same potential with the opposite sign, which keeps the stopping rule exact
+    (start_x, start_y) = start_node.location
+    (end_x, end_y) = end_node.location
+    scale = HEURISTIC_DISCOUNT / (2 * max_speed)
+
+    def potential(node):
+        (x, y) = node.location
+        distance_difference = (sqrt((x - end_x) ** 2 + (y - end_y) ** 2) -
+                               sqrt((x - start_x) ** 2 + (y - start_y) ** 2))
+        return distance_difference * scale
+
+    # With arc flags, each search only follows links which are flagged for the region at
+    # the other end.  Checking a flag is one byte lookup and mask (see PackedArcFlags).
+    if(use_arcflags):
+        if(curr_map is None or curr_map.arc_flags is None):
+            raise Exception("Arc flags have not been computed for this map.")
+        (forward_flags, forward_mask) = curr_map.arc_flags.get_column(end_node.region_id)
+        (backward_flags, backward_mask) = curr_map.arc_flags.get_column(start_node.region_id,
+                                                                        backward=True)
+
     # Initialize the priority queue for the forward search from the origin
     forward_pq = []
-    start_node.forward_time = 0
-    #forward_pq.put((0, None, start_node))
-    heapq.heappush(forward_pq, (0,None,start_node))    
-    forward_expanded = []
+    visit(start_node.node_index)
+    forward_time[start_node.node_index] = 0
+    heapq.heappush(forward_pq, (potential(start_node) if use_astar else 0, None, start_node))
+    num_forward_expanded = 0
 
     # Initialize the priority queue for the backward search from the destination
     backward_pq = []
-    end_node.backward_time = 0
-    heapq.heappush(backward_pq, (0, None, end_node))
-    backward_expanded = []
+    visit(end_node.node_index)
+    backward_time[end_node.node_index] = 0
+    heapq.heappush(backward_pq, (-potential(end_node) if use_astar else 0, None, end_node))
+    num_backward_expanded = 0
 
     best_full_time = float('inf')
     center_node = None
+    if(start_node == end_node):
+        best_full_time = 0
+        center_node = start_node
 
-    # The main loop alternates between forward and backward expansions
+    # The main loop expands whichever search has the smaller key
     while(len(forward_pq)>0 and len(backward_pq)>0):
-
-        #### FORWARD EXPANSION ####
-        (cost, link, node) = heapq.heappop(forward_pq)
-        forward_expanded.append(node)
-        node.was_forward_expanded = True
-
-        # If this node has been touched by both searches, it is potentially the center node
-        # The center node is the node which has the shortest total distance to
-        # the origin and destination
-        if(node.backward_time + node.forward_time < best_full_time):
-            best_full_time = node.backward_time + node.forward_time
-            center_node = node
-
-        # If this node was already expanded by the backward search, then the two
-        # searches have met each other - we are done
-        if(node.was_backward_expanded):
+        # No path through an unexpanded node can beat the best one found so far
+        if(forward_pq[0][0] + backward_pq[0][0] >= best_full_time):
             break
 
-        # propagate to neighboring nodes
-        for link in node.forward_links:
-            # Proposed time of reaching this neighbor via this node
-            if use_arcflags == True:
-                if link.forward_arc_flags_vector[end_node.region_id] == 0:
+        if(forward_pq[0][0] <= backward_pq[0][0]):
+            #### FORWARD EXPANSION ####
+            (cost, link, node) = heapq.heappop(forward_pq)
+            i = node.node_index
+            # Skip stale queue entries, left over from earlier relaxations of this node
+            if(was_forward_expanded[i]):
+                continue
+            num_forward_expanded += 1
+            was_forward_expanded[i] = True
+
+            # propagate to neighboring nodes
+            for link in node.forward_links:
+                # Proposed time of reaching this neighbor via this node
+                if(use_arcflags and not forward_flags[link.link_id] & forward_mask):
                     continue
 
-            proposed_cost = node.forward_time + link.time
-
-            # If this is better than the current path, then make the update and
-            # add that neighbor to the PQ
-            if(proposed_cost < link.connecting_node.forward_time):
-                link.connecting_node.forward_time = proposed_cost
-                link.connecting_node.forward_predecessor_link = link
-
-                # If we are using A*, then the priority is modified with a
-                # heuristic function
-                if(use_astar):
-                    # for bidirectional search, we must consider both the forward cost and backward cost, in order to guarantee admissibility
-                    # We take half of their difference as in
-                    # "A Fast Algorithm for Finding Better Routes by AI Search Techniques", Ikeda et al., 1994
-                    distance_difference = end_node.approx_dist_to(
-                        link.connecting_node) - start_node.approx_dist_to(link.connecting_node)
-                    proposed_cost += (distance_difference / 
-                                      max_speed) * (HEURISTIC_DISCOUNT / 2)
-                heapq.heappush(forward_pq, (proposed_cost, link, link.connecting_node))
-
-        #### BACKWARD EXPANSION ####
-        (cost, link, node) = heapq.heappop(backward_pq)
-        backward_expanded.append(node)
-        node.was_backward_expanded = True
-
-        # If this node has been touched by both searches, it is potentially the center node
-        # The center node is the node which has the shortest total distance to
-        # the origin and destination
-        if(node.backward_time + node.forward_time < best_full_time):
-            best_full_time = node.backward_time + node.forward_time
-            center_node = node
-
-        # If this node was already expanded by the forward search, then the two searches have met
-        # We are done
-        if(node.was_forward_expanded):
-            break
-
-        # propagate to neighboring nodes
-        for link in node.backward_links:
-            # Proposed time of reaching this neighbor via this node
-            if use_arcflags == True:
-                if link.backward_arc_flags_vector[start_node.region_id] == 0:
+                proposed_cost = forward_time[i] + link.time
+
+                # If this is better than the current path, then make the update and
+                # add that neighbor to the PQ
+                j = link.connecting_node.node_index
+                visit(j)
+                if(proposed_cost < forward_time[j]):
+                    forward_time[j] = proposed_cost
+                    forward_predecessor_link[j] = link
+                    key = proposed_cost
+                    if(use_astar):
+                        key += potential(link.connecting_node)
+                    heapq.heappush(forward_pq, (key, link, link.connecting_node))
+
+                    # If the backward search has reached this neighbor, this is a complete path
+                    if(proposed_cost + backward_time[j] < best_full_time):
+                        best_full_time = proposed_cost + backward_time[j]
+                        center_node = link.connecting_node
+        else:
+            #### BACKWARD EXPANSION ####
+            (cost, link, node) = heapq.heappop(backward_pq)
+            i = node.node_index
+            # Skip stale queue entries, left over from earlier relaxations of this node
+            if(was_backward_expanded[i]):
+                continue
+            num_backward_expanded += 1
+            was_backward_expanded[i] = True
+
+            # propagate to neighboring nodes
+            for link in node.backward_links:
+                # Proposed time of reaching this neighbor via this node
+                if(use_arcflags and not backward_flags[link.link_id] & backward_mask):
                     continue
-            proposed_cost = node.backward_time + link.time
-
-            # If this is better than the current path, then make the update and
-            # add that neighbor to the PQ
-            if(proposed_cost < link.origin_node.backward_time):
-                link.origin_node.backward_time = proposed_cost
-                link.origin_node.backward_predecessor_link = link
-
-                # If we are using A*, then the priority is modified with a
-                # heuristic function
-                if(use_astar):
-                    distance_difference = start_node.approx_dist_to(
-                        link.origin_node) - end_node.approx_dist_to(link.origin_node)
-                    proposed_cost += (distance_difference / 
-                                      max_speed) * (HEURISTIC_DISCOUNT / 2)
-                heapq.heappush(backward_pq, (proposed_cost, link, link.origin_node))
+                proposed_cost = backward_time[i] + link.time
+
+                # If this is better than the current path, then make the update and
+                # add that neighbor to the PQ
+                j = link.origin_node.node_index
+                visit(j)
+                if(proposed_cost < backward_time[j]):
+                    backward_time[j] = proposed_cost
+                    backward_predecessor_link[j] = link
+                    key = proposed_cost
+                    if(use_astar):
+                        key -= potential(link.origin_node)
+                    heapq.heappush(backward_pq, (key, link, link.origin_node))
+
+                    # If the forward search has reached this neighbor, this is a complete path
+                    if(proposed_cost + forward_time[j] < best_full_time):
+                        best_full_time = proposed_cost + forward_time[j]
+                        center_node = link.origin_node
 
     if(center_node is None):
         # path = bidirectional_search(start_node, end_node)
@@ -192,7 +313,7 @@ def bidirectional_dijkstra(
 
         # pace_dict = {}
         # for link in curr_map.links:
-        #     if link.forward_arc_flags_vector[end_node.region_id] == True:
+        #     if curr_map.arc_flags.get_flag(link.link_id, end_node.region_id):
         #         pace_dict[(link.origin_node_id, link.connecting_node_id)]= 5
         #     else:
         #         pace_dict[(link.origin_node_id, link.connecting_node_id)]= -5
@@ -202,7 +323,7 @@ def bidirectional_dijkstra(
 
         # pace_dict = {}
         # for link in curr_map.links:
-        #     if link.forward_arc_flags_vector[origin_node.region_id] == True:
+        #     if curr_map.arc_flags.get_flag(link.link_id, start_node.region_id, backward=True):
         #         pace_dict[(link.origin_node_id, link.connecting_node_id)]= 5
         #     else:
         #         pace_dict[(link.origin_node_id, link.connecting_node_id)]= -5
@@ -211,22 +332,21 @@ def bidirectional_dijkstra(
 
         print("Bidirectional search has failed.")
 
-    return (
-        center_node,
-        forward_pq,
-        forward_expanded,
-        backward_pq,
-        backward_expanded,
-        len(forward_expanded) + len(backward_expanded))
+    context.num_expanded = num_forward_expanded + num_backward_expanded
+    return center_node, context.num_expanded
 
 # Uses the output from bidirectional_dijkstra() to reconstruct the shortest path
 # Params:
     # center_node - the node where the forward and backward searches met - output by bidirectional_dijkstra()
+    # context - the QueryContext that the search was run in
 # Returns:
     # path - a list of Links on the shortest path, in order
 
 
-def reconstruct_path(center_node):
+def reconstruct_path(center_node, context=None):
+    if(context is None):
+        context = get_query_context()
+    state = context.state
     # At this point, the forward search and backward search have met at center_node
     # The path consists of two parts
     # 1) The links leading from the center_node to the origin, which must be reversed
@@ -236,37 +356,20 @@ def reconstruct_path(center_node):
     # Reconstruct first part of the path
     first_part = []
     node = center_node
-    while(node.forward_predecessor_link is not None):
-        first_part.append(node.forward_predecessor_link)
-        node = node.forward_predecessor_link.origin_node
+    while(state.forward_predecessor_link[node.node_index] is not None):
+        first_part.append(state.forward_predecessor_link[node.node_index])
+        node = state.forward_predecessor_link[node.node_index].origin_node
 
     # Reconstruct second part of the path
     second_part = []
     node = center_node
-    while(node.backward_predecessor_link is not None):
-        second_part.append(node.backward_predecessor_link)
-        node = node.backward_predecessor_link.connecting_node
+    while(state.backward_predecessor_link[node.node_index] is not None):
+        second_part.append(state.backward_predecessor_link[node.node_index])
+        node = state.backward_predecessor_link[node.node_index].connecting_node
 
     # Reverse the first part and combine
     return list(reversed(first_part)) + second_part
 
-# Cleans up the mess made by bidirectional_dijkstra()
-# It resets the pointers and time costs on node objects which were touched by the search
-# The four inputs come directly from the outputs of bidirectional_dijkstra
-# Collectively, they represent all of the nodes that were touched by the search
-
-
-def cleanup(forward_pq, forward_expanded, backward_pq, backward_expanded):
-    for node_pq in [forward_pq, backward_pq]:
-        if(node_pq is not None):
-            for (priority, link, node) in node_pq:
-                node.reset()
-
-    for node_list in [forward_expanded, backward_expanded]:
-        if(node_list is not None):
-            for node in node_list:
-                node.reset()
-
 
 # A simple one-directional Dijkstra search from start_node to end_node
 # Slower than the bidirectional search, this is mostly needed for testing purposes
@@ -276,6 +379,8 @@ def cleanup(forward_pq, forward_expanded, backward_pq, backward_expanded):
     # use_astar - use euclidean distance heuristic to guide the search using A*
     # use_arcflags - if arcflags are pre-computed on the links, search can be drastically improved
     # max_speed - maximum speed on any link in the graph. used for the A* heuristic
+    # curr_map - the Map which the nodes belong to (used to size the search state)
+    # context - the QueryContext to run the search in.  Uses the current thread's context if None
 # Returns:
     # path - a list of Links on the shortest path, in order
 def simple_dijkstra(
@@ -283,51 +388,71 @@ def simple_dijkstra(
         end_node,
         use_astar=False,
         use_arcflags=False,
-        max_speed=1.0):
+        max_speed=1.0,
+        curr_map=None,
+        context=None):
+    if(context is None):
+        context = get_query_context()
+    state = context.state
+    state.new_search(get_num_nodes(curr_map, start_node, end_node))
+    visit = state.visit
+    forward_time = state.forward_time
+
     # Initialize the priority queue for the forward search from the origin
-    forward_pq = PriorityQueue()
-    start_node.forward_time = 0
-    forward_pq.put((0, start_node))
-    forward_expanded = []
+    forward_pq = []
+    visit(start_node.node_index)
+    forward_time[start_node.node_index] = 0
+    heapq.heappush(forward_pq, (0, start_node))
+
+    num_expanded = 0
 
-    # The main loop alternates between forward and backward expansions
-    while(not forward_pq.empty()):
+    # The main loop expands one node at a time
+    while(len(forward_pq) > 0):
 
         # FORWARD EXPANSION
-        (cost, node) = forward_pq.get()
-        forward_expanded.append(node)
-        # If this node has already been expanded by the backward search, then we
-        # have met in the middle - we are done
+        (cost, node) = heapq.heappop(forward_pq)
+        # Skip stale queue entries, left over from earlier relaxations of this node
+        if(state.was_forward_expanded[node.node_index]):
+            continue
+        state.was_forward_expanded[node.node_index] = True
+        num_expanded += 1
+        # Once the destination is expanded, its path is final - we are done
         if(node == end_node):
             break
 
         # propagate to neighboring nodes
         for link in node.forward_links:
             # Proposed time of reaching this neighbor via this node
-            proposed_cost = node.forward_time + link.time
+            proposed_cost = forward_time[node.node_index] + link.time
 
             # If this is better than the current path, then make the update and
             # add that neighbor to the PQ
-            if(proposed_cost < link.connecting_node.forward_time):
-                link.connecting_node.forward_time = proposed_cost
-                link.connecting_node.forward_predecessor_link = link
+            j = link.connecting_node.node_index
+            visit(j)
+            if(proposed_cost < forward_time[j]):
+                forward_time[j] = proposed_cost
+                state.forward_predecessor_link[j] = link
 
                 if(use_astar):
                     proposed_cost += (
                         end_node.approx_dist_to(
                             link.connecting_node) / max_speed) * HEURISTIC_DISCOUNT
 
-                forward_pq.put((proposed_cost, link.connecting_node))
+                heapq.heappush(forward_pq, (proposed_cost, link.connecting_node))
+
+    context.num_expanded = num_expanded
+
+    # If the end node was never reached, there is no path (as in bidirectional_search)
+    visit(end_node.node_index)
+    if(not state.was_forward_expanded[end_node.node_index]):
+        return None
 
     # Reconstruct the path up to the end node, using the
     # forward_predecessor_links
-    path = reconstruct_path(end_node)
-
-    cleanup(forward_pq, forward_expanded, None, None)
+    path = reconstruct_path(end_node, context)
 
     return path
 
-
 ###################### TESTING CODE ###################################
 
 # choose a random node on the map
@@ -518,6 +643,64 @@ def test_specific_paths():
         print
         print
 
+# Checks the bidirectional searches against simple_dijkstra() on random pairs of nodes.
+# The travel times of the paths must match exactly (the paths themselves may differ
+# when there are ties).
+# Params:
+    # road_map - a Map
+    # num_trials - the number of random queries
+# Returns:
+    # the number of queries where a bidirectional search found a longer path, or
+    # disagreed with simple_dijkstra() about whether there is a path at all
+def test_against_simple_dijkstra(road_map, num_trials=100):
+    max_speed = road_map.get_max_speed()
+    num_mistakes = 0
+    for trial in range(num_trials):
+        orig = road_map.nodes[randint(0, len(road_map.nodes) - 1)]
+        dest = road_map.nodes[randint(0, len(road_map.nodes) - 1)]
+        correct_path = simple_dijkstra(orig, dest, curr_map=road_map)
+        for use_astar in [False, True]:
+            path = bidirectional_search(orig, dest, use_astar=use_astar, max_speed=max_speed,
+                                        curr_map=road_map)
+            # Unreachable destinations must be unreachable for both searches
+            if(path is None or correct_path is None):
+                if(path is not correct_path):
+                    num_mistakes += 1
+                    print (orig.node_id, dest.node_id, use_astar, path is None)
+                continue
+            correct_time = sum(link.time for link in correct_path)
+            if(abs(sum(link.time for link in path) - correct_time) > 1e-6):
+                num_mistakes += 1
+                print (orig.node_id, dest.node_id, use_astar)
+                compare_paths(correct_path, path)
+    print "num mistakes = " + str(num_mistakes)
+    return num_mistakes
+
+
+# Measures the work per query (expanded nodes and time) of each search algorithm, on
+# the same random pairs of nodes
+# Params:
+    # road_map - a Map
+    # num_trials - the number of random queries
+def benchmark_expansions(road_map, num_trials=100):
+    max_speed = road_map.get_max_speed()
+    od_list = [(road_map.nodes[randint(0, len(road_map.nodes) - 1)],
+                road_map.nodes[randint(0, len(road_map.nodes) - 1)])
+               for trial in range(num_trials)]
+    context = get_query_context()
+    for (name, search, use_astar) in [("Dijkstra        ", simple_dijkstra, False),
+                                      ("Bidirectional   ", bidirectional_search, False),
+                                      ("Bidirectional A*", bidirectional_search, True)]:
+        num_expanded = 0
+        t1 = datetime.now()
+        for (orig, dest) in od_list:
+            search(orig, dest, use_astar=use_astar, max_speed=max_speed, curr_map=road_map)
+            num_expanded += context.num_expanded
+        t2 = datetime.now()
+        print(name + " : " + str(float(num_expanded) / num_trials) + " expanded / query, " +
+              str((t2 - t1) / num_trials) + " / query")
+
+
 # Given a list of (origin,destination) pairs, runs all of the shortest path queries
 # use_bidirectional and use_astar control which algorithm will be used
 
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+Contraction Hierarchies (CH) for fast shortest path queries on an ArrayGraph.
+
+Preprocessing contracts the nodes one at a time, in order of importance.  When a
+node v is contracted, a shortcut u->w is added for each pair of neighbors whose
+shortest path goes through v (u->v->w), unless a witness search finds a path that
+is at least as short without v.  The rank of a node is its position in this order.
+
+A query is a bidirectional Dijkstra search which only follows edges towards
+higher-ranked nodes - the forward search from the origin and the backward search
+from the destination meet at the highest node of the shortest path.  Shortcuts on
+the resulting path are then unpacked back into the original links.
+
+For more information, see:
+"Contraction Hierarchies: Faster and Simpler Hierarchical Routing in Road Networks",
+Geisberger et al., 2008
+
+The hierarchy is built for one set of link travel times.  If the times change, it
+must be rebuilt (see Map.get_contraction_hierarchy()).
+"""
+import heapq
+import numpy as np
+
+# Limits on the witness searches.  Smaller limits make preprocessing faster, but
+# may add unnecessary shortcuts.  The queries are exact either way.
+WITNESS_MAX_SETTLED = 100
+
+
+# A Contraction Hierarchy, built from an ArrayGraph and a vector of travel times.
+# Edges 0 ... num_links-1 are the original links of the graph, and the remaining
+# edges are shortcuts.  Shortcut e stands for the two edges edge_child1[e] and
+# edge_child2[e], in that order.
+class ContractionHierarchy(object):
+
+    # Params:
+        # graph - an ArrayGraph
+        # link_time - the travel time of every link.  Uses graph.link_time if None
+    def __init__(self, graph, link_time=None):
+        if(link_time is None):
+            link_time = graph.link_time
+        self.num_nodes = graph.num_nodes
+        self.num_links = graph.num_links
+        self.link_time = np.array(link_time, dtype=np.float64)
+
+        self.edge_weight = self.link_time.tolist()
+        self.edge_tail = graph.link_origin.tolist()
+        self.edge_head = graph.link_dest.tolist()
+        self.edge_child1 = [-1] * self.num_links
+        self.edge_child2 = [-1] * self.num_links
+
+        self.contract_nodes()
+
+    # Adds an edge to the list of edges
+    # Returns:
+        # the id of the new edge
+    def add_edge(self, tail, head, weight, child1, child2):
+        self.edge_tail.append(tail)
+        self.edge_head.append(head)
+        self.edge_weight.append(weight)
+        self.edge_child1.append(child1)
+        self.edge_child2.append(child2)
+        return len(self.edge_weight) - 1
+
+    # A Dijkstra search from source, which ignores the node being contracted.
+    # Stops once all of the targets are settled, max_time is exceeded, or
+    # WITNESS_MAX_SETTLED nodes are settled.
+    # Params:
+        # out_edges - the remaining graph (see contract_nodes())
+        # source - where the search begins
+        # ignore - the node being contracted
+        # targets - the nodes whose distances are needed
+        # max_time - the longest distance that is interesting
+    # Returns:
+        # a dictionary of (upper bounds on) distances from source
+    @staticmethod
+    def witness_search(out_edges, source, ignore, targets, max_time):
+        dist = {source: 0.0}
+        pq = [(0.0, source)]
+        num_settled = 0
+        targets_left = len(targets)
+        while(len(pq) > 0):
+            (time, node) = heapq.heappop(pq)
+            if(time > dist[node]):
+                continue
+            if(time > max_time or num_settled >= WITNESS_MAX_SETTLED):
+                break
+            num_settled += 1
+            if(node in targets):
+                targets_left -= 1
+                if(targets_left == 0):
+                    break
+            for (neighbor, (_, edge_time)) in out_edges[node].iteritems():
+                if(neighbor == ignore):
+                    continue
+                proposed_time = time + edge_time
+                if(proposed_time < dist.get(neighbor, float('inf'))):
+                    dist[neighbor] = proposed_time
+                    heapq.heappush(pq, (proposed_time, neighbor))
+        return dist
+
+    # Finds the shortcuts which are needed to contract a node
+    # Params:
+        # out_edges, in_edges - the remaining graph (see contract_nodes())
+        # node - the node to contract
+    # Returns:
+        # a list of (tail, head, weight, in_edge, out_edge)
+    def find_shortcuts(self, out_edges, in_edges, node):
+        shortcuts = []
+        outgoing = out_edges[node]
+        if(len(outgoing) == 0):
+            return shortcuts
+        max_out = max(time for (_, time) in outgoing.itervalues())
+        for (tail, (in_edge, in_time)) in in_edges[node].iteritems():
+            dist = ContractionHierarchy.witness_search(out_edges, tail, node, outgoing,
+                                                       in_time + max_out)
+            for (head, (out_edge, out_time)) in outgoing.iteritems():
+                if(head == tail):
+                    continue
+                time = in_time + out_time
+                if(dist.get(head, float('inf')) > time):
+                    shortcuts.append((tail, head, time, in_edge, out_edge))
+        return shortcuts
+
+    # Computes the priority of a node - nodes with a low priority are contracted first.
+    # Uses the edge difference (shortcuts added minus edges removed, with shortcuts
+    # counted twice) plus the number of neighbors that have already been contracted,
+    # which spreads the contraction out.
+    # Params:
+        # shortcuts - the output of find_shortcuts() for this node
+    @staticmethod
+    def get_priority(out_edges, in_edges, deleted_neighbors, node, shortcuts):
+        num_removed = len(out_edges[node]) + len(in_edges[node])
+        return 2 * len(shortcuts) - num_removed + deleted_neighbors[node]
+
+    # Contracts all of the nodes, and builds the upward graphs used by queries.
+    # The remaining graph is kept in two lists of dictionaries:
+        # out_edges[u][w] = (edge, time) for the fastest edge from u to w
+        # in_edges[w][u] = (edge, time) for the same edge
+    def contract_nodes(self):
+        n = self.num_nodes
+        out_edges = [{} for _ in xrange(n)]
+        in_edges = [{} for _ in xrange(n)]
+        for edge in xrange(self.num_links):
+            tail = self.edge_tail[edge]
+            head = self.edge_head[edge]
+            time = self.edge_weight[edge]
+            if(tail != head and time < out_edges[tail].get(head, (-1, float('inf')))[1]):
+                out_edges[tail][head] = (edge, time)
+                in_edges[head][tail] = (edge, time)
+
+        deleted_neighbors = [0] * n
+        pq = [(ContractionHierarchy.get_priority(out_edges, in_edges, deleted_neighbors, node,
+                                                 self.find_shortcuts(out_edges, in_edges, node)),
+               node) for node in xrange(n)]
+        heapq.heapify(pq)
+
+        self.rank = [-1] * n
+        up_forward = [None] * n
+        up_backward = [None] * n
+        next_rank = 0
+        while(len(pq) > 0):
+            (priority, node) = heapq.heappop(pq)
+
+            # Lazy update - the priority may be out of date
+            shortcuts = self.find_shortcuts(out_edges, in_edges, node)
+            new_priority = ContractionHierarchy.get_priority(out_edges, in_edges,
+                                                             deleted_neighbors, node, shortcuts)
+            if(len(pq) > 0 and new_priority > pq[0][0]):
+                heapq.heappush(pq, (new_priority, node))
+                continue
+
+            # Add the shortcuts (or improve existing edges)
+            for (tail, head, time, in_edge, out_edge) in shortcuts:
+                if(time < out_edges[tail].get(head, (-1, float('inf')))[1]):
+                    edge = self.add_edge(tail, head, time, in_edge, out_edge)
+                    out_edges[tail][head] = (edge, time)
+                    in_edges[head][tail] = (edge, time)
+
+            # All of the remaining neighbors are ranked higher than this node, so its
+            # remaining edges are exactly its upward edges
+            self.rank[node] = next_rank
+            next_rank += 1
+            up_forward[node] = [(head, edge) for (head, (edge, _)) in out_edges[node].iteritems()]
+            up_backward[node] = [(tail, edge) for (tail, (edge, _)) in in_edges[node].iteritems()]
+
+            # Remove the node from the remaining graph
+            for (head, _) in up_forward[node]:
+                del in_edges[head][node]
+                deleted_neighbors[head] += 1
+            for (tail, _) in up_backward[node]:
+                del out_edges[tail][node]
+                deleted_neighbors[tail] += 1
+            out_edges[node] = {}
+            in_edges[node] = {}
+
+        self.up_forward = up_forward
+        self.up_backward = up_backward
+        self.num_shortcuts = len(self.edge_weight) - self.num_links
+
+    # Finds the shortest path between two nodes with a bidirectional upward search.
+    # Each search stops once its smallest key is at least the best path found so far.
+    # Params:
+        # origin - the node index at the beginning of the path
+        # dest - the node index at the end of the path
+    # Returns:
+        # path - a list of link indices on the shortest path, in order, or None if no
+            # such path exists
+        # num_expanded - the number of nodes that were expanded during the search
+    def find_path(self, origin, dest):
+        edge_weight = self.edge_weight
+        dists = ({origin: 0.0}, {dest: 0.0})
+        preds = ({origin: -1}, {dest: -1})
+        pqs = ([(0.0, origin)], [(0.0, dest)])
+        up_edges = (self.up_forward, self.up_backward)
+
+        best_time = float('inf')
+        center_node = -1
+        if(origin == dest):
+            best_time = 0.0
+            center_node = origin
+
+        num_expanded = 0
+        while(True):
+            # Expand the search whose next node is closer, unless it can no longer
+            # improve the best path
+            side = -1
+            top = best_time
+            for i in (0, 1):
+                if(len(pqs[i]) > 0 and pqs[i][0][0] < top):
+                    side = i
+                    top = pqs[i][0][0]
+            if(side == -1):
+                break
+
+            (time, node) = heapq.heappop(pqs[side])
+            dist = dists[side]
+            if(time > dist[node]):
+                continue
+            num_expanded += 1
+            other_dist = dists[1 - side]
+            pred = preds[side]
+            for (neighbor, edge) in up_edges[side][node]:
+                proposed_time = time + edge_weight[edge]
+                if(proposed_time < dist.get(neighbor, float('inf'))):
+                    dist[neighbor] = proposed_time
+                    pred[neighbor] = edge
+                    heapq.heappush(pqs[side], (proposed_time, neighbor))
+                    if(neighbor in other_dist and
+                            proposed_time + other_dist[neighbor] < best_time):
+                        best_time = proposed_time + other_dist[neighbor]
+                        center_node = neighbor
+
+        if(center_node == -1):
+            return None, num_expanded
+
+        # Collect the edges of the path, then unpack the shortcuts
+        edges = []
+        node = center_node
+        while(preds[0][node] != -1):
+            edge = preds[0][node]
+            edges.append(edge)
+            node = self.edge_tail[edge]
+        edges.reverse()
+        node = center_node
+        while(preds[1][node] != -1):
+            edge = preds[1][node]
+            edges.append(edge)
+            node = self.edge_head[edge]
+
+        return self.unpack_edges(edges), num_expanded
+
+    # A complete upward search from one node, which finds the distances to (or from)
+    # every node in its upward search space.  Used by bucket_many_to_many().
+    # Params:
+        # node - the node index where the search begins
+        # backward - search the incoming upward edges, which finds the travel times to node
+    # Returns:
+        # a dictionary from node index to travel time
+    def upward_search(self, node, backward=False):
+        edge_weight = self.edge_weight
+        if(backward):
+            up_edges = self.up_backward
+        else:
+            up_edges = self.up_forward
+        dist = {node: 0.0}
+        pq = [(0.0, node)]
+        while(len(pq) > 0):
+            (time, node) = heapq.heappop(pq)
+            if(time > dist[node]):
+                continue
+            for (neighbor, edge) in up_edges[node]:
+                proposed_time = time + edge_weight[edge]
+                if(proposed_time < dist.get(neighbor, float('inf'))):
+                    dist[neighbor] = proposed_time
+                    heapq.heappush(pq, (proposed_time, neighbor))
+        return dist
+
+    # Replaces shortcuts with the original links that they represent
+    # Params:
+        # edges - a list of edge ids, in order
+    # Returns:
+        # a list of link indices, in order
+    def unpack_edges(self, edges):
+        path = []
+        stack = list(reversed(edges))
+        while(len(stack) > 0):
+            edge = stack.pop()
+            if(edge < self.num_links):
+                path.append(edge)
+            else:
+                stack.append(self.edge_child2[edge])
+                stack.append(self.edge_child1[edge])
+        return path
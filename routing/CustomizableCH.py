@@ -0,0 +1,438 @@
+# -*- coding: utf-8 -*-
+"""
+Customizable Contraction Hierarchies (CCH), which stay fast when the link travel
+times change.  Preprocessing is split into two phases:
+
+1) A metric-independent phase, which only looks at the road geometry.  The nodes
+   are ordered by nested dissection (recursive coordinate bisection with small
+   separators), and then contracted in that order without any witness searches.
+   Every pair of higher-ranked neighbors of a contracted node gets an arc, so the
+   arcs do not depend on the travel times.  The lower triangles of each arc are
+   also saved.
+2) A customization phase, which computes the weights of all arcs for a vector of
+   link travel times.  It only needs a few vectorized passes over the triangles,
+   so it can be repeated every time the travel times are updated.
+
+Queries are bidirectional upward searches, like in a ContractionHierarchy.
+
+For more information, see:
+"Customizable Contraction Hierarchies", Dibbelt, Strasser, and Wagner, 2014
+"""
+import heapq
+import numpy as np
+
+# Node sets which are at most this big are not split any further
+DISSECTION_LEAF_SIZE = 16
+
+
+# Computes a nested dissection order of the nodes.  Each set of nodes is split in two
+# at the median of its wider coordinate.  The endpoints of the edges which cross the
+# split (on the smaller side) form a separator, which is ordered after both halves.
+# Params:
+    # x, y - node coordinates in meters
+    # edge_a, edge_b - the endpoints of every (undirected) edge
+# Returns:
+    # order - an array of node indices, from least to most important
+def nested_dissection_order(x, y, edge_a, edge_b):
+    n = len(x)
+    side = np.zeros(n, dtype=np.int8)
+    order = []
+
+    # Params:
+        # nodes - an array of node indices
+        # a, b - the edges whose endpoints are both in nodes
+    def dissect(nodes, a, b):
+        if(len(nodes) <= DISSECTION_LEAF_SIZE):
+            order.extend(nodes.tolist())
+            return
+        if(np.ptp(x[nodes]) >= np.ptp(y[nodes])):
+            coords = x[nodes]
+        else:
+            coords = y[nodes]
+        median = np.median(coords)
+        left = coords <= median
+        if(left.all() or not left.any()):
+            # All of the coordinates are the same - split by position instead
+            left = np.arange(len(nodes)) < len(nodes) // 2
+
+        side[nodes[left]] = 0
+        side[nodes[~left]] = 1
+        crossing = side[a] != side[b]
+        left_ends = np.unique(np.where(side[a[crossing]] == 0, a[crossing], b[crossing]))
+        right_ends = np.unique(np.where(side[a[crossing]] == 1, a[crossing], b[crossing]))
+        if(len(left_ends) <= len(right_ends)):
+            separator = left_ends
+        else:
+            separator = right_ends
+
+        # Separator nodes are removed from both halves.  The recursion reuses side[],
+        # so both halves are found before recursing
+        side[separator] = 2
+        parts = []
+        for part in (0, 1):
+            keep = (side[a] == part) & (side[b] == part)
+            parts.append((nodes[side[nodes] == part], a[keep], b[keep]))
+        for (part_nodes, part_a, part_b) in parts:
+            dissect(part_nodes, part_a, part_b)
+        order.extend(separator.tolist())
+
+    dissect(np.arange(n), np.asarray(edge_a), np.asarray(edge_b))
+    return np.array(order, dtype=np.int64)
+
+
+# A Customizable Contraction Hierarchy for an ArrayGraph.  Every arc connects a low
+# node to a higher-ranked node, and has two weights:
+    # arc_up - the travel time from arc_low to arc_high
+    # arc_down - the travel time from arc_high to arc_low
+# The lower triangles of the arcs are stored as pairs of arc ids - tri_low_arc and
+# tri_high_arc connect the bottom node of the triangle to the lower and higher of its
+# two other nodes.  The triangles are sorted by level, and then grouped by the arc
+# between the two other nodes (group_top).
+class CustomizableCH(object):
+
+    # Performs the metric-independent preprocessing.  Call customize() before querying.
+    # Params:
+        # graph - an ArrayGraph
+    def __init__(self, graph):
+        self.graph = graph
+        self.num_nodes = n = graph.num_nodes
+
+        # Order the nodes by nested dissection
+        (x, y) = graph.get_node_locations()
+        order = nested_dissection_order(x, y, graph.link_origin, graph.link_dest)
+        self.rank = np.empty(n, dtype=np.int64)
+        self.rank[order] = np.arange(n)
+        rank = self.rank.tolist()
+
+        # Contract the nodes in order, without witness searches.  upper[v] ends up as
+        # the set of all higher-ranked neighbors of v
+        upper = [set() for _ in xrange(n)]
+        for (a, b) in zip(graph.link_origin.tolist(), graph.link_dest.tolist()):
+            if(a != b):
+                if(rank[a] < rank[b]):
+                    upper[a].add(b)
+                else:
+                    upper[b].add(a)
+        for v in order.tolist():
+            neighbors = sorted(upper[v], key=rank.__getitem__)
+            for i in xrange(len(neighbors)):
+                upper[neighbors[i]].update(neighbors[i + 1:])
+
+        # Index the arcs, sorted by (low node, rank of high node)
+        arc_low = []
+        arc_high = []
+        for v in xrange(n):
+            neighbors = sorted(upper[v], key=rank.__getitem__)
+            arc_low.extend([v] * len(neighbors))
+            arc_high.extend(neighbors)
+        self.arc_low = np.array(arc_low, dtype=np.int64)
+        self.arc_high = np.array(arc_high, dtype=np.int64)
+        self.num_arcs = len(arc_low)
+        self.arc_offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.arc_low, minlength=n), out=self.arc_offsets[1:])
+        arc_keys = self.arc_low * n + self.arc_high
+        self.arc_key_order = np.argsort(arc_keys)
+        self.sorted_arc_keys = arc_keys[self.arc_key_order]
+
+        # The level of a node is the height of its subtree in the elimination tree.
+        # Triangles with a bottom node on a lower level are customized first
+        level = [0] * n
+        for v in order.tolist():
+            for u in upper[v]:
+                if(level[u] < level[v] + 1):
+                    level[u] = level[v] + 1
+
+        # Find all of the lower triangles - every pair of arcs leaving the same node
+        tri_low_arc = []
+        tri_high_arc = []
+        tri_level = []
+        offsets = self.arc_offsets.tolist()
+        for v in xrange(n):
+            k = offsets[v + 1] - offsets[v]
+            if(k >= 2):
+                (i, j) = np.triu_indices(k, 1)
+                tri_low_arc.append(i + offsets[v])
+                tri_high_arc.append(j + offsets[v])
+                tri_level.append(np.repeat(level[v], len(i)))
+        if(len(tri_low_arc) > 0):
+            tri_low_arc = np.concatenate(tri_low_arc).astype(np.int32)
+            tri_high_arc = np.concatenate(tri_high_arc).astype(np.int32)
+            tri_level = np.concatenate(tri_level).astype(np.int32)
+        else:
+            tri_low_arc = tri_high_arc = tri_level = np.zeros(0, dtype=np.int32)
+        tri_top = self.get_arc_ids(self.arc_high[tri_low_arc],
+                                   self.arc_high[tri_high_arc]).astype(np.int32)
+
+        # Sort the triangles by level, then by top arc, so that each level can be
+        # customized with one np.minimum.reduceat() per direction
+        tri_order = np.lexsort((tri_top, tri_level))
+        self.tri_low_arc = tri_low_arc[tri_order]
+        self.tri_high_arc = tri_high_arc[tri_order]
+        tri_top = tri_top[tri_order]
+        tri_level = tri_level[tri_order]
+        del tri_order
+        is_start = np.ones(len(tri_top), dtype=bool)
+        is_start[1:] = (tri_top[1:] != tri_top[:-1]) | (tri_level[1:] != tri_level[:-1])
+        self.group_starts = np.append(np.flatnonzero(is_start), len(tri_top))
+        self.group_top = tri_top[self.group_starts[:-1]]
+        self.level_group_offsets = np.searchsorted(
+            tri_level[self.group_starts[:-1]], np.arange(max(level) + 2 if n > 0 else 1))
+        del tri_top, tri_level, is_start
+
+        # The arcs grouped by their high node, for unpacking shortcuts
+        self.down_arcs = np.argsort(self.arc_high, kind='mergesort')
+        self.down_offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.arc_high, minlength=n), out=self.down_offsets[1:])
+
+        # Every link maps onto one arc, in one direction (self-loops map onto no arc)
+        self.link_is_down = self.rank[graph.link_origin] > self.rank[graph.link_dest]
+        self.link_arc = self.get_arc_ids(
+            np.where(self.link_is_down, graph.link_dest, graph.link_origin),
+            np.where(self.link_is_down, graph.link_origin, graph.link_dest))
+
+        self.link_time = None
+        self.arc_up = None
+        self.arc_down = None
+
+    # Finds the arcs between pairs of nodes
+    # Params:
+        # low - node indices of the lower-ranked ends
+        # high - node indices of the higher-ranked ends
+    # Returns:
+        # an array of arc ids, which is -1 where there is no such arc
+    def get_arc_ids(self, low, high):
+        keys = np.asarray(low, dtype=np.int64) * self.num_nodes + high
+        if(self.num_arcs == 0):
+            return np.repeat(-1, len(keys))
+        pos = np.minimum(np.searchsorted(self.sorted_arc_keys, keys), self.num_arcs - 1)
+        return np.where(self.sorted_arc_keys[pos] == keys, self.arc_key_order[pos], -1)
+
+    # Computes the arc weights for a new set of link travel times.  This is fast, and
+    # should be called whenever the travel times change.
+    # Params:
+        # link_time - the travel time of every link.  Uses graph.link_time if None
+    def customize(self, link_time=None):
+        if(link_time is None):
+            link_time = self.graph.link_time
+        self.link_time = np.array(link_time, dtype=np.float64)
+
+        # Start with the original links
+        valid = self.link_arc >= 0
+        up = np.repeat(float('inf'), self.num_arcs)
+        down = np.repeat(float('inf'), self.num_arcs)
+        is_down = self.link_is_down & valid
+        is_up = ~self.link_is_down & valid
+        np.minimum.at(up, self.link_arc[is_up], self.link_time[is_up])
+        np.minimum.at(down, self.link_arc[is_down], self.link_time[is_down])
+
+        # Then improve them with the lower triangles, one level at a time.  The arcs
+        # that are read on each level were already finished on the lower levels
+        for level in xrange(len(self.level_group_offsets) - 1):
+            group_lo = self.level_group_offsets[level]
+            group_hi = self.level_group_offsets[level + 1]
+            if(group_lo == group_hi):
+                continue
+            lo = self.group_starts[group_lo]
+            hi = self.group_starts[group_hi]
+            starts = self.group_starts[group_lo:group_hi] - lo
+            top = self.group_top[group_lo:group_hi]
+            low_arc = self.tri_low_arc[lo:hi]
+            high_arc = self.tri_high_arc[lo:hi]
+            up[top] = np.minimum(up[top], np.minimum.reduceat(
+                down[low_arc] + up[high_arc], starts))
+            down[top] = np.minimum(down[top], np.minimum.reduceat(
+                down[high_arc] + up[low_arc], starts))
+
+        # An arc is not needed by the queries if an intermediate triangle (whose bottom
+        # is the arc's low node) is at least as fast.  That path only uses upward arcs,
+        # so the queries still find it.  This removes most of the fill-in arcs
+        self.up_used = up < float('inf')
+        self.down_used = down < float('inf')
+        for level in xrange(len(self.level_group_offsets) - 1):
+            group_lo = self.level_group_offsets[level]
+            group_hi = self.level_group_offsets[level + 1]
+            lo = self.group_starts[group_lo]
+            hi = self.group_starts[group_hi]
+            top = np.repeat(self.group_top[group_lo:group_hi],
+                            np.diff(self.group_starts[group_lo:group_hi + 1]))
+            low_arc = self.tri_low_arc[lo:hi]
+            high_arc = self.tri_high_arc[lo:hi]
+            self.up_used[high_arc[up[low_arc] + up[top] <= up[high_arc]]] = False
+            self.down_used[high_arc[down[top] + down[low_arc] <= down[high_arc]]] = False
+
+        self.arc_up = up
+        self.arc_down = down
+        self.up_list = up.tolist()
+        self.down_list = down.tolist()
+        self.adjacency = ([None] * self.num_nodes, [None] * self.num_nodes)
+
+    # The arcs leaving a node which are used by the queries, with their neighbors.
+    # Cached as lists for the queries
+    # Params:
+        # node - a node index
+        # side - 0 for the forward search (arc_up weights), or 1 for the backward
+            # search (arc_down weights)
+    def get_adjacency(self, node, side):
+        if(self.adjacency[side][node] is None):
+            lo = self.arc_offsets[node]
+            hi = self.arc_offsets[node + 1]
+            if(side == 0):
+                used = self.up_used[lo:hi]
+            else:
+                used = self.down_used[lo:hi]
+            arcs = np.arange(lo, hi)[used]
+            self.adjacency[side][node] = zip(arcs.tolist(), self.arc_high[arcs].tolist())
+        return self.adjacency[side][node]
+
+    # Finds the shortest path between two nodes with a bidirectional upward search.
+    # Each search stops once its smallest key is at least the best path found so far.
+    # Params:
+        # origin - the node index at the beginning of the path
+        # dest - the node index at the end of the path
+    # Returns:
+        # path - a list of link indices on the shortest path, in order, or None if no
+            # such path exists
+        # num_expanded - the number of nodes that were expanded during the search
+    def find_path(self, origin, dest):
+        if(self.arc_up is None):
+            raise Exception("The CustomizableCH must be customized before it can be queried.")
+        dists = ({origin: 0.0}, {dest: 0.0})
+        preds = ({origin: -1}, {dest: -1})
+        pqs = ([(0.0, origin)], [(0.0, dest)])
+        weights = (self.up_list, self.down_list)
+
+        best_time = float('inf')
+        center_node = -1
+        if(origin == dest):
+            best_time = 0.0
+            center_node = origin
+
+        num_expanded = 0
+        while(True):
+            side = -1
+            top = best_time
+            for i in (0, 1):
+                if(len(pqs[i]) > 0 and pqs[i][0][0] < top):
+                    side = i
+                    top = pqs[i][0][0]
+            if(side == -1):
+                break
+
+            (time, node) = heapq.heappop(pqs[side])
+            dist = dists[side]
+            if(time > dist[node]):
+                continue
+            num_expanded += 1
+            other_dist = dists[1 - side]
+            pred = preds[side]
+            weight = weights[side]
+            for (arc, neighbor) in self.get_adjacency(node, side):
+                proposed_time = time + weight[arc]
+                if(proposed_time < dist.get(neighbor, float('inf'))):
+                    dist[neighbor] = proposed_time
+                    pred[neighbor] = arc
+                    heapq.heappush(pqs[side], (proposed_time, neighbor))
+                    if(neighbor in other_dist and
+                            proposed_time + other_dist[neighbor] < best_time):
+                        best_time = proposed_time + other_dist[neighbor]
+                        center_node = neighbor
+
+        if(center_node == -1):
+            return None, num_expanded
+
+        # Collect the arcs of the path (with their directions), then unpack them
+        arcs = []
+        node = center_node
+        while(preds[0][node] != -1):
+            arc = preds[0][node]
+            arcs.append((arc, False))
+            node = int(self.arc_low[arc])
+        arcs.reverse()
+        node = center_node
+        while(preds[1][node] != -1):
+            arc = preds[1][node]
+            arcs.append((arc, True))
+            node = int(self.arc_low[arc])
+
+        return self.unpack_arcs(arcs), num_expanded
+
+    # A complete upward search from one node, which finds the distances to (or from)
+    # every node in its upward search space.  Used by bucket_many_to_many().
+    # Params:
+        # node - the node index where the search begins
+        # backward - search the down weights, which finds the travel times to node
+    # Returns:
+        # a dictionary from node index to travel time
+    def upward_search(self, node, backward=False):
+        if(self.arc_up is None):
+            raise Exception("The CustomizableCH must be customized before it can be queried.")
+        side = int(backward)
+        weight = (self.up_list, self.down_list)[side]
+        dist = {node: 0.0}
+        pq = [(0.0, node)]
+        while(len(pq) > 0):
+            (time, node) = heapq.heappop(pq)
+            if(time > dist[node]):
+                continue
+            for (arc, neighbor) in self.get_adjacency(node, side):
+                proposed_time = time + weight[arc]
+                if(proposed_time < dist.get(neighbor, float('inf'))):
+                    dist[neighbor] = proposed_time
+                    heapq.heappush(pq, (proposed_time, neighbor))
+        return dist
+
+    # Replaces arcs with the original links that they represent.  An arc is either one
+    # of the links, or the two halves of one of its lower triangles - whichever matches
+    # its weight.
+    # Params:
+        # arcs - a list of (arc, is_down) tuples, in order
+    # Returns:
+        # a list of link indices, in order
+    def unpack_arcs(self, arcs):
+        graph = self.graph
+        path = []
+        stack = list(reversed(arcs))
+        while(len(stack) > 0):
+            (arc, is_down) = stack.pop()
+            if(is_down):
+                weight = self.down_list[arc]
+                (tail, head) = (self.arc_high[arc], self.arc_low[arc])
+            else:
+                weight = self.up_list[arc]
+                (tail, head) = (self.arc_low[arc], self.arc_high[arc])
+
+            # The best lower triangle.  The bottom nodes of the triangles are the lower
+            # neighbors of the arc's low node, which are also connected to its high node
+            low = self.arc_low[arc]
+            low_arcs = self.down_arcs[self.down_offsets[low]:self.down_offsets[low + 1]]
+            high_arcs = self.get_arc_ids(self.arc_low[low_arcs],
+                                         np.repeat(self.arc_high[arc], len(low_arcs)))
+            low_arcs = low_arcs[high_arcs >= 0]
+            high_arcs = high_arcs[high_arcs >= 0]
+            if(is_down):
+                tri_times = self.arc_down[high_arcs] + self.arc_up[low_arcs]
+            else:
+                tri_times = self.arc_down[low_arcs] + self.arc_up[high_arcs]
+
+            # The best original link
+            links = graph.get_forward_links(tail)
+            links = links[graph.link_dest[links] == head]
+            if(len(links) > 0):
+                link = links[np.argmin(self.link_time[links])]
+                link_time = self.link_time[link]
+            else:
+                link_time = float('inf')
+
+            if(len(low_arcs) == 0 or link_time <= weight or link_time <= tri_times.min()):
+                path.append(int(link))
+            else:
+                best = np.argmin(tri_times)
+                if(is_down):
+                    # high -> bottom -> low
+                    stack.append((int(low_arcs[best]), False))
+                    stack.append((int(high_arcs[best]), True))
+                else:
+                    # low -> bottom -> high
+                    stack.append((int(high_arcs[best]), False))
+                    stack.append((int(low_arcs[best]), True))
+        return path
@@ -309,32 +309,33 @@ class DijkstrasAlgorithm:
     # final node
     @staticmethod
     def set_arc_flags(nyc_map, curr_region_id):
+        arc_flags = nyc_map.arc_flags
         for node in nyc_map.nodes:
             # Set forward arc flags
             for predecessor_node in node.forward_predecessors:
                 if predecessor_node is not None:
                     assignLink = nyc_map.links_by_node_id[(node.node_id, predecessor_node.node_id)]
-                    assignLink.forward_arc_flags_vector[curr_region_id] = True
+                    arc_flags.set_flag(assignLink.link_id, curr_region_id)
             # Set backward arc flags
             for predecessor_node in node.backward_predecessors:
                 if predecessor_node is not None:
                     assignLink = nyc_map.links_by_node_id[(predecessor_node.node_id, node.node_id)]
-                    assignLink.backward_arc_flags_vector[curr_region_id] = True
+                    arc_flags.set_flag(assignLink.link_id, curr_region_id, backward=True)
 
 
         for link in nyc_map.links:
             connect_node = nyc_map.nodes_by_id[link.connecting_node_id]
             forward_region_id = connect_node.region_id
-            link.forward_arc_flags_vector[forward_region_id] = True
+            arc_flags.set_flag(link.link_id, forward_region_id)
 
 
             origin_node = nyc_map.nodes_by_id[link.origin_node_id]
             backward_region_id = origin_node.region_id
-            link.backward_arc_flags_vector[backward_region_id] = True
+            arc_flags.set_flag(link.link_id, backward_region_id, backward=True)
 
 
-            link.forward_arc_flags_vector[backward_region_id] = True
-            link.backward_arc_flags_vector[forward_region_id] = True
+            arc_flags.set_flag(link.link_id, backward_region_id)
+            arc_flags.set_flag(link.link_id, forward_region_id, backward=True)
 
 
 
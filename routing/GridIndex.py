@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+A uniform grid over a set of 2D points, for snapping whole arrays of query points to
+their nearest neighbors at once (see Map.match_points()).
+
+The points are bucketed by grid cell, and the buckets are stored in CSR form.  A batch
+of queries is answered ring by ring: every query that is not finished yet looks at the
+cells at Chebyshev distance r from its own cell, for r = 0, 1, 2, ...  A query is
+finished once its best distance is no larger than the distance to the edge of the
+block of cells that it has searched, since every point outside of that block is at
+least that far away.  Each ring is a handful of array operations over all of the
+unfinished queries, so there is no per-query Python work.  The k nearest points
+(k_nearest()) are found the same way, and the points within a radius (within()) come
+from the block of cells that covers the radius.
+"""
+import numpy as np
+
+
+class GridIndex(object):
+
+    # Buckets a set of points into a uniform grid
+    # Params:
+        # x, y - arrays of point coordinates (e.g. in meters)
+        # points_per_cell - the average number of points per occupied cell to aim for
+    def __init__(self, x, y, points_per_cell=4):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        n = len(self.x)
+        if(n == 0):
+            raise Exception("Cannot build a GridIndex without points")
+
+        self.min_x = self.x.min()
+        self.min_y = self.y.min()
+        width = max(self.x.max() - self.min_x, 1e-9)
+        height = max(self.y.max() - self.min_y, 1e-9)
+        self.cell_size = np.sqrt(width * height * points_per_cell / float(n))
+        self.cell_size = max(self.cell_size, max(width, height) / 4096.0)
+        self.num_x = int(width / self.cell_size) + 1
+        self.num_y = int(height / self.cell_size) + 1
+
+        cells = self.get_cells(self.x, self.y)
+        self.point_order = np.argsort(cells, kind="mergesort")
+        counts = np.bincount(cells, minlength=self.num_x * self.num_y)
+        self.cell_offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    # The grid coordinates of some points, clipped to the grid
+    # Returns:
+        # cx, cy - integer arrays
+    def get_cell_coords(self, x, y):
+        cx = np.clip(((x - self.min_x) / self.cell_size).astype(np.int64), 0, self.num_x - 1)
+        cy = np.clip(((y - self.min_y) / self.cell_size).astype(np.int64), 0, self.num_y - 1)
+        return cx, cy
+
+    # The cell ids of some points (row-major, cx * num_y + cy)
+    def get_cells(self, x, y):
+        (cx, cy) = self.get_cell_coords(x, y)
+        return cx * self.num_y + cy
+
+    # The offsets of the cells at Chebyshev distance r from a cell
+    @staticmethod
+    def get_ring(r):
+        if(r == 0):
+            return np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64)
+        side = np.arange(-r, r + 1)
+        inner = np.arange(-r + 1, r)
+        dx = np.concatenate((side, side, np.repeat(-r, len(inner)), np.repeat(r, len(inner))))
+        dy = np.concatenate((np.repeat(-r, len(side)), np.repeat(r, len(side)), inner, inner))
+        return dx, dy
+
+    # The cells at Chebyshev distance r from the cells of some queries
+    # Params:
+        # queries - the query numbers
+        # cx, cy - the cell coordinates of those queries
+        # r - the ring
+    # Returns:
+        # pair_query, pair_cell - one entry per (query, cell) pair that is inside of the
+            # grid, grouped by query
+    def get_ring_pairs(self, queries, cx, cy, r):
+        (dx, dy) = GridIndex.get_ring(r)
+        pair_query = np.repeat(queries, len(dx))
+        pair_x = (cx[:, np.newaxis] + dx).ravel()
+        pair_y = (cy[:, np.newaxis] + dy).ravel()
+        inside = (pair_x >= 0) & (pair_x < self.num_x) & (pair_y >= 0) & (pair_y < self.num_y)
+        return pair_query[inside], pair_x[inside] * self.num_y + pair_y[inside]
+
+    # Expands (query, cell) pairs into the points of those cells
+    # Returns:
+        # cand_query, cand_point - one entry per (query, point) pair, in the same order
+            # as the pairs
+    def get_candidates(self, pair_query, pair_cell):
+        starts = self.cell_offsets[pair_cell]
+        counts = self.cell_offsets[pair_cell + 1] - starts
+        total = counts.sum()
+        cand_query = np.repeat(pair_query, counts)
+        firsts = np.cumsum(counts) - counts
+        cand_pos = np.arange(total) - np.repeat(firsts - starts, counts)
+        return cand_query, self.point_order[cand_pos]
+
+    # The distance from each query to the edge of the block of cells within Chebyshev
+    # distance r of its own cell.  Any point outside of the block is at least this far
+    # away.
+    def get_block_margin(self, qx, qy, cx, cy, r):
+        low_x = self.min_x + (cx - r) * self.cell_size
+        low_y = self.min_y + (cy - r) * self.cell_size
+        margin = np.minimum(
+            np.minimum(qx - low_x, low_x + (2 * r + 1) * self.cell_size - qx),
+            np.minimum(qy - low_y, low_y + (2 * r + 1) * self.cell_size - qy))
+        return np.maximum(margin, 0.0)
+
+    # Whether the block of cells within Chebyshev distance r covers the whole grid
+    def covers_grid(self, cx, cy, r):
+        return ((cx - r <= 0) & (cx + r >= self.num_x - 1) &
+                (cy - r <= 0) & (cy + r >= self.num_y - 1))
+
+    # Finds the nearest point to every query point
+    # Params:
+        # qx, qy - arrays of query coordinates
+        # max_dist - points farther away than this are not returned
+    # Returns:
+        # indices - the index of the nearest point of each query (into x and y), or -1 if
+            # there is none within max_dist.  Ties go to the lowest index.
+        # dists - the distance to that point, inf where indices is -1
+    def nearest(self, qx, qy, max_dist=float('inf')):
+        qx = np.asarray(qx, dtype=np.float64)
+        qy = np.asarray(qy, dtype=np.float64)
+        num_queries = len(qx)
+        best_index = np.repeat(np.int64(-1), num_queries)
+        best_squared = np.repeat(np.inf, num_queries)
+        max_squared = float(max_dist) ** 2
+
+        (cx, cy) = self.get_cell_coords(qx, qy)
+        active = np.arange(num_queries)
+        r = 0
+        while(len(active) > 0):
+            # Every (query, point) pair of this ring, grouped by query
+            (pair_query, pair_cell) = self.get_ring_pairs(active, cx[active], cy[active], r)
+            (cand_query, cand_point) = self.get_candidates(pair_query, pair_cell)
+            total = len(cand_query)
+            if(total > 0):
+                squared = ((self.x[cand_point] - qx[cand_query]) ** 2 +
+                           (self.y[cand_point] - qy[cand_query]) ** 2)
+
+                # The best candidate of every query, with ties broken by point index.  The
+                # candidates are still grouped by query.
+                new_query = np.concatenate(([True], cand_query[1:] != cand_query[:-1]))
+                starts = np.flatnonzero(new_query)
+                queries = cand_query[starts]
+                group_squared = np.minimum.reduceat(squared, starts)
+                group_sizes = np.diff(np.append(starts, total))
+                is_min = squared == np.repeat(group_squared, group_sizes)
+                points = np.minimum.reduceat(np.where(is_min, cand_point, len(self.x)), starts)
+                squared = group_squared
+                better = (squared < best_squared[queries]) | (
+                    (squared == best_squared[queries]) & (points < best_index[queries]))
+                best_squared[queries[better]] = squared[better]
+                best_index[queries[better]] = points[better]
+
+            # Every point outside of the block searched so far is at least margin away
+            margin = self.get_block_margin(qx[active], qy[active], cx[active], cy[active], r)
+            done = ((best_squared[active] <= margin ** 2) | (margin ** 2 >= max_squared) |
+                    self.covers_grid(cx[active], cy[active], r))
+            active = active[~done]
+            r += 1
+
+        too_far = best_squared > max_squared
+        best_index[too_far] = -1
+        best_squared[too_far] = np.inf
+        return best_index, np.sqrt(best_squared)
+
+    # Finds the k nearest points to every query point, the same way as nearest().  The
+    # best k points of every query are kept as the rings are searched, and a query is
+    # finished once its k-th best distance is within the searched block.
+    # Params:
+        # qx, qy - arrays of query coordinates
+        # k - the number of neighbors to find
+        # max_dist - points farther away than this are not returned
+    # Returns:
+        # indices - a (num_queries x k) array with the indices of the nearest points of
+            # each query, nearest first (ties go to the lowest index).  Padded with -1
+            # when fewer than k points are within max_dist.
+        # dists - the distances to those points, inf where indices is -1
+    def k_nearest(self, qx, qy, k, max_dist=float('inf')):
+        qx = np.asarray(qx, dtype=np.float64)
+        qy = np.asarray(qy, dtype=np.float64)
+        num_queries = len(qx)
+        best_index = np.empty((num_queries, k), dtype=np.int64)
+        best_index.fill(-1)
+        best_squared = np.empty((num_queries, k))
+        best_squared.fill(np.inf)
+        max_squared = float(max_dist) ** 2
+
+        (cx, cy) = self.get_cell_coords(qx, qy)
+        active = np.arange(num_queries)
+        r = 0
+        while(len(active) > 0):
+            (pair_query, pair_cell) = self.get_ring_pairs(active, cx[active], cy[active], r)
+            (cand_query, cand_point) = self.get_candidates(pair_query, pair_cell)
+            squared = ((self.x[cand_point] - qx[cand_query]) ** 2 +
+                       (self.y[cand_point] - qy[cand_query]) ** 2)
+            close = squared <= max_squared
+            if(close.any()):
+                # Merge the new candidates with the best points found so far, and keep
+                # the first k of every query
+                (old_query, old_rank) = np.nonzero(best_index[active] >= 0)
+                old_query = active[old_query]
+                cand_query = np.concatenate((cand_query[close], old_query))
+                cand_point = np.concatenate((cand_point[close],
+                                             best_index[old_query, old_rank]))
+                squared = np.concatenate((squared[close], best_squared[old_query, old_rank]))
+                order = np.lexsort((cand_point, squared, cand_query))
+                (cand_query, cand_point, squared) = (cand_query[order], cand_point[order],
+                                                     squared[order])
+                new_query = np.concatenate(([True], cand_query[1:] != cand_query[:-1]))
+                starts = np.flatnonzero(new_query)
+                group_sizes = np.diff(np.append(starts, len(cand_query)))
+                rank = np.arange(len(cand_query)) - np.repeat(starts, group_sizes)
+                keep = rank < k
+                best_index[cand_query[keep], rank[keep]] = cand_point[keep]
+                best_squared[cand_query[keep], rank[keep]] = squared[keep]
+
+            margin = self.get_block_margin(qx[active], qy[active], cx[active], cy[active], r)
+            done = ((best_squared[active, k - 1] <= margin ** 2) |
+                    (margin ** 2 >= max_squared) | self.covers_grid(cx[active], cy[active], r))
+            active = active[~done]
+            r += 1
+
+        return best_index, np.sqrt(best_squared)
+
+    # Finds every point within some distance of every query point
+    # Params:
+        # qx, qy - arrays of query coordinates
+        # radius - the maximum distance
+    # Returns:
+        # offsets - the points of query i are at offsets[i]:offsets[i + 1] of the other
+            # two arrays
+        # indices - the indices of the points, nearest first within each query (ties go
+            # to the lowest index)
+        # dists - the distances to those points
+    def within(self, qx, qy, radius):
+        qx = np.asarray(qx, dtype=np.float64)
+        qy = np.asarray(qy, dtype=np.float64)
+        num_queries = len(qx)
+        radius = float(radius)
+
+        # The block of cells that overlaps the square around each query
+        (x_lo, y_lo) = self.get_cell_coords(qx - radius, qy - radius)
+        (x_hi, y_hi) = self.get_cell_coords(qx + radius, qy + radius)
+        widths = x_hi - x_lo + 1
+        heights = y_hi - y_lo + 1
+        sizes = widths * heights
+        pair_query = np.repeat(np.arange(num_queries), sizes)
+        pair_pos = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        pair_x = x_lo[pair_query] + pair_pos // heights[pair_query]
+        pair_y = y_lo[pair_query] + pair_pos % heights[pair_query]
+        (cand_query, cand_point) = self.get_candidates(pair_query, pair_x * self.num_y + pair_y)
+
+        squared = ((self.x[cand_point] - qx[cand_query]) ** 2 +
+                   (self.y[cand_point] - qy[cand_query]) ** 2)
+        close = squared <= radius ** 2
+        (cand_query, cand_point, squared) = (cand_query[close], cand_point[close],
+                                             squared[close])
+        order = np.lexsort((cand_point, squared, cand_query))
+        counts = np.bincount(cand_query, minlength=num_queries)
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        return offsets, cand_point[order], np.sqrt(squared[order])
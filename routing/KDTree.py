@@ -5,93 +5,212 @@ i.e. objects that implement __getitem__() and __len__()
 This can be used to quickly perform nearest neighbor queries, and partition
 data points into rectangles with roughly the same number of points in each
 region.
+
+The tree is stored in flat arrays instead of one object per tree node.  The tree
+nodes are numbered in pre-order (the root is 0, and the low child of an internal
+node i is i + 1), and every leaf owns a slice of one permutation of the data point
+indices.  The tree is grown one level at a time over that permutation: the slices of
+all of the nodes on a level are sorted together, with one stable sort, so each split
+only reorders its own slice.
 Created on Fri Dec  5 16:30:53 2014
 
 @author: brian
 """
 from itertools import imap
+import heapq
+import numpy as np
+
+
+# Copies the coordinates of some data points into an array.  Nodes keep their
+# coordinates in a tuple (Node.location), which is much faster to read than calling
+# __getitem__() once per coordinate.
+# Params:
+    # data - A list of objects which must implement __getitem__() and __len__()
+# Returns:
+    # an (n x num_dimensions) array
+def get_coordinates(data):
+    if(len(data) == 0):
+        return np.zeros((0, 1))
+    if(hasattr(data[0], "location")):
+        return np.array([d.location for d in data], dtype=np.float64)
+    num_dimensions = len(data[0])
+    return np.array([[d[k] for k in xrange(num_dimensions)] for d in data],
+                    dtype=np.float64)
+
+
+# Finds the leaves that many points are geometrically in, by walking all of them down
+# the tree at once.  Only needs the split arrays, so it also works on a tree that was
+# saved without its data (see RegionRaster).
+# Params:
+    # split_dim, split_val, hi_child - the arrays of a KDTree
+    # points - an (n x num_dimensions) array
+# Returns:
+    # an array with the leaf of every point
+def find_leaves(split_dim, split_val, hi_child, points):
+    points = np.asarray(points, dtype=np.float64)
+    leaves = np.zeros(len(points), dtype=np.int64)
+    active = np.flatnonzero(hi_child[leaves] >= 0)
+    while(len(active) > 0):
+        nodes = leaves[active]
+        values = points[active, split_dim[nodes]]
+        leaves[active] = np.where(values < split_val[nodes], nodes + 1, hi_child[nodes])
+        active = active[hi_child[leaves[active]] >= 0]
+    return leaves
 
 
 # A KD-Tree which supports nearest-neighbor lookup.  It also has a get_leaf()
-# function which can be used to determine if two nodes are in the same region.
-# Note that the children of a KD-Tree are also KD-Trees. We make no distinction
-# between the nodes of the tree and the tree itself.  Leaf nodes are just
-# KDTrees whose chidren are None, and store data points in them
-class KDTree:
-    split_dim = 0
-    split_val = 0
-    low_child = None
-    hi_child = None
-
-    # Initializes the kd-tree with some data.  Will recursively grow children
-    # trees if there is too much data
+# function which can be used to determine if two points are in the same region.
+# Leaves are identified by their tree node number.
+class KDTree(object):
+
+    # Initializes the kd-tree with some data.  Splits the data until every leaf has
+    # at most leaf_size data points
     # Params:
     # data - A list of objects which must implement __getitem__() and __len__()
+    # The list is not modified.
     # split_dim - which dimension should we split on (the children will split
     # on the next dimension and so on)
     # leaf_size - stop splitting when a child has less than this many data
     # points
+    # split_weights - if True, split at the weighted median of data.trip_weight
+    # instead, and stop when the total weight is at most leaf_size
     def __init__(self, data, split_dim=0, leaf_size=100, split_weights = False):
-
-        self.split_dim = split_dim
-        stop = False
-        if split_weights == False:
-            if(len(data) <= leaf_size):
-                # Not enough data - this tree is a leaf node
-                stop = True
-        else:
-            if sum(node.trip_weight for node in data) <= leaf_size:
-                stop = True
-        if stop == True:
-            self.data = data
-        else:
-            num_dimensions = len(data[0])
-            # Identify the median as the split point
-            # TODO: This is currently done the "easy way".
-            # A linear time algorithm or simpler criteria could be used
-            mid = 0
-            data.sort(key=lambda x: x[split_dim])
-            if split_weights == True:
-                totSum = sum(node.trip_weight for node in data)
-                curr = 0
-                for i in range(len(data)):
-                    curr += data[i].trip_weight
-                    if curr >= totSum/2:
-                        mid = i
-                        break
+        self.data = list(data)
+        n = len(self.data)
+        self.points = get_coordinates(self.data)
+        num_dimensions = self.points.shape[1]
+        if split_weights == True:
+            weights = np.array([d.trip_weight for d in self.data], dtype=np.int64)
+        items = np.arange(n, dtype=np.int32)
+
+        # The tree is grown one level at a time, in breadth-first order.  Every tree
+        # node of the level owns the slice lo:hi of items.
+        (lo, hi) = (np.zeros(1, dtype=np.int64), np.array([n], dtype=np.int64))
+        dims = np.array([split_dim], dtype=np.int64)
+        levels = []
+        while(len(lo) > 0):
+            sizes = hi - lo
+            if split_weights == False:
+                split = sizes > leaf_size
             else:
-                mid = len(data) / 2
-
-            self.split_val = data[mid][split_dim]
-
-            # Child trees will split on the next dimension (cycle after running
-            # out)
-            next_dim = (self.split_dim + 1) % num_dimensions
-
-            # Recursively grow children
-            self.low_child = KDTree(data[:mid], next_dim, leaf_size, split_weights)
-            self.hi_child = KDTree(data[mid:], next_dim, leaf_size, split_weights)
-            self.data = None
+                cumulative = np.concatenate(([0], np.cumsum(weights[items])))
+                split = cumulative[hi] - cumulative[lo] > leaf_size
+            split &= sizes > 1
+            vals = np.zeros(len(lo))
+            mids = lo.copy()
+
+            segments = np.flatnonzero(split)
+            if(len(segments) > 0):
+                # Sort the slices of all of the split nodes of this level at once, by
+                # node and then by value.  The sort is stable, so ties keep the order
+                # of the parent's slice.
+                seg_sizes = sizes[segments]
+                seg_starts = np.cumsum(seg_sizes) - seg_sizes
+                seg_of = np.repeat(np.arange(len(segments)), seg_sizes)
+                positions = np.arange(seg_sizes.sum()) + np.repeat(lo[segments] - seg_starts,
+                                                                   seg_sizes)
+                values = self.points[items[positions], dims[segments][seg_of]]
+                order = np.lexsort((values, seg_of))
+                items[positions] = items[positions[order]]
+
+                # Identify the median (or the weighted median) as the split point
+                if split_weights == False:
+                    mid = seg_sizes / 2
+                else:
+                    cumulative = np.cumsum(weights[items[positions]])
+                    before = np.concatenate(([0], cumulative))[seg_starts]
+                    totals = cumulative[seg_starts + seg_sizes - 1] - before
+                    mid = np.searchsorted(cumulative, before + totals / 2) - seg_starts
+                    # Both children must get some data, or the split would repeat forever
+                    mid = np.clip(mid, 1, seg_sizes - 1)
+                mids[segments] = lo[segments] + mid
+                vals[segments] = self.points[items[mids[segments]], dims[segments]]
+
+            levels.append((lo, hi, dims, vals, split))
+            # Child trees will split on the next dimension (cycle after running out)
+            next_dims = (dims[segments] + 1) % num_dimensions
+            lo = np.column_stack((lo[segments], mids[segments])).ravel()
+            hi = np.column_stack((mids[segments], hi[segments])).ravel()
+            dims = np.repeat(next_dims, 2)
+
+        # Renumber the tree nodes from breadth-first order to pre-order, where the low
+        # child of node i is i + 1, and the high child comes after the whole low subtree
+        subtree_sizes = [None] * len(levels)
+        below = np.zeros(0, dtype=np.int64)
+        for depth in reversed(xrange(len(levels))):
+            split = levels[depth][4]
+            sizes = np.ones(len(split), dtype=np.int64)
+            sizes[split] += below[0::2] + below[1::2]
+            subtree_sizes[depth] = sizes
+            below = sizes
+        numbers = [np.zeros(1, dtype=np.int64)]
+        for depth in xrange(len(levels) - 1):
+            parents = numbers[depth][levels[depth][4]]
+            low_sizes = subtree_sizes[depth + 1][0::2]
+            numbers.append(np.column_stack((parents + 1, parents + 1 + low_sizes)).ravel())
+
+        num_nodes = int(subtree_sizes[0][0]) if n > 0 else 1
+        self.split_dim = np.zeros(num_nodes, dtype=np.int8)
+        self.split_val = np.zeros(num_nodes, dtype=np.float64)
+        self.hi_child = np.zeros(num_nodes, dtype=np.int32)
+        self.hi_child.fill(-1)
+        self.leaf_start = np.zeros(num_nodes, dtype=np.int64)
+        self.leaf_end = np.zeros(num_nodes, dtype=np.int64)
+        self.depth = np.zeros(num_nodes, dtype=np.int32)
+        for (depth, (lo, hi, dims, vals, split)) in enumerate(levels):
+            number = numbers[depth]
+            self.split_dim[number] = dims
+            self.split_val[number] = vals
+            self.leaf_start[number] = lo
+            self.leaf_end[number] = hi
+            self.depth[number] = depth
+            if(depth + 1 < len(levels)):
+                self.hi_child[number[split]] = numbers[depth + 1][1::2]
+        self.items = items
+        self.query_lists = None
+
+    # Whether a tree node is a leaf
+    def is_leaf(self, i):
+        return self.hi_child[i] < 0
 
     # Returns the leaf node that a query point is geometricaly in
     # Params:
         # point - any array-like object.  Not necessarily a point used to grow
         # the tree
     # Returns:
-        # A KDTree object, which represents the leaf node.
+        # The tree node number of the leaf
     def get_leaf(self, point):
-        # This is a leaf
-        if(self.low_child is None and self.hi_child is None):
-            return self
-
-        # This is not a leaf - figure out which child contains the point
-        point_val = point[self.split_dim]
+        hi_child = self.hi_child
+        i = 0
+        while(hi_child[i] >= 0):
+            # This is not a leaf - figure out which child contains the point
+            if(point[self.split_dim[i]] < self.split_val[i]):
+                i += 1
+            else:
+                i = hi_child[i]
+        return int(i)
 
-        # Recursively call that child
-        if(point_val < self.split_val):
-            return self.low_child.get_leaf(point)
-        else:
-            return self.hi_child.get_leaf(point)
+    # Same as get_leaf(), for many points at once
+    # Params:
+        # points - an (n x num_dimensions) array
+    # Returns:
+        # an array with the leaf of every point
+    def get_leaves(self, points):
+        return find_leaves(self.split_dim, self.split_val, self.hi_child, points)
+
+    # The data points stored in a leaf
+    def get_leaf_data(self, i):
+        return [self.data[j] for j in self.items[self.leaf_start[i]:self.leaf_end[i]]]
+
+    # The tree arrays as Python lists, which are much faster than NumPy arrays to
+    # read one element at a time.  Built on the first query.
+    def get_query_lists(self):
+        if(self.query_lists is None):
+            self.query_lists = (self.split_dim.tolist(), self.split_val.tolist(),
+                                self.hi_child.tolist(), self.leaf_start.tolist(),
+                                self.leaf_end.tolist(), self.items.tolist(),
+                                self.points.tolist())
+        return self.query_lists
 
     # Finds the data point in the KDTree which is nearest to a query point
     # Params:
@@ -99,70 +218,196 @@ class KDTree:
         # max_squared_dist - An upper bound on the (squared) neighbor distance.
         #   Subtrees That are further away than this will not be explored
     # Returns:
-        # The data point which is nearest to the query point
+        # The data point which is nearest to the query point, and its squared distance
     def nearest_neighbor_query(self, point, max_squared_dist=float('inf')):
+        (split_dim, split_val, hi_child, leaf_start, leaf_end, items,
+         points) = self.get_query_lists()
+        query = [float(point[k]) for k in xrange(self.points.shape[1])]
+        best_squared_dist = max_squared_dist
+        best_item = -1
+
+        # Each entry is a tree node, and a lower bound on the squared distance to it
+        stack = [(0, 0.0)]
+        while(len(stack) > 0):
+            (i, bound) = stack.pop()
+            if(bound >= best_squared_dist):
+                continue
+
+            if(hi_child[i] < 0):
+                # This is a leaf, search through the points
+                for j in items[leaf_start[i]:leaf_end[i]]:
+                    dist = sum([(a - b) * (a - b) for (a, b) in zip(query, points[j])])
+                    if(dist < best_squared_dist):
+                        best_squared_dist = dist
+                        best_item = j
+                continue
+
+            # This is an internal node.  The nearest neighbor is probably in the
+            # branch that contains the point (close branch), but if the point is
+            # close to the border, it might still be in the far branch.  The close
+            # branch is pushed last, so it is searched first.
+            diff = split_val[i] - query[split_dim[i]]
+            if(diff > 0):
+                (close_branch, far_branch) = (i + 1, hi_child[i])
+            else:
+                (close_branch, far_branch) = (hi_child[i], i + 1)
+            stack.append((far_branch, max(bound, diff * diff)))
+            stack.append((close_branch, bound))
+
+        if(best_item < 0):
+            return None, best_squared_dist
+        return self.data[best_item], best_squared_dist
+
+    # Finds the k data points in the KDTree which are nearest to a query point
+    # Params:
+        # point - The query point, any array-like object
+        # k - The number of neighbors to find
+        # max_squared_dist - Points that are further away than this (squared) distance
+        #   are not returned
+    # Returns:
+        # A list of up to k data points, nearest first (ties go to the lowest index),
+        # and a list of their squared distances
+    def k_nearest_query(self, point, k, max_squared_dist=float('inf')):
+        (split_dim, split_val, hi_child, leaf_start, leaf_end, items,
+         points) = self.get_query_lists()
+        query = [float(point[d]) for d in xrange(self.points.shape[1])]
+
+        # A max-heap of the best points so far, as (-squared distance, -index).  Once it
+        # is full, its top is the distance to beat.
+        best = []
+        worst_squared_dist = max_squared_dist
+        stack = [(0, 0.0)]
+        while(len(stack) > 0):
+            (i, bound) = stack.pop()
+            if(bound > worst_squared_dist):
+                continue
+
+            if(hi_child[i] < 0):
+                for j in items[leaf_start[i]:leaf_end[i]]:
+                    dist = sum([(a - b) * (a - b) for (a, b) in zip(query, points[j])])
+                    if(dist <= worst_squared_dist):
+                        heapq.heappush(best, (-dist, -j))
+                        if(len(best) > k):
+                            heapq.heappop(best)
+                        if(len(best) == k):
+                            worst_squared_dist = -best[0][0]
+                continue
+
+            diff = split_val[i] - query[split_dim[i]]
+            if(diff > 0):
+                (close_branch, far_branch) = (i + 1, hi_child[i])
+            else:
+                (close_branch, far_branch) = (hi_child[i], i + 1)
+            stack.append((far_branch, max(bound, diff * diff)))
+            stack.append((close_branch, bound))
 
-        # if this is a leaf, search through the points
-        if(self.data is not None):
-            best_squared_dist = max_squared_dist
-            best_point = None
-            for d in self.data:
-                # dist = squared_dist(point, d)
-                diff = imap(float.__sub__, point, d)
-                dist = sum(map(lambda x: x * x, diff))
-
-                if(dist < best_squared_dist):
-                    best_squared_dist = dist
-                    best_point = d
-            self.calls = 1
-            return best_point, best_squared_dist
-
-        # This is an internal node.  Determine which branch the point is in
-        # (close branch)
-        # And which one it is not (far branch).  The nearest neighbor is
-        # probably in the close
-        # branch, but there is a possibility that it is in the far branch
-        point_val = point[self.split_dim]
-
-        if(point_val < self.split_val):
-            close_branch = self.low_child
-            far_branch = self.hi_child
-        else:
-            close_branch = self.hi_child
-            far_branch = self.low_child
-
-        # First search the close branch for the nearest neighbor and its
-        # distance
-        best_point, best_squared_dist = close_branch.nearest_neighbor_query(
-            point, max_squared_dist)
-        self.calls = close_branch.calls + 1
-
-        # If the query point is close to the border, the nearest neighbor might
-        # still be in the far branch
-        # However, if the border is farther away than the best match so far,
-        # there is no need to search it
-        border_dist = (self.split_val - point[self.split_dim]) ** 2
-        if(border_dist < best_squared_dist):
-            candidate_point, candidate_squared_dist = (
-                far_branch.nearest_neighbor_query(point, best_squared_dist))
-
-            # If we found a better match in the far branch, replace the old one
-            if(candidate_squared_dist < best_squared_dist):
-                best_point = candidate_point
-                best_squared_dist = candidate_squared_dist
-
-            self.calls += far_branch.calls
-
-        # Return the best match that we have found so far
-        return best_point, best_squared_dist
+        best = sorted([(-dist, -j) for (dist, j) in best])
+        return [self.data[j] for (_, j) in best], [dist for (dist, _) in best]
 
+    # Finds all of the data points in the KDTree within some distance of a query point
+    # Params:
+        # point - The query point, any array-like object
+        # radius - The maximum distance (not squared)
+    # Returns:
+        # A list of the data points, nearest first (ties go to the lowest index), and a
+        # list of their squared distances
+    def radius_query(self, point, radius):
+        (split_dim, split_val, hi_child, leaf_start, leaf_end, items,
+         points) = self.get_query_lists()
+        query = [float(point[d]) for d in xrange(self.points.shape[1])]
+        max_squared_dist = float(radius) ** 2
+
+        found = []
+        stack = [(0, 0.0)]
+        while(len(stack) > 0):
+            (i, bound) = stack.pop()
+            if(bound > max_squared_dist):
+                continue
+
+            if(hi_child[i] < 0):
+                for j in items[leaf_start[i]:leaf_end[i]]:
+                    dist = sum([(a - b) * (a - b) for (a, b) in zip(query, points[j])])
+                    if(dist <= max_squared_dist):
+                        found.append((dist, j))
+                continue
+
+            diff = split_val[i] - query[split_dim[i]]
+            stack.append((i + 1, max(bound, diff * diff) if diff <= 0 else bound))
+            stack.append((hi_child[i], max(bound, diff * diff) if diff > 0 else bound))
+
+        found.sort()
+        return [self.data[j] for (_, j) in found], [dist for (dist, _) in found]
+
+    # The depth of the shallowest leaf
     def get_height(self):
-        if(self.low_child is None and self.hi_child is None):
-            return 1
-        else:
-            return min(
-                self.low_child.get_height(),
-                self.hi_child.get_height()) + 1
+        return int(self.depth[self.hi_child < 0].min()) + 1
+
+    # Returns the number of bytes used by the tree arrays (not the data points)
+    def get_memory_usage(self):
+        return sum(arr.nbytes for arr in [self.points, self.split_dim, self.split_val,
+                                          self.hi_child, self.leaf_start, self.leaf_end,
+                                          self.depth, self.items])
+
+    # Flattens the tree into arrays, so it can be saved without pickling the data
+    # points.  Tree nodes are numbered in pre-order (the root is 0).
+    # Params:
+        # index_of - a function which maps a data point to an integer index
+    # Returns:
+        # a dictionary of arrays - split_dim, split_val, low_child, hi_child (-1 for
+        # leaves), and leaf_start, leaf_end, which give the slice of leaf_items
+        # (data point indices) stored in each leaf
+    def to_arrays(self, index_of):
+        indices = np.array([index_of(d) for d in self.data], dtype=np.int32)
+        internal = self.hi_child >= 0
+        is_leaf = ~internal
+        # Only the leaves own their slices
+        leaf_sizes = np.where(is_leaf, self.leaf_end - self.leaf_start, 0)
+        leaf_end = np.cumsum(leaf_sizes)
+        leaf_items = (indices[self.items] if len(self.data) > 0
+                      else np.zeros(0, dtype=np.int32))
+        return {"split_dim": self.split_dim.copy(),
+                "split_val": self.split_val.copy(),
+                "low_child": np.where(internal, np.arange(len(self.hi_child)) + 1,
+                                      -1).astype(np.int32),
+                "hi_child": self.hi_child.copy(),
+                "leaf_start": leaf_end - leaf_sizes,
+                "leaf_end": leaf_end,
+                "leaf_items": leaf_items}
+
+    # Rebuilds a tree that was flattened with to_arrays(), without re-sorting the data
+    # Params:
+        # arrays - the dictionary returned by to_arrays()
+        # data - a list of data points, indexed the same way as in to_arrays()
+    # Returns:
+        # the KDTree
+    @staticmethod
+    def from_arrays(arrays, data):
+        tree = KDTree.__new__(KDTree)
+        tree.data = list(data)
+        tree.points = get_coordinates(tree.data)
+        tree.split_dim = np.array(arrays["split_dim"], dtype=np.int8)
+        tree.split_val = np.array(arrays["split_val"], dtype=np.float64)
+        tree.hi_child = np.array(arrays["hi_child"], dtype=np.int32)
+        tree.items = np.array(arrays["leaf_items"], dtype=np.int32)
+
+        # Internal nodes own the slices of all of their leaves, and the depths are
+        # recomputed top-down
+        num_nodes = len(tree.split_dim)
+        leaf_start = np.array(arrays["leaf_start"], dtype=np.int64)
+        leaf_end = np.array(arrays["leaf_end"], dtype=np.int64)
+        depth = np.zeros(num_nodes, dtype=np.int32)
+        for i in xrange(num_nodes):
+            if(tree.hi_child[i] >= 0):
+                depth[i + 1] = depth[tree.hi_child[i]] = depth[i] + 1
+        for i in reversed(xrange(num_nodes)):
+            if(tree.hi_child[i] >= 0):
+                leaf_start[i] = leaf_start[i + 1]
+                leaf_end[i] = leaf_end[tree.hi_child[i]]
+        tree.leaf_start = leaf_start
+        tree.leaf_end = leaf_end
+        tree.depth = depth
+        tree.query_lists = None
+        return tree
 
 # For testing purposes - finds the nearest neighbor to a query point brute
 # force style
@@ -228,6 +473,21 @@ if __name__ == "__main__":
             num_mistakes += 1
     print "Number of mistakes : " + str(num_mistakes)
 
+    print("Querying k nearest (fast way and slow way)")
+    num_mistakes = 0
+    for t in test_points:
+        (neighbors, squared_dists) = kdtree.k_nearest_query(t, 5)
+        radius = squared_dists[-1] ** .5 * 1.000001
+        (in_radius, radius_dists) = kdtree.radius_query(t, radius)
+        # Same distance expression as the tree, so that the distances match exactly
+        brute = sorted([(sum([(a - b) * (a - b) for (a, b) in zip(p, t)]), j)
+                        for (j, p) in enumerate(train_points)])[:5]
+        brute_neighbors = [train_points[j] for (_, j) in brute]
+        if(squared_dists != [dist for (dist, _) in brute] or neighbors != brute_neighbors or
+                in_radius[:5] != neighbors):
+            num_mistakes += 1
+    print "Number of mistakes : " + str(num_mistakes)
+
     test_points = generate_random_points(1000)
     print("Checking regions")
     matches = 0
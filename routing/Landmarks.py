@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Landmark lower bounds (ALT) for bidirectional A* search on an ArrayGraph.
+
+A small set of landmark nodes is chosen, and the travel times from every landmark
+to every node (and from every node to every landmark) are precomputed.  By the
+triangle inequality, for any landmark L:
+    dist(v, t) >= dist(v, L) - dist(t, L)
+    dist(v, t) >= dist(L, t) - dist(L, v)
+The best of these bounds is a much tighter A* heuristic than the straight-line
+distance, and it never overestimates, so the search stays exact.
+
+For more information, see:
+"Computing the Shortest Path: A* Search Meets Graph Theory", Goldberg and Harrelson, 2005
+"Computing Point-to-Point Shortest Paths from External Memory", Goldberg and Werneck, 2005
+
+The landmarks only depend on the graph, but the tables depend on the link travel
+times.  After the times change, recompute() rebuilds the tables for the same
+landmarks (see Map.get_landmarks()).
+"""
+import numpy as np
+from ArraySearch import shortest_path_tree
+
+# Stands in for infinity in the tables, so that bounds involving unreachable nodes
+# are still valid numbers (inf - inf would be nan)
+UNREACHABLE_TIME = 1e12
+
+
+# Precomputed landmark distances.
+# Attributes:
+    # landmarks - the node indices of the landmarks
+    # from_landmark - from_landmark[i, v] is the travel time from landmark i to node v
+    # to_landmark - to_landmark[i, v] is the travel time from node v to landmark i
+    # node_bounds - one row per node, [to_landmark[:, v], -from_landmark[:, v]].  For
+        # any two nodes, max(node_bounds[v] - node_bounds[t]) is a lower bound on the
+        # travel time from v to t.  This is what bidirectional_search() uses.
+    # link_time - the travel times that the tables were computed with
+class Landmarks(object):
+
+    # Chooses the landmarks and computes their tables
+    # Params:
+        # graph - an ArrayGraph
+        # num_landmarks - how many landmarks to choose
+        # method - "avoid" or "farthest" (see select_avoid() and select_farthest())
+        # link_time - the travel time of every link.  Uses graph.link_time if None
+        # seed - seed for the random choices made during landmark selection
+    def __init__(self, graph, num_landmarks=16, method="avoid", link_time=None, seed=None):
+        if(method not in ("avoid", "farthest")):
+            raise Exception("Unknown landmark selection method: " + str(method))
+        if(link_time is None):
+            link_time = graph.link_time
+        self.graph = graph
+        self.method = method
+        self.link_time = np.array(link_time, dtype=np.float64)
+        self.landmarks = []
+        self.from_landmark = np.zeros((0, graph.num_nodes))
+        self.to_landmark = np.zeros((0, graph.num_nodes))
+
+        num_landmarks = min(num_landmarks, graph.num_nodes)
+        random = np.random.RandomState(seed)
+        while(len(self.landmarks) < num_landmarks):
+            if(method == "avoid"):
+                landmark = self.select_avoid(random)
+            else:
+                landmark = self.select_farthest(random)
+            self.add_landmark(landmark)
+
+        self.landmarks = np.array(self.landmarks, dtype=np.int64)
+        self.build_node_bounds()
+
+    # Computes the tables of a new landmark, and adds it to the set
+    # Params:
+        # landmark - a node index
+    def add_landmark(self, landmark):
+        (from_dist, _, _) = shortest_path_tree(self.graph, landmark, self.link_time)
+        (to_dist, _, _) = shortest_path_tree(self.graph, landmark, self.link_time,
+                                             backward=True)
+        self.landmarks.append(landmark)
+        self.from_landmark = np.vstack((self.from_landmark,
+                                        np.minimum(from_dist, UNREACHABLE_TIME)))
+        self.to_landmark = np.vstack((self.to_landmark,
+                                      np.minimum(to_dist, UNREACHABLE_TIME)))
+
+    # Farthest selection - the next landmark is the node which is farthest (in travel
+    # time, in both directions) from all of the existing landmarks.  The first landmark
+    # is the node farthest from a random node.
+    # Params:
+        # random - a numpy RandomState
+    # Returns:
+        # the node index of the next landmark
+    def select_farthest(self, random):
+        if(len(self.landmarks) == 0):
+            start = random.randint(self.graph.num_nodes)
+            (from_dist, _, _) = shortest_path_tree(self.graph, start, self.link_time)
+            (to_dist, _, _) = shortest_path_tree(self.graph, start, self.link_time,
+                                                 backward=True)
+            round_trip = (np.minimum(from_dist, UNREACHABLE_TIME) +
+                          np.minimum(to_dist, UNREACHABLE_TIME))
+        else:
+            round_trip = np.min(self.from_landmark + self.to_landmark, axis=0)
+            round_trip[self.landmarks] = -1
+        return int(np.argmax(round_trip))
+
+    # Avoid selection - grows a shortest path tree from a random root, and weights each
+    # node by how badly the existing landmarks bound its distance from the root.  Then
+    # walks down from the root, always into the subtree with the largest total weight,
+    # skipping subtrees which already contain a landmark.  The leaf that it reaches is
+    # the next landmark.
+    # Params:
+        # random - a numpy RandomState
+    # Returns:
+        # the node index of the next landmark
+    def select_avoid(self, random):
+        graph = self.graph
+        root = random.randint(graph.num_nodes)
+        (dist, pred, order) = shortest_path_tree(graph, root, self.link_time)
+
+        # The current lower bounds on the distances from the root
+        if(len(self.landmarks) > 0):
+            lower_bound = np.maximum(
+                np.max(self.to_landmark[:, [root]] - self.to_landmark, axis=0),
+                np.max(self.from_landmark - self.from_landmark[:, [root]], axis=0))
+            lower_bound = np.maximum(lower_bound, 0)
+        else:
+            lower_bound = np.zeros(graph.num_nodes)
+        weight = np.zeros(graph.num_nodes)
+        weight[order] = dist[order] - lower_bound[order]
+
+        # Sum the weights of the subtrees, from the leaves up
+        size = weight.tolist()
+        has_landmark = np.zeros(graph.num_nodes, dtype=bool)
+        has_landmark[self.landmarks] = True
+        has_landmark = has_landmark.tolist()
+        parent = np.where(pred >= 0, graph.link_origin[np.maximum(pred, 0)], -1).tolist()
+        for node in reversed(order.tolist()[1:]):
+            if(has_landmark[node]):
+                size[node] = 0.0
+                has_landmark[parent[node]] = True
+            else:
+                size[parent[node]] += size[node]
+        if(has_landmark[root]):
+            size[root] = 0.0
+        if(size[root] <= 0):
+            return self.select_farthest(random)
+
+        # Walk down to a leaf
+        children = {}
+        for node in order.tolist()[1:]:
+            children.setdefault(parent[node], []).append(node)
+        node = root
+        while(node in children):
+            best_child = max(children[node], key=lambda child: size[child])
+            if(size[best_child] <= 0):
+                break
+            node = best_child
+        return node
+
+    # Rebuilds node_bounds from the landmark tables
+    def build_node_bounds(self):
+        self.node_bounds = np.ascontiguousarray(
+            np.hstack((self.to_landmark.T, -self.from_landmark.T)))
+
+    # Recomputes the tables for new travel times, keeping the same landmarks.  This only
+    # costs two Dijkstra searches per landmark.
+    # Params:
+        # link_time - the travel time of every link.  Uses graph.link_time if None
+    def recompute(self, link_time=None):
+        if(link_time is None):
+            link_time = self.graph.link_time
+        self.link_time = np.array(link_time, dtype=np.float64)
+        for (i, landmark) in enumerate(self.landmarks.tolist()):
+            (from_dist, _, _) = shortest_path_tree(self.graph, landmark, self.link_time)
+            (to_dist, _, _) = shortest_path_tree(self.graph, landmark, self.link_time,
+                                                 backward=True)
+            self.from_landmark[i] = np.minimum(from_dist, UNREACHABLE_TIME)
+            self.to_landmark[i] = np.minimum(to_dist, UNREACHABLE_TIME)
+        self.build_node_bounds()
+
+    # A lower bound on the travel time between two nodes
+    # Params:
+        # origin - a node index
+        # dest - a node index
+    def get_lower_bound(self, origin, dest):
+        if(len(self.landmarks) == 0):
+            return 0.0
+        return max(float((self.node_bounds[origin] - self.node_bounds[dest]).max()), 0.0)
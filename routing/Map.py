@@ -1,19 +1,38 @@
 from KDTree import KDTree
+from ArrayGraph import ArrayGraph, LAT_METERS, LON_METERS
+from ArraySearch import route_chunk, route_from_origin, route_origin_chunk
+from ArraySearch import candidate_search
+from ArraySearch import bidirectional_search as array_bidirectional_search
+from ContractionHierarchy import ContractionHierarchy
+from CustomizableCH import CustomizableCH
+from Landmarks import Landmarks
+from GridIndex import GridIndex
+from RegionRaster import RegionRaster
+from PackedArcFlags import PackedArcFlags
+import TravelTimeMatrix
+import ArcFlagLabels
+import snapshot
 import csv
+import atexit
+import tempfile
+import os
 from Node import Node
 from Link import Link
 from traffic_estimation.Trip import Trip
+from traffic_estimation.TripBatch import TripBatch
 from BiDirectionalSearch import bidirectional_search
-from SCC import kosaraju
+from SCC import tarjan
 from datetime import datetime
 from random import shuffle
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import numpy as np
 
 
 # Represents a roadmap, has a set of Nodes and Links
 
 
-class Map:
+class Map(object):
     reasonable_nyc_bbox = (-74.05, 40.9, -73.85, 40.65)
     min_lat = float('inf')
     max_lat = float('-inf')
@@ -44,13 +63,156 @@ class Map:
         node, dist = self.lookup_kd_tree.nearest_neighbor_query(coordinates)
         return node
 
+    # Finds the k Nodes which are nearest to a given coordinate, for example to get
+    # several candidates for a GPS point that lies between two streets
+    # Params:
+    # lat - the query latitude
+    # lon - the query longitude
+    # k - the number of Nodes to find
+    # Returns:
+    # A list of Node objects, nearest first, and a list of their distances in meters.
+    # Both are empty if the point is outside of the Map
+    def get_nearest_nodes(self, lat, lon, k):
+        if(lat < self.min_lat or lat > self.max_lat or lon < self.min_lon
+           or lon > self.max_lon):
+            return [], []
+        coordinates = (lat * LAT_METERS, lon * LON_METERS)
+        nodes, squared_dists = self.lookup_kd_tree.k_nearest_query(coordinates, k)
+        return nodes, [dist ** .5 for dist in squared_dists]
+
+    # Finds all of the Nodes within some distance of a given coordinate
+    # Params:
+    # lat - the query latitude
+    # lon - the query longitude
+    # radius - the maximum distance, in meters
+    # Returns:
+    # A list of Node objects, nearest first, and a list of their distances in meters.
+    # Both are empty if the point is outside of the Map
+    def get_nodes_within(self, lat, lon, radius):
+        if(lat < self.min_lat or lat > self.max_lat or lon < self.min_lon
+           or lon > self.max_lon):
+            return [], []
+        coordinates = (lat * LAT_METERS, lon * LON_METERS)
+        nodes, squared_dists = self.lookup_kd_tree.radius_query(coordinates, radius)
+        return nodes, [dist ** .5 for dist in squared_dists]
+
+    # Returns the GridIndex of the Node locations, which is built on first use
+    def get_node_grid(self):
+        if(self.node_grid is None):
+            (x, y) = self.graph.get_node_locations()
+            self.node_grid = GridIndex(x, y)
+        return self.node_grid
+
+    # The indices of the coordinates that are inside of the Map's bounding box.  Points
+    # outside of it are never matched (see get_nearest_node()).
+    def get_points_inside(self, lats, lons):
+        return np.flatnonzero((lats >= self.min_lat) & (lats <= self.max_lat) &
+                              (lons >= self.min_lon) & (lons <= self.max_lon))
+
+    # Finds the nearest Node to many coordinates at once, with a GridIndex over the Node
+    # locations.  Gives the same Nodes as get_nearest_node(), except that ties are broken
+    # by the lowest node index.
+    # Params:
+        # lats - an array of query latitudes
+        # lons - an array of query longitudes
+        # max_snap_dist - points that are farther than this many meters from every Node
+            # are not matched
+    # Returns:
+        # node_indices - the index (into self.nodes) of the nearest Node of each point, or
+            # -1 if the point is outside of the Map's bounding box or too far from any Node
+        # snap_dists - the distance to that Node in meters, inf where node_indices is -1
+    def match_points(self, lats, lons, max_snap_dist=float('inf')):
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        inside = self.get_points_inside(lats, lons)
+        node_indices = np.repeat(np.int64(-1), len(lats))
+        snap_dists = np.repeat(np.inf, len(lats))
+        (node_indices[inside], snap_dists[inside]) = self.get_node_grid().nearest(
+            lats[inside] * LAT_METERS, lons[inside] * LON_METERS, max_snap_dist)
+        return node_indices, snap_dists
+
+    # Finds the k nearest Nodes to many coordinates at once (see GridIndex.k_nearest())
+    # Params:
+        # lats - an array of query latitudes
+        # lons - an array of query longitudes
+        # k - the number of candidate Nodes per point
+        # max_snap_dist - Nodes that are farther than this many meters are not returned
+    # Returns:
+        # node_indices - a (num_points x k) array of node indices, nearest first.  Padded
+            # with -1, and all -1 for points outside of the Map's bounding box
+        # snap_dists - the distances to those Nodes in meters, inf where node_indices is -1
+    def match_point_candidates(self, lats, lons, k, max_snap_dist=float('inf')):
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        inside = self.get_points_inside(lats, lons)
+        node_indices = np.empty((len(lats), k), dtype=np.int64)
+        node_indices.fill(-1)
+        snap_dists = np.empty((len(lats), k))
+        snap_dists.fill(np.inf)
+        (node_indices[inside], snap_dists[inside]) = self.get_node_grid().k_nearest(
+            lats[inside] * LAT_METERS, lons[inside] * LON_METERS, k, max_snap_dist)
+        return node_indices, snap_dists
+
+    # Finds all of the Nodes within some distance of many coordinates at once (see
+    # GridIndex.within())
+    # Params:
+        # lats - an array of query latitudes
+        # lons - an array of query longitudes
+        # radius - the maximum distance, in meters
+    # Returns:
+        # offsets - the Nodes of point i are at offsets[i]:offsets[i + 1] of the other
+            # two arrays.  Points outside of the Map's bounding box have none.
+        # node_indices - the node indices, nearest first within each point
+        # snap_dists - the distances to those Nodes in meters
+    def match_points_within(self, lats, lons, radius):
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        inside = self.get_points_inside(lats, lons)
+        (inside_offsets, node_indices, snap_dists) = self.get_node_grid().within(
+            lats[inside] * LAT_METERS, lons[inside] * LON_METERS, radius)
+        counts = np.zeros(len(lats), dtype=np.int64)
+        counts[inside] = np.diff(inside_offsets)
+        return np.concatenate(([0], np.cumsum(counts))), node_indices, snap_dists
+
     # Gets the region that a point is in geometrically
     # Params:
         # point - an array-like that contains coordinates(like a Node or tuple)
-    # Returns: The region, which is a leaf node of the region_kd_tree
+    # Returns: The region, which is the number of a leaf node of the region_kd_tree
     def get_region(self, point):
         return self.region_kd_tree.get_leaf(point)
 
+    # Returns a RegionRaster of the regions of this Map, for fast region lookups of many
+    # points.  It is only rebuilt after the regions change.  assign_node_regions() must
+    # be called first.
+    # Params:
+        # cell_size - the side of a raster cell, in meters
+    def get_region_raster(self, cell_size=25.0):
+        raster = self.region_raster
+        if(raster is None or raster.cell_size != cell_size):
+            tree = self.region_kd_tree
+            locations = np.array([node.location for node in self.nodes])
+            # The region of every leaf, from the regions of the nodes in it
+            region_of_leaf = np.repeat(np.int32(-1), len(tree.hi_child))
+            region_of_leaf[tree.get_leaves(locations)] = [node.region_id for node in self.nodes]
+            bounds = np.concatenate((locations.min(axis=0), locations.max(axis=0)))
+            raster = RegionRaster(tree.split_dim, tree.split_val, tree.hi_child,
+                                  region_of_leaf, bounds, cell_size)
+            self.region_raster = raster
+        return raster
+
+    # Finds the regions of many coordinates at once, the same way that
+    # assign_node_regions() finds the regions of the Nodes.  Points outside of the Map
+    # get the region of the nearest edge.
+    # Params:
+        # lats - an array of latitudes
+        # lons - an array of longitudes
+    # Returns:
+        # an array of region ids, -1 for points in a leaf without any nodes
+    def get_region_ids(self, lats, lons):
+        raster = self.get_region_raster()
+        return raster.get_region_ids(np.asarray(lats, dtype=np.float64) * LAT_METERS,
+                                     np.asarray(lons, dtype=np.float64) * LON_METERS)
+
     def get_all_nodes_in_region(self, region_id):
         set_of_nodes = set()
         for node in self.nodes:
@@ -69,21 +231,103 @@ class Map:
     # Assigns integer region_id numbers to every node in the graph
     # Regions are based on the rectangular leaf nodes of the region_kd_tree
 
+    # Clears the arc flags of every Link (see self.arc_flags)
     def assign_link_arc_flags(self):
-        for link in self.links:
-            link.forward_arc_flags_vector = np.repeat(
-                [False], self.total_region_count)
-            link.backward_arc_flags_vector = np.repeat(
-                [False], self.total_region_count)
+        self.arc_flags = PackedArcFlags(len(self.links), self.total_region_count)
+
+    # Computes the arc flags of every region on the array graph, and stores them in
+    # self.arc_flags (see ArcFlagLabels and PackedArcFlags).  Replaces the per-region
+    # DijkstrasAlgorithm searches.  assign_node_regions() must be called first.
+    # Params:
+        # method - "multi" or "single" (see ArcFlagLabels.region_arc_flags())
+        # pool - a multiprocessing Pool or an MPIPool (see mpi_parallel.mpipool).  If
+            # given, the regions are computed in parallel.  The workers attach to a shared
+            # snapshot of the graph (see get_shared_snapshot()), so they must be able to
+            # read its file.
+        # keep_slack - also keep the slack of every link and region, which is needed to
+            # update the flags later with update_arc_flags().  Takes 32 bits per flag.
+    # Returns:
+        # the PackedArcFlags
+    def compute_arc_flags(self, method="multi", pool=None, keep_slack=False):
+        self.copy_link_times_to_graph()
+        self.arc_flags = PackedArcFlags(len(self.links), self.total_region_count, keep_slack)
+        self.arc_flags.link_time = self.graph.link_time.copy()
+        self.compute_region_arc_flags(range(self.total_region_count), method, pool)
+        return self.arc_flags
+
+    # Updates self.arc_flags after link times have changed, by recomputing only the
+    # regions whose shortest path trees may have changed (see
+    # PackedArcFlags.find_affected_regions()).  The other regions keep their flags.  The
+    # flags must have been computed with keep_slack=True.
+    # Params:
+        # changed_links - the Links whose times changed.  If None, they are found by
+            # comparing the current times with the ones the flags were computed with.
+        # method, pool - see compute_arc_flags()
+    # Returns:
+        # a list of the region ids that were recomputed
+    def update_arc_flags(self, changed_links=None, method="multi", pool=None):
+        if(self.arc_flags is None):
+            raise Exception("Arc flags have not been computed for this map.")
+        self.copy_link_times_to_graph()
+        if(changed_links is not None):
+            changed_links = [link.link_id for link in changed_links]
+        region_ids = self.arc_flags.find_affected_regions(self.graph.link_time,
+                                                          changed_links)
+        region_ids = region_ids.tolist()
+        self.compute_region_arc_flags(region_ids, method, pool)
+
+        if(changed_links is None):
+            self.arc_flags.link_time = self.graph.link_time.copy()
+        else:
+            self.arc_flags.link_time[changed_links] = self.graph.link_time[changed_links]
+        return region_ids
+
+    # Recomputes the arc flags (and slack, if it is kept) of some regions in
+    # self.arc_flags, with the times in self.graph.  Helper for compute_arc_flags() and
+    # update_arc_flags().
+    # Params:
+        # region_ids - a list of region ids
+        # method, pool - see compute_arc_flags()
+    def compute_region_arc_flags(self, region_ids, method="multi", pool=None):
+        arc_flags = self.arc_flags
+        m = len(self.links)
+        with_slack = arc_flags.forward_slack is not None
+        if(pool is None):
+            results = (ArcFlagLabels.region_arc_flags(self.graph, region_id, method=method,
+                                                      with_slack=with_slack)
+                       for region_id in region_ids)
+            results = ((region_id, columns[0], columns[1], columns[2:])
+                       for (region_id, columns) in zip(region_ids, results))
+        else:
+            # One task per region, most expensive first, so that the cheap regions fill
+            # in the gaps at the end
+            graph_fn = self.get_shared_snapshot()
+            link_time = self.graph.link_time
+            sizes = ArcFlagLabels.count_boundary_nodes(self.graph, self.total_region_count)
+            region_ids = sorted(region_ids, key=lambda region_id: -sizes[region_id])
+            tasks = [(graph_fn, link_time, region_id, method, with_slack)
+                     for region_id in region_ids]
+            results = ((region_id, np.unpackbits(forward_bits)[:m].astype(bool),
+                        np.unpackbits(backward_bits)[:m].astype(bool), slack)
+                       for (region_id, forward_bits, backward_bits, slack) in pool.map(
+                           ArcFlagLabels.region_arc_flags_task, tasks))
+
+        for (region_id, forward_column, backward_column, slack) in results:
+            arc_flags.clear_region(region_id)
+            arc_flags.set_region(region_id, forward_column, backward_column)
+            if(with_slack):
+                arc_flags.forward_slack[:, region_id] = slack[0]
+                arc_flags.backward_slack[:, region_id] = slack[1]
 
     def assign_node_regions(self):
         print ("Region tree depth " + str(self.region_kd_tree.get_height()))
         region_id_lookup = {}
         next_region_id = 0
 
-        for node in self.nodes:
-            region = self.get_region(node)
-
+        # Find the leaves of all of the nodes at once
+        regions = self.region_kd_tree.get_leaves([node.location for node in self.nodes])
+        regions = regions.tolist()
+        for (node, region) in zip(self.nodes, regions):
             if(region not in region_id_lookup):
                 region_id_lookup[region] = next_region_id
                 next_region_id += 1
@@ -91,6 +335,12 @@ class Map:
             node.region_id = region_id_lookup[region]
 
         self.total_region_count = next_region_id
+        self.region_raster = None
+
+        if(self.graph is not None):
+            self.graph.node_region_id[:] = [node.region_id for node in self.nodes]
+        # Any shared snapshot has the old regions
+        self.shared_snapshot_fn = None
 
         for node in self.nodes:
             for connecting_link in node.forward_links:
@@ -287,6 +537,209 @@ class Map:
                     w.writerow(line)
                  
 
+    # Saves the Map into a single binary snapshot file (see routing/snapshot.py).
+    # This includes the pruned graph, all Node and Link properties, the region ids,
+    # and both KD trees.  Loading it with Map.load_snapshot() skips CSV parsing,
+    # SCC pruning, and KD tree construction.
+    # Params:
+        # filename - the file to write
+    def save_snapshot(self, filename):
+        nodes = self.nodes
+        links = self.links
+        arrays = self.graph.to_arrays(prefix="graph_")
+
+        # Properties of the Node and Link objects that are not part of the graph
+        arrays["node_is_complete"] = np.array([node.is_complete for node in nodes], dtype=bool)
+        arrays["node_is_boundary_node"] = np.array(
+            [node.is_boundary_node for node in nodes], dtype=bool)
+        arrays["node_osm_traffic_controller"] = np.array(
+            [node.osm_traffic_controller for node in nodes], dtype=str)
+        for name in ["osm_changeset", "birth_timestamp", "death_timestamp"]:
+            arrays["node_" + name] = np.array([getattr(node, name) for node in nodes],
+                                              dtype=np.int64)
+        for name in ["begin_angle", "end_angle"]:
+            arrays["link_" + name] = np.array([getattr(link, name) for link in links],
+                                              dtype=np.float64)
+        for name in ["osm_name", "osm_class"]:
+            arrays["link_" + name] = np.array([getattr(link, name) for link in links],
+                                              dtype=str)
+        for name in ["osm_way_id", "osm_changeset", "birth_timestamp", "death_timestamp"]:
+            arrays["link_" + name] = np.array([getattr(link, name) for link in links],
+                                              dtype=np.int64)
+
+        # The KD trees refer to Nodes by their index
+        index_of = lambda node: node.node_index
+        for tree_name in ["region_kd_tree", "lookup_kd_tree"]:
+            tree = getattr(self, tree_name)
+            if(tree is not None):
+                for name, arr in tree.to_arrays(index_of).items():
+                    arrays[tree_name + "_" + name] = arr
+
+        # Only the flags themselves - the slack is much larger, and is saved separately
+        # with PackedArcFlags.save() when it is needed
+        if(self.arc_flags is not None):
+            arrays["arc_flags_forward"] = self.arc_flags.forward
+            arrays["arc_flags_backward"] = self.arc_flags.backward
+
+        attrs = {"nodes_fn": self.nodes_fn,
+                 "links_fn": self.links_fn,
+                 "total_region_count": self.total_region_count,
+                 "region_kd_size": self.region_kd_size,
+                 "lookup_kd_size": self.lookup_kd_size,
+                 "min_lat": self.min_lat,
+                 "max_lat": self.max_lat,
+                 "min_lon": self.min_lon,
+                 "max_lon": self.max_lon}
+        snapshot.save_snapshot(filename, arrays, attrs)
+
+    # Loads a Map from a file that was written by Map.save_snapshot()
+    # Params:
+        # filename - the snapshot file
+        # mmap - if True, the graph arrays are memory-mapped read-only, so that many
+            # processes which load the same snapshot share one copy of them
+    # Returns:
+        # a new Map object
+    @staticmethod
+    def load_snapshot(filename, mmap=False):
+        arrays, attrs = snapshot.load_snapshot(filename, mmap=mmap)
+
+        road_map = Map.__new__(Map)
+        road_map.nodes_fn = attrs["nodes_fn"]
+        road_map.links_fn = attrs["links_fn"]
+        road_map.total_region_count = attrs["total_region_count"]
+        road_map.region_kd_size = attrs["region_kd_size"]
+        road_map.lookup_kd_size = attrs["lookup_kd_size"]
+        road_map.min_lat = attrs["min_lat"]
+        road_map.max_lat = attrs["max_lat"]
+        road_map.min_lon = attrs["min_lon"]
+        road_map.max_lon = attrs["max_lon"]
+        road_map.isFlat = False
+        road_map.shared_snapshot_fn = None
+        road_map.contraction_hierarchy = None
+        road_map.customizable_ch = None
+        road_map.landmarks = None
+        road_map.arc_flags = None
+        road_map.node_grid = None
+        road_map.region_raster = None
+
+        graph = ArrayGraph.from_arrays(arrays, prefix="graph_")
+        road_map.graph = graph
+
+        # Rebuild the Node objects
+        node_ids = graph.node_ids.tolist()
+        node_lat = graph.node_lat.tolist()
+        node_lon = graph.node_lon.tolist()
+        region_ids = graph.node_region_id.tolist()
+        is_complete = arrays["node_is_complete"].tolist()
+        if("node_is_boundary_node" in arrays):
+            is_boundary_node = arrays["node_is_boundary_node"].tolist()
+        else:
+            # Older snapshots - a node is a boundary node if it has a link to or from
+            # another region (see assign_node_regions())
+            is_boundary_node = np.zeros(graph.num_nodes, dtype=bool)
+            crossing = (graph.node_region_id[graph.link_origin] !=
+                        graph.node_region_id[graph.link_dest])
+            is_boundary_node[graph.link_origin[crossing]] = True
+            is_boundary_node[graph.link_dest[crossing]] = True
+            is_boundary_node = is_boundary_node.tolist()
+        traffic_controller = arrays["node_osm_traffic_controller"].tolist()
+        node_changeset = arrays["node_osm_changeset"].tolist()
+        node_birth = arrays["node_birth_timestamp"].tolist()
+        node_death = arrays["node_death_timestamp"].tolist()
+
+        road_map.nodes = []
+        road_map.nodes_by_id = {}
+        for i in xrange(graph.num_nodes):
+            node = Node(node_ids[i], node_lat[i], node_lon[i], region_ids[i])
+            node.is_complete = is_complete[i]
+            node.is_boundary_node = is_boundary_node[i]
+            node.osm_traffic_controller = traffic_controller[i]
+            node.osm_changeset = node_changeset[i]
+            node.birth_timestamp = node_birth[i]
+            node.death_timestamp = node_death[i]
+            node.region_id = region_ids[i]
+            node.node_index = i
+            road_map.nodes.append(node)
+            road_map.nodes_by_id[node.node_id] = node
+
+        # Rebuild the Link objects and the adjacency lists
+        link_origin = graph.link_origin.tolist()
+        link_dest = graph.link_dest.tolist()
+        link_length = graph.link_length.tolist()
+        link_time = graph.link_time.tolist()
+        link_num_trips = graph.link_num_trips.tolist()
+        begin_angle = arrays["link_begin_angle"].tolist()
+        end_angle = arrays["link_end_angle"].tolist()
+        osm_name = arrays["link_osm_name"].tolist()
+        osm_class = arrays["link_osm_class"].tolist()
+        osm_way_id = arrays["link_osm_way_id"].tolist()
+        link_changeset = arrays["link_osm_changeset"].tolist()
+        link_birth = arrays["link_birth_timestamp"].tolist()
+        link_death = arrays["link_death_timestamp"].tolist()
+
+        road_map.links = []
+        road_map.links_by_node_id = {}
+        for i in xrange(graph.num_links):
+            begin_node = road_map.nodes[link_origin[i]]
+            end_node = road_map.nodes[link_dest[i]]
+            link = Link(begin_node.node_id, end_node.node_id, link_length[i])
+            link.link_id = i
+            link.time = link_time[i]
+            link.num_trips = link_num_trips[i]
+            link.origin_node = begin_node
+            link.connecting_node = end_node
+            link.begin_angle = begin_angle[i]
+            link.end_angle = end_angle[i]
+            link.osm_name = osm_name[i]
+            link.osm_class = osm_class[i]
+            link.osm_way_id = osm_way_id[i]
+            link.osm_changeset = link_changeset[i]
+            link.birth_timestamp = link_birth[i]
+            link.death_timestamp = link_death[i]
+
+            begin_node.forward_links.append(link)
+            end_node.backward_links.append(link)
+            road_map.links.append(link)
+            road_map.links_by_node_id[begin_node.node_id, end_node.node_id] = link
+
+        # Rebuild the KD trees, or grow them if they were not saved
+        if("region_kd_tree_split_dim" in arrays):
+            for tree_name in ["region_kd_tree", "lookup_kd_tree"]:
+                tree_arrays = dict((name[len(tree_name) + 1:], arrays[name])
+                                   for name in arrays if name.startswith(tree_name + "_"))
+                setattr(road_map, tree_name, KDTree.from_arrays(tree_arrays, road_map.nodes))
+        else:
+            road_map.build_kd_trees()
+
+        # The arc flags stay memory-mapped if the snapshot is
+        if("arc_flags_forward" in arrays):
+            road_map.arc_flags = PackedArcFlags.from_arrays(
+                arrays, road_map.total_region_count, prefix="arc_flags_")
+
+        return road_map
+
+    # Writes a snapshot of this Map which worker processes can memory-map, either
+    # with Map.load_snapshot(filename, mmap=True) or ArrayGraph.attach_graph(filename).
+    # The file is written once, in shared memory (/dev/shm) if possible, and it is
+    # deleted when this process exits.  It is rewritten if the graph or the regions
+    # change, but not if the travel times change - those should be sent to the workers.
+    # Returns:
+        # the filename of the snapshot
+    def get_shared_snapshot(self):
+        if(self.shared_snapshot_fn is None):
+            if(os.path.isdir("/dev/shm")):
+                directory = "/dev/shm"
+            else:
+                directory = None
+            (fd, filename) = tempfile.mkstemp(prefix="taxisim_map_", suffix=".snapshot",
+                                              dir=directory)
+            os.close(fd)
+            self.copy_link_times_to_graph()
+            self.save_snapshot(filename)
+            atexit.register(os.remove, filename)
+            self.shared_snapshot_fn = filename
+        return self.shared_snapshot_fn
+
     # Saves the graph in METIS file format    
     def save_as_metis(self, filename):
         #First, re-index nodes to start with 1
@@ -372,6 +825,22 @@ class Map:
         self.links_by_node_id = {}
 
         self.total_region_count = 0
+
+        # The compact array representation of this Map (see build_graph())
+        self.graph = None
+        # A snapshot of this Map that worker processes can attach to (see get_shared_snapshot())
+        self.shared_snapshot_fn = None
+        # Speed up shortest path queries (see get_contraction_hierarchy() and
+        # get_customizable_ch() and get_landmarks())
+        self.contraction_hierarchy = None
+        self.customizable_ch = None
+        self.landmarks = None
+        # The arc flags of every Link and region (see compute_arc_flags())
+        self.arc_flags = None
+        # A grid of the Node locations, for snapping points in bulk (see match_points())
+        self.node_grid = None
+        # A raster of the region ids, for finding regions in bulk (see get_region_ids())
+        self.region_raster = None
         
         self.isFlat = False
         self.region_kd_size = region_kd_size
@@ -490,6 +959,9 @@ class Map:
             self.links[i].link_id = i
 
 
+        # Build the array representation of the graph
+        self.build_graph()
+
         # Clean the graph by removing extra SCCs
         self.remove_extra_sccs()
 
@@ -526,6 +998,10 @@ class Map:
         # Re-index the link ids, since we have shifted the list around
         for i in xrange(len(self.links)):
             self.links[i].link_id = i
+
+        # The node and link indices have changed, so the arrays must be rebuilt
+        if(self.graph is not None):
+            self.build_graph()
         
         
 
@@ -534,62 +1010,119 @@ class Map:
     # The largest strongly connected component is extracted from the raw graph,
     # and nodes/links in the remaining SCCs are deleted.
     def remove_extra_sccs(self):
-        # find strongly connected components
-        sccs = kosaraju(self.nodes)
-        
+        # find strongly connected components on the array graph
+        if(self.graph is None):
+            self.build_graph()
+        (scc_ids, num_sccs) = tarjan(self.graph)
+        if(num_sccs <= 1):
+            return
+
         # determine which scc is largest
-        largest_scc = []
-        for scc in sccs:
-            if(len(scc) > len(largest_scc)):
-                largest_scc = scc
-                
+        largest_scc = np.argmax(np.bincount(scc_ids, minlength=num_sccs))
+
         # find nodes in other small sccs
-        bad_nodes = set()
-        for scc in sccs:
-            if(scc!=largest_scc):
-                bad_nodes.update(scc)
-        
+        bad_nodes = [self.nodes[i] for i in np.flatnonzero(scc_ids != largest_scc)]
         self.delete_nodes(bad_nodes)
 
 
     # Builds KD trees to spatially index the nodes of the graph.  This makes
     # geographic queries much faster
     def build_kd_trees(self, split_weights = False):
+        self.region_raster = None
         # Finally, index nodes using KD Trees
         if split_weights == False:
             self.region_kd_tree = KDTree(self.nodes, leaf_size=self.region_kd_size)
         else:
             self.region_kd_tree = KDTree(self.nodes, leaf_size=self.region_kd_size, split_weights=True)
         self.lookup_kd_tree = KDTree(self.nodes, leaf_size=self.lookup_kd_size)
+
+    # Builds the compact ArrayGraph representation of this Map (self.graph).
+    # Node i of the graph is self.nodes[i] (and gets node.node_index = i), and link j
+    # of the graph is self.links[j].  Node and Link objects stay the main API for now,
+    # but code can work directly on the arrays using these shared indices.
+    def build_graph(self):
+        for i in xrange(len(self.nodes)):
+            self.nodes[i].node_index = i
+        self.graph = ArrayGraph.from_map(self)
+        # Any shared snapshot or hierarchy has the old indices
+        self.shared_snapshot_fn = None
+        self.contraction_hierarchy = None
+        self.customizable_ch = None
+        self.landmarks = None
+        self.arc_flags = None
+        self.node_grid = None
+
+    # Copies link.time and link.num_trips from the Link objects into self.graph.
+    # Should be called after the travel times on the Links have been modified.
+    def copy_link_times_to_graph(self):
+        m = len(self.links)
+        self.graph.link_time = np.fromiter(
+            (link.time for link in self.links), np.float64, m)
+        self.graph.link_num_trips = np.fromiter(
+            (link.num_trips for link in self.links), np.float64, m)
+
+    # Copies the travel times and trip counts from self.graph onto the Link objects.
+    # Should be called after the arrays have been modified.
+    def copy_graph_times_to_links(self):
+        times = self.graph.link_time.tolist()
+        num_trips = self.graph.link_num_trips.tolist()
+        for i in xrange(len(self.links)):
+            link = self.links[i]
+            link.time = times[i]
+            link.num_trips = num_trips[i]
     
     
     # Matches a list of Trips to their nearest intersections (Nodes) in this Map
     # Upon completion, each trip will have .origin_node and .dest_node attributes
     # For efficiency, duplicates (some orig/dest) are also removed - although the Trips
     # are edited "in place", this function still returns a subset of them.  The trip.dup_times
-    # attribute is set, which
+    # attribute is set, which holds the times of all of the duplicates.
+    # The trips are validated and snapped to Nodes in bulk (see TripBatch.get_error_codes()
+    # and match_points()).
     # Params:
-        # trips - a list of Trip objects to be map-matched
+        # trips - a list of Trip objects to be map-matched, or a TripBatch.  For a
+            # TripBatch, the matched nodes are also stored on the batch, and Trip
+            # objects are only created for the valid trips.
     def match_trips_to_nodes(self, trips):
-        trip_lookup = {} # lookup a trip by origin, destination nodes
-
-        #First find the nearest origin/destination nodes for each trip
-        #We will also find duplicate trips (same origin,destination nodes)
-        for trip in trips:
-            if(trip.isValid() == Trip.VALID):
-                trip.num_occurrences = 1
-                trip.origin_node = self.get_nearest_node(trip.fromLat, trip.fromLon)
-                trip.dest_node = self.get_nearest_node(trip.toLat, trip.toLon)
-
-                if((trip.origin_node, trip.dest_node) in trip_lookup):
-                    #Already seen this trip at least once
-                    trip_lookup[trip.origin_node, trip.dest_node].num_occurrences += 1
-                    trip_lookup[trip.origin_node, trip.dest_node].dup_times.append(trip.time)
-                    trip.dup_times = None
-                elif trip.origin_node !=None and trip.dest_node != None:
-                    #Never seen this trip before
-                    trip_lookup[trip.origin_node, trip.dest_node] = trip
-                    trip_lookup[trip.origin_node, trip.dest_node].dup_times = [trip.time]
+        if(isinstance(trips, TripBatch)):
+            valid = np.flatnonzero(trips.get_error_codes() == Trip.VALID)
+            (from_lats, from_lons) = (trips.fromLat[valid], trips.fromLon[valid])
+            (to_lats, to_lons) = (trips.toLat[valid], trips.toLon[valid])
+        else:
+            trips = [trip for trip in trips if(trip.isValid() == Trip.VALID)]
+            from_lats = np.array([trip.fromLat for trip in trips], dtype=np.float64)
+            from_lons = np.array([trip.fromLon for trip in trips], dtype=np.float64)
+            to_lats = np.array([trip.toLat for trip in trips], dtype=np.float64)
+            to_lons = np.array([trip.toLon for trip in trips], dtype=np.float64)
+
+        (origins, _) = self.match_points(from_lats, from_lons)
+        (dests, _) = self.match_points(to_lats, to_lons)
+
+        if(isinstance(trips, TripBatch)):
+            origin_node = np.repeat(np.int64(-1), len(trips))
+            dest_node = origin_node.copy()
+            origin_node[valid] = origins
+            dest_node[valid] = dests
+            trips.set_matched_nodes(origin_node, dest_node)
+            trips = trips.get_trips(self, valid)
+
+        trip_lookup = {} # lookup a trip by origin, destination node indices
+
+        #Find duplicate trips (same origin,destination nodes)
+        for (trip, origin, dest) in zip(trips, origins.tolist(), dests.tolist()):
+            trip.num_occurrences = 1
+            trip.origin_node = self.nodes[origin] if origin >= 0 else None
+            trip.dest_node = self.nodes[dest] if dest >= 0 else None
+
+            if((origin, dest) in trip_lookup):
+                #Already seen this trip at least once
+                trip_lookup[origin, dest].num_occurrences += 1
+                trip_lookup[origin, dest].dup_times.append(trip.time)
+                trip.dup_times = None
+            elif origin >= 0 and dest >= 0:
+                #Never seen this trip before
+                trip_lookup[origin, dest] = trip
+                trip_lookup[origin, dest].dup_times = [trip.time]
     
         
         #Make unique trips into a list and return
@@ -644,7 +1177,112 @@ class Map:
     
         self.build_kd_trees()
     
-    def routeTrips(self, trips, num_cpus = 1, max_speed=None, astar_used=False, arcflags_used=False):
+    # Returns a ContractionHierarchy for the current link travel times.  It is only
+    # rebuilt if the travel times have changed since the last call.
+    def get_contraction_hierarchy(self):
+        self.copy_link_times_to_graph()
+        ch = self.contraction_hierarchy
+        if(ch is None or not np.array_equal(ch.link_time, self.graph.link_time)):
+            ch = ContractionHierarchy(self.graph)
+            self.contraction_hierarchy = ch
+        return ch
+
+    # Returns a CustomizableCH which is customized for the current link travel times.
+    # The metric-independent part is only built once, and the (fast) customization is
+    # only repeated if the travel times have changed since the last call.
+    def get_customizable_ch(self):
+        self.copy_link_times_to_graph()
+        if(self.customizable_ch is None):
+            self.customizable_ch = CustomizableCH(self.graph)
+        cch = self.customizable_ch
+        if(cch.link_time is None or not np.array_equal(cch.link_time, self.graph.link_time)):
+            cch.customize(self.graph.link_time)
+        return cch
+
+    # Returns Landmarks (for the ALT heuristic) for the current link travel times.  The
+    # landmarks are only chosen once, and their tables are only recomputed if the travel
+    # times have changed since the last call.
+    # Params:
+        # num_landmarks - how many landmarks to choose
+        # method - "avoid" or "farthest" (see Landmarks)
+    def get_landmarks(self, num_landmarks=16, method="avoid"):
+        self.copy_link_times_to_graph()
+        lm = self.landmarks
+        if(lm is None or lm.method != method or
+                len(lm.landmarks) != min(num_landmarks, self.graph.num_nodes)):
+            lm = Landmarks(self.graph, num_landmarks, method)
+            self.landmarks = lm
+        elif(not np.array_equal(lm.link_time, self.graph.link_time)):
+            lm.recompute(self.graph.link_time)
+        return lm
+
+    # Finds the shortest path between two Nodes using a ContractionHierarchy
+    # Params:
+        # ch - a ContractionHierarchy or CustomizableCH, from get_contraction_hierarchy()
+            # or get_customizable_ch()
+        # origin_node - the Node at the beginning of the path
+        # dest_node - the Node at the end of the path
+    # Returns:
+        # path - a list of Links on the shortest path, in order, or None if no such path exists
+    def find_path_with_ch(self, ch, origin_node, dest_node):
+        (path, _) = ch.find_path(origin_node.node_index, dest_node.node_index)
+        if(path is None):
+            return None
+        return [self.links[link_id] for link_id in path]
+
+    # Computes the travel times between every origin and every destination.  This is
+    # much cheaper than routing every pair separately - with a contraction hierarchy,
+    # the bucket-based many-to-many algorithm is used, and otherwise one Dijkstra search
+    # is grown from each distinct origin until all of the destinations are reached.
+    # Params:
+        # origins - a list of Nodes (the rows)
+        # destinations - a list of Nodes (the columns)
+        # ch_used - use a ContractionHierarchy (see get_contraction_hierarchy())
+        # cch_used - use a CustomizableCH (see get_customizable_ch())
+    # Returns:
+        # a len(origins) x len(destinations) NumPy array of travel times, in seconds
+            # (inf where there is no path)
+    def travel_time_matrix(self, origins, destinations, ch_used=False, cch_used=False):
+        ch = None
+        if(cch_used):
+            ch = self.get_customizable_ch()
+        elif(ch_used):
+            ch = self.get_contraction_hierarchy()
+        else:
+            self.copy_link_times_to_graph()
+        origin_ids = [node.node_index for node in origins]
+        dest_ids = [node.node_index for node in destinations]
+        return TravelTimeMatrix.travel_time_matrix(self.graph, origin_ids, dest_ids, ch=ch)
+
+    def routeTrips(self, trips, num_cpus = 1, max_speed=None, astar_used=False, arcflags_used=False,
+                   ch_used=False, cch_used=False, alt_used=False):
+        if(ch_used or cch_used):
+            # Contraction Hierarchy queries are fast enough to run in this process
+            if(cch_used):
+                ch = self.get_customizable_ch()
+            else:
+                ch = self.get_contraction_hierarchy()
+            for trip in trips:
+                trip.path_links = self.find_path_with_ch(ch, trip.origin_node, trip.dest_node)
+            return
+
+        if(alt_used):
+            # Exact bidirectional A* with landmark lower bounds, on the array graph
+            landmark_bounds = self.get_landmarks().node_bounds
+            if(num_cpus <= 1):
+                for trip in trips:
+                    (path, _) = array_bidirectional_search(
+                        self.graph, trip.origin_node.node_index, trip.dest_node.node_index,
+                        landmark_bounds=landmark_bounds)
+                    if(path is not None):
+                        path = [self.links[link_id] for link_id in path]
+                    trip.path_links = path
+            else:
+                pool = Pool(num_cpus)
+                self.route_trips_with_pool(trips, pool, alt_used=True)
+                pool.terminate()
+            return
+
         if(max_speed==None):
             max_speed = self.get_max_speed()
         
@@ -653,8 +1291,196 @@ class Map:
             for trip in trips:
                 trip.path_links = bidirectional_search(trip.origin_node, trip.dest_node, use_astar=astar_used, use_arcflags=arcflags_used, max_speed=max_speed, curr_map=self)
         else:
+            # The workers only have the array graph, not the arc flags
+            if(arcflags_used):
+                raise Exception("Arc flags can only be used with num_cpus=1")
             #Use parallel processing - split the trips into chunks
-            pass
+            pool = Pool(num_cpus)
+            self.route_trips_with_pool(trips, pool, max_speed=max_speed, astar_used=astar_used)
+            pool.terminate()
+
+    # Routes many trips with a pool of threads, which all share this Map.  Every thread
+    # runs its searches in its own QueryContext, and the searches never modify the Nodes
+    # or Links, so any number of queries can run at once.  Because of the GIL, this
+    # mostly helps when routing is overlapped with I/O (for example database access).
+    # Params:
+        # trips - a list of Trips, which have already been matched to nodes
+        # num_threads - the number of threads to use
+        # max_speed - the maximum speed of any Link.  Will be computed if None
+        # astar_used - use the A* heuristic
+        # arcflags_used - use the ArcFlags
+    def route_trips_with_threads(self, trips, num_threads, max_speed=None, astar_used=False,
+                                 arcflags_used=False):
+        if(max_speed==None):
+            max_speed = self.get_max_speed()
+
+        def route_trip(trip):
+            trip.path_links = bidirectional_search(trip.origin_node, trip.dest_node,
+                                                   use_astar=astar_used,
+                                                   use_arcflags=arcflags_used,
+                                                   max_speed=max_speed, curr_map=self)
+        pool = ThreadPool(num_threads)
+        pool.map(route_trip, trips)
+        pool.terminate()
+
+    # Routes many trips in parallel with a Pool of worker processes.  The workers attach
+    # to a shared, memory-mapped snapshot of the graph (see get_shared_snapshot()), so the
+    # Map is never pickled.  Each worker only receives the current link travel times and
+    # the origin/destination node indices of its chunk of trips.
+    # Params:
+        # trips - a list of Trips, which have already been matched to nodes
+        # pool - a multiprocessing Pool
+        # max_speed - the maximum speed of any Link.  Will be computed if None
+        # astar_used - use the A* heuristic
+        # alt_used - use the exact landmark heuristic instead (see get_landmarks())
+    def route_trips_with_pool(self, trips, pool, max_speed=None, astar_used=False, alt_used=False):
+        if(max_speed==None and not alt_used):
+            max_speed = self.get_max_speed()
+        graph_fn = self.get_shared_snapshot()
+        landmark_bounds = None
+        if(alt_used):
+            landmark_bounds = self.get_landmarks().node_bounds
+        self.copy_link_times_to_graph()
+        link_time = self.graph.link_time
+
+        # One chunk per CPU
+        chunks = []
+        num_chunks = pool._processes
+        for i in range(num_chunks):
+            lo = len(trips) * i // num_chunks
+            hi = len(trips) * (i + 1) // num_chunks
+            origins = [trip.origin_node.node_index for trip in trips[lo:hi]]
+            dests = [trip.dest_node.node_index for trip in trips[lo:hi]]
+            chunks.append((graph_fn, link_time, origins, dests, astar_used, max_speed,
+                           landmark_bounds))
+
+        # The workers return link indices, which are also indices into self.links
+        i = 0
+        for paths in pool.map(route_chunk, chunks):
+            for path in paths:
+                if(path is None):
+                    trips[i].path_links = None
+                else:
+                    trips[i].path_links = [self.links[link_id] for link_id in path]
+                i += 1
+
+    # Routes many trips by grouping them by origin Node.  All of the trips from one origin
+    # are routed with a single shortest path tree, which is grown until all of their
+    # destinations are settled (see ArraySearch.route_from_origin()).
+    # Params:
+        # trips - a list of Trips, which have already been matched to nodes
+        # pool - a multiprocessing Pool.  If given, the origin groups are split among the
+            # worker processes, which attach to a shared snapshot of the graph
+        # max_speed - the maximum speed of any Link.  Will be computed if None
+        # astar_used - use the A* heuristic for origins with a single destination
+    def route_trips_by_origin(self, trips, pool=None, max_speed=None, astar_used=False):
+        if(max_speed==None):
+            max_speed = self.get_max_speed()
+        self.copy_link_times_to_graph()
+        link_time = self.graph.link_time
+
+        trips_by_origin = {}
+        for trip in trips:
+            trips_by_origin.setdefault(trip.origin_node.node_index, []).append(trip)
+        groups = [(origin, [trip.dest_node.node_index for trip in origin_trips])
+                  for (origin, origin_trips) in trips_by_origin.iteritems()]
+
+        if(pool is None):
+            group_paths = [route_from_origin(self.graph, origin, dests, link_time,
+                                             astar_used, max_speed)
+                           for (origin, dests) in groups]
+        else:
+            # One chunk per CPU, with roughly the same number of trips in each
+            graph_fn = self.get_shared_snapshot()
+            chunks = []
+            num_chunks = pool._processes
+            lo = 0
+            trips_so_far = 0
+            for i in range(num_chunks):
+                hi = lo
+                while(hi < len(groups) and
+                        trips_so_far < len(trips) * (i + 1) // num_chunks):
+                    trips_so_far += len(groups[hi][1])
+                    hi += 1
+                chunks.append((graph_fn, link_time, groups[lo:hi], astar_used, max_speed))
+                lo = hi
+            group_paths = [paths for chunk_paths in pool.map(route_origin_chunk, chunks)
+                           for paths in chunk_paths]
+
+        # The paths are link indices, which are also indices into self.links
+        for ((origin, _), paths) in zip(groups, group_paths):
+            for (trip, path) in zip(trips_by_origin[origin], paths):
+                if(path is None):
+                    trip.path_links = None
+                else:
+                    trip.path_links = [self.links[link_id] for link_id in path]
+
+    # Routes many trips from their raw coordinates, with several candidate Nodes at each
+    # end instead of only the nearest one.  The candidates are found in bulk (see
+    # match_point_candidates()), and each trip is routed with a single search which
+    # starts from all of its origin candidates and ends at all of its destination
+    # candidates (see ArraySearch.candidate_search()).  The distance from the GPS point to
+    # each candidate is converted to a head start time, so a slightly farther Node on
+    # the right street beats the nearest Node on the wrong one.  The matched Nodes and
+    # the path are stored on each Trip.
+    # Params:
+        # trips - a list of Trips
+        # k - the number of candidate Nodes at each end
+        # max_snap_dist - candidates farther than this many meters are not used
+        # snap_speed - the speed (meters per second) used to convert snap distances to
+            # times.  Defaults to the median speed of the Links.
+        # astar_used - use the A* heuristic
+        # alt_used - use the exact landmark heuristic instead (see get_landmarks())
+        # max_speed - the maximum speed of any Link.  Will be computed if None
+    # Returns:
+        # an array with the estimated time of every trip, including the snap times (inf
+            # for trips that could not be matched or routed)
+    def route_trips_with_candidates(self, trips, k=4, max_snap_dist=float('inf'),
+                                    snap_speed=None, astar_used=False, alt_used=False,
+                                    max_speed=None):
+        self.copy_link_times_to_graph()
+        link_time = self.graph.link_time
+        if(snap_speed is None):
+            moving = link_time > 0
+            snap_speed = np.median(self.graph.link_length[moving] / link_time[moving])
+        if(max_speed is None and astar_used and not alt_used):
+            max_speed = self.get_max_speed()
+        landmark_bounds = None
+        if(alt_used):
+            landmark_bounds = self.get_landmarks().node_bounds
+
+        from_lats = np.array([trip.fromLat for trip in trips], dtype=np.float64)
+        from_lons = np.array([trip.fromLon for trip in trips], dtype=np.float64)
+        to_lats = np.array([trip.toLat for trip in trips], dtype=np.float64)
+        to_lons = np.array([trip.toLon for trip in trips], dtype=np.float64)
+        (origins, origin_dists) = self.match_point_candidates(from_lats, from_lons, k,
+                                                              max_snap_dist)
+        (dests, dest_dists) = self.match_point_candidates(to_lats, to_lons, k,
+                                                          max_snap_dist)
+        origin_times = origin_dists / snap_speed
+        dest_times = dest_dists / snap_speed
+
+        estimates = np.repeat(np.inf, len(trips))
+        for (i, trip) in enumerate(trips):
+            found_origins = origins[i] >= 0
+            found_dests = dests[i] >= 0
+            (path, origin, dest) = (None, -1, -1)
+            if(found_origins.any() and found_dests.any()):
+                (path, origin, dest, _) = candidate_search(
+                    self.graph, origins[i][found_origins].tolist(),
+                    origin_times[i][found_origins], dests[i][found_dests].tolist(),
+                    dest_times[i][found_dests], link_time, astar_used, max_speed,
+                    landmark_bounds)
+
+            if(path is None):
+                (trip.origin_node, trip.dest_node, trip.path_links) = (None, None, None)
+                continue
+            trip.origin_node = self.nodes[origin]
+            trip.dest_node = self.nodes[dest]
+            trip.path_links = [self.links[link_id] for link_id in path]
+            estimates[i] = (origin_times[i][origins[i] == origin][0] + link_time[path].sum() +
+                            dest_times[i][dests[i] == dest][0])
+        return estimates
 
 # A simple test that tries various leaf_sizes for the lookup_kd_tree
 # Turns out smaller is always better
@@ -758,6 +1584,24 @@ def test_flatten():
     d4 = datetime.now()
     print(d4 - d3)
 
+# Compares the time to build a Map from CSV files with the time to load it from a snapshot
+def test_snapshot():
+    print("Loading from CSV")
+    d1 = datetime.now()
+    nyc_map = Map("nyc_map4/nodes.csv", "nyc_map4/links.csv")
+    d2 = datetime.now()
+    print(d2 - d1)
+    print("Saving snapshot")
+    nyc_map.save_snapshot("nyc_map4/map.snapshot")
+    d3 = datetime.now()
+    print(d3 - d2)
+    print("Loading from snapshot")
+    snap_map = Map.load_snapshot("nyc_map4/map.snapshot")
+    d4 = datetime.now()
+    print(d4 - d3)
+    print("Same nodes : " + str([node.node_id for node in nyc_map.nodes] ==
+                                [node.node_id for node in snap_map.nodes]))
+
 # memory usage of this process in MB
 def getmem():
     import resource
@@ -74,7 +74,8 @@ class Node:
         #  Used at query time                                #
         ######################################################
 
-        self.reset()
+        # The state of shortest path searches is not stored on the Node (see
+        # BiDirectionalSearch.SearchState)
 
         # Checks if the node is currently in the queue (won't add otherwise)
         # self.in_queue = False
@@ -86,6 +87,10 @@ class Node:
         # Identifies which region this node belongs to
         self.region_id = -1
 
+        # Position of this node in Map.nodes, which is also its index in the
+        # Map's ArrayGraph (set by Map.build_graph())
+        self.node_index = -1
+
     # Used for the KD-tree - the node can be used as an array-like object
     def __getitem__(self, x):
         return self.location[x]
@@ -94,19 +99,6 @@ class Node:
     def __len__(self):
         return 2
 
-    def reset(self):
-        self.forward_predecessor_link = None  # For the forward search
-        self.backward_predecessor_link = None  # For the backward search
-
-        # Shows how far this node is from the origin and destination
-        # Time from the origin (forward search)
-        self.forward_time = float('Inf')
-        # Time to the destination (backward search)
-        self.backward_time = float('Inf')
-
-        self.was_forward_expanded = False
-        self.was_backward_expanded = False
-
     def approx_dist_to(self, other_node):
         return approx_distance(
             self.lat,
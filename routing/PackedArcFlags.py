@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Packed bit matrices of arc flags, owned by the Map (see Map.arc_flags).
+
+Link i has one row of bits in each matrix, with one bit per region, packed in the
+order of np.packbits() - region r is bit (0x80 >> (r % 8)) of byte r // 8.  This takes
+one bit per flag instead of one byte plus two NumPy objects per Link, and checking a
+flag during a search is a single byte lookup and mask.
+
+To update the flags incrementally when link times change (see Map.update_arc_flags()),
+the slack of every link and region can be kept as well (see ArcFlagLabels.link_slack()).
+A link whose time changes without crossing its slack for a region cannot change that
+region's shortest path trees, so the region keeps its flags.
+
+The matrices are plain contiguous arrays, so they are written to disk and read back
+(or memory-mapped) without any conversion (see save() and load()), and the database
+stores them as bytea blobs (see db_functions/db_arc_flags).
+"""
+import numpy as np
+import snapshot
+
+# Slack comparisons allow this much relative error, since the slack is stored in single
+# precision.  Any link within it is treated as tight, which only costs extra updates.
+SLACK_TOLERANCE = 1e-5
+
+
+# Arc flags for every Link and region.
+# Attributes:
+    # num_links - the number of links (rows)
+    # num_regions - the number of regions (bits per row)
+    # forward - a (num_links x num_bytes) uint8 array.  The forward flag of a link for
+        # region r is set if the link is on a shortest path into region r.
+    # backward - the same for the backward flags, which are set if the link is on a
+        # shortest path out of region r
+    # link_time - the travel times that the flags were computed with, or None
+    # forward_slack - a (num_links x num_regions) float32 array, with the slack of every
+        # link in the trees into every region, or None if it was not kept
+    # backward_slack - the same for the trees out of every region
+class PackedArcFlags(object):
+
+    # Creates empty flags
+    # Params:
+        # num_links - the number of links
+        # num_regions - the number of regions
+        # keep_slack - also allocate the slack matrices
+    def __init__(self, num_links, num_regions, keep_slack=False):
+        self.num_links = num_links
+        self.num_regions = num_regions
+        num_bytes = (num_regions + 7) // 8
+        self.forward = np.zeros((num_links, num_bytes), dtype=np.uint8)
+        self.backward = np.zeros((num_links, num_bytes), dtype=np.uint8)
+        self.link_time = None
+        self.forward_slack = None
+        self.backward_slack = None
+        if(keep_slack):
+            self.forward_slack = np.empty((num_links, num_regions), dtype=np.float32)
+            self.forward_slack.fill(-np.inf)
+            self.backward_slack = self.forward_slack.copy()
+
+    # Packs boolean flag matrices
+    # Params:
+        # forward - a (num_links x num_regions) boolean array
+        # backward - the same for the backward flags
+    # Returns:
+        # a new PackedArcFlags
+    @staticmethod
+    def from_bool(forward, backward):
+        (num_links, num_regions) = forward.shape
+        arc_flags = PackedArcFlags(num_links, num_regions)
+        arc_flags.forward = np.packbits(forward, axis=1)
+        arc_flags.backward = np.packbits(backward, axis=1)
+        return arc_flags
+
+    # Unpacks the flags into boolean matrices
+    # Returns:
+        # forward - a (num_links x num_regions) boolean array
+        # backward - the same for the backward flags
+    def to_bool(self):
+        forward = np.unpackbits(self.forward, axis=1)[:, :self.num_regions].astype(bool)
+        backward = np.unpackbits(self.backward, axis=1)[:, :self.num_regions].astype(bool)
+        return forward, backward
+
+    # Gets the bits of one region, for fast lookups during a search.  The flag of link i
+    # is set if column[i] & mask is nonzero.
+    # Params:
+        # region_id - the region
+        # backward - use the backward flags instead of the forward flags
+    # Returns:
+        # column - a (strided, not copied) view of the byte that holds the region's bit,
+            # one entry per link
+        # mask - the bit of the region within that byte
+    def get_column(self, region_id, backward=False):
+        flags = self.backward if backward else self.forward
+        return flags[:, region_id >> 3], 0x80 >> (region_id & 7)
+
+    # Checks one flag
+    # Params:
+        # link_id - the link index
+        # region_id - the region
+        # backward - check the backward flag instead of the forward flag
+    def get_flag(self, link_id, region_id, backward=False):
+        flags = self.backward if backward else self.forward
+        return bool(flags[link_id, region_id >> 3] & (0x80 >> (region_id & 7)))
+
+    # Sets one flag
+    # Params:
+        # link_id - the link index
+        # region_id - the region
+        # backward - set the backward flag instead of the forward flag
+    def set_flag(self, link_id, region_id, backward=False):
+        flags = self.backward if backward else self.forward
+        flags[link_id, region_id >> 3] |= 0x80 >> (region_id & 7)
+
+    # Sets the flags of every link for one region.  Flags which are already set stay set.
+    # Params:
+        # region_id - the region
+        # forward_column - a boolean array with one entry per link
+        # backward_column - the same for the backward flags
+    def set_region(self, region_id, forward_column, backward_column):
+        mask = np.uint8(0x80 >> (region_id & 7))
+        self.forward[forward_column, region_id >> 3] |= mask
+        self.backward[backward_column, region_id >> 3] |= mask
+
+    # Clears the flags of every link for one region
+    # Params:
+        # region_id - the region
+    def clear_region(self, region_id):
+        mask = np.uint8(0xff ^ (0x80 >> (region_id & 7)))
+        self.forward[:, region_id >> 3] &= mask
+        self.backward[:, region_id >> 3] &= mask
+
+    # Finds the regions whose shortest path trees may change when link times change.
+    # A link that gets slower matters to the regions where it was tight (it may be on a
+    # tree), and a link that gets faster matters to the regions where it becomes tight
+    # (it may join a tree).  Links whose time is not positive are ignored by the
+    # preprocessing, so they count as infinitely slow.
+    # Params:
+        # link_time - the new travel time of every link
+        # changed_links - the indices of the links whose times changed.  If None, they
+            # are found by comparing link_time with self.link_time
+    # Returns:
+        # a sorted array of region ids
+    def find_affected_regions(self, link_time, changed_links=None):
+        if(self.forward_slack is None or self.link_time is None):
+            raise Exception("The arc flags were computed without keep_slack, so they can "
+                            "not be updated incrementally.")
+        link_time = np.asarray(link_time, dtype=np.float64)
+        if(changed_links is None):
+            changed_links = np.flatnonzero(link_time != self.link_time)
+        changed_links = np.asarray(changed_links, dtype=np.int64)
+
+        old_time = self.link_time[changed_links]
+        old_time = np.where(old_time > 0, old_time, np.inf)[:, np.newaxis]
+        new_time = link_time[changed_links]
+        new_time = np.where(new_time > 0, new_time, np.inf)[:, np.newaxis]
+        tolerance = SLACK_TOLERANCE * np.minimum(old_time, new_time)
+
+        affected = np.zeros(self.num_regions, dtype=bool)
+        for slack in (self.forward_slack, self.backward_slack):
+            slack = slack[changed_links]
+            affected |= ((new_time > old_time) & (old_time <= slack + tolerance)).any(axis=0)
+            affected |= ((new_time < old_time) & (new_time <= slack + tolerance)).any(axis=0)
+        return np.flatnonzero(affected)
+
+    # The memory used by the flag and slack matrices, in bytes
+    def get_memory_usage(self):
+        total = self.forward.nbytes + self.backward.nbytes
+        if(self.forward_slack is not None):
+            total += self.forward_slack.nbytes + self.backward_slack.nbytes
+        return total
+
+    # Gets the arrays which store the flags, for saving in a snapshot
+    # Params:
+        # prefix - prepended to every array name
+    # Returns:
+        # a dictionary which maps names to arrays
+    def to_arrays(self, prefix=""):
+        arrays = {prefix + "forward": self.forward, prefix + "backward": self.backward}
+        for name in ["link_time", "forward_slack", "backward_slack"]:
+            if(getattr(self, name) is not None):
+                arrays[prefix + name] = getattr(self, name)
+        return arrays
+
+    # Rebuilds flags from the arrays returned by to_arrays().  The arrays are used as-is,
+    # so memory-mapped arrays stay memory-mapped.
+    # Params:
+        # arrays - a dictionary which maps names to arrays
+        # num_regions - the number of regions
+        # prefix - the prefix that was given to to_arrays()
+    # Returns:
+        # a new PackedArcFlags
+    @staticmethod
+    def from_arrays(arrays, num_regions, prefix=""):
+        arc_flags = PackedArcFlags.__new__(PackedArcFlags)
+        arc_flags.forward = arrays[prefix + "forward"]
+        arc_flags.backward = arrays[prefix + "backward"]
+        arc_flags.num_links = len(arc_flags.forward)
+        arc_flags.num_regions = num_regions
+        for name in ["link_time", "forward_slack", "backward_slack"]:
+            setattr(arc_flags, name, arrays.get(prefix + name))
+        return arc_flags
+
+    # Writes the flags into a snapshot file (see routing/snapshot.py)
+    # Params:
+        # filename - the file to write
+    def save(self, filename):
+        snapshot.save_snapshot(filename, self.to_arrays(), {"num_regions": self.num_regions})
+
+    # Loads flags which were written by save()
+    # Params:
+        # filename - the file to read
+        # mmap - if True, the matrices are memory-mapped read-only instead of read
+    # Returns:
+        # a new PackedArcFlags
+    @staticmethod
+    def load(filename, mmap=False):
+        (arrays, attrs) = snapshot.load_snapshot(filename, mmap=mmap)
+        return PackedArcFlags.from_arrays(arrays, attrs["num_regions"])
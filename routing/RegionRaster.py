@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+A fine raster over the Map which stores the region id of every cell, so that the
+regions of many points can be found with one array lookup instead of one walk down
+the region KD-tree per point (see Map.get_region_ids()).
+
+The regions are the leaves of the region KD-tree, which are axis-aligned rectangles.
+A cell gets a region id only if it is entirely inside one of those rectangles (with
+a small margin for rounding).  Cells that a split line goes through are marked as
+mixed, and points that fall in them, or outside of the raster, are looked up exactly
+with the split arrays of the tree.
+"""
+import numpy as np
+import snapshot
+from KDTree import find_leaves
+
+# The cell value of cells that are split between several regions
+MIXED_CELL = -2
+
+
+class RegionRaster(object):
+
+    # Builds the raster
+    # Params:
+        # split_dim, split_val, hi_child - the arrays of the region KDTree.  The points
+            # are (latitude, longitude) in meters, like Node.location.
+        # region_of_leaf - the region id of every tree node (-1 for internal nodes and
+            # leaves without a region)
+        # bounds - (min_x, min_y, max_x, max_y), the area to cover, in meters
+        # cell_size - the side of a cell, in meters
+    def __init__(self, split_dim, split_val, hi_child, region_of_leaf, bounds,
+                 cell_size=25.0):
+        self.split_dim = np.asarray(split_dim)
+        self.split_val = np.asarray(split_val, dtype=np.float64)
+        self.hi_child = np.asarray(hi_child)
+        self.region_of_leaf = np.asarray(region_of_leaf, dtype=np.int32)
+        (self.min_x, self.min_y, max_x, max_y) = [float(b) for b in bounds]
+        self.cell_size = float(cell_size)
+        self.num_x = int((max_x - self.min_x) / self.cell_size) + 1
+        self.num_y = int((max_y - self.min_y) / self.cell_size) + 1
+
+        dtype = np.int16 if self.region_of_leaf.max() < 2 ** 15 else np.int32
+        self.cells = np.empty((self.num_x, self.num_y), dtype=dtype)
+        self.cells.fill(MIXED_CELL)
+
+        # Fill in the cells that are entirely inside of each leaf's rectangle.  The
+        # margin keeps cells that only touch a split line (up to rounding) mixed.
+        margin = 1e-6 * self.cell_size
+        for (leaf, (x_lo, y_lo, x_hi, y_hi)) in self.get_leaf_rectangles():
+            # The first cell that starts after the low edge, and the first cell that
+            # ends after the high edge
+            (i_lo, j_lo) = np.ceil((np.array([x_lo, y_lo]) + margin -
+                                    (self.min_x, self.min_y)) / self.cell_size)
+            (i_hi, j_hi) = np.floor((np.array([x_hi, y_hi]) - margin -
+                                     (self.min_x, self.min_y)) / self.cell_size)
+            (i_lo, i_hi) = np.clip((i_lo, i_hi), 0, self.num_x).astype(int)
+            (j_lo, j_hi) = np.clip((j_lo, j_hi), 0, self.num_y).astype(int)
+            if(i_lo < i_hi and j_lo < j_hi):
+                self.cells[i_lo:i_hi, j_lo:j_hi] = self.region_of_leaf[leaf]
+
+    # Finds the rectangle covered by every leaf, by passing the bounds down the tree
+    # Returns:
+        # a list of (leaf, (x_lo, y_lo, x_hi, y_hi)).  Outer leaves extend to infinity.
+    def get_leaf_rectangles(self):
+        inf = float('inf')
+        rectangles = []
+        stack = [(0, [-inf, -inf], [inf, inf])]
+        while(len(stack) > 0):
+            (i, low, high) = stack.pop()
+            if(self.hi_child[i] < 0):
+                rectangles.append((i, (low[0], low[1], high[0], high[1])))
+                continue
+            dim = self.split_dim[i]
+            # Points below the split value go to the low child (see KDTree.get_leaf())
+            low_high = list(high)
+            low_high[dim] = min(high[dim], self.split_val[i])
+            high_low = list(low)
+            high_low[dim] = max(low[dim], self.split_val[i])
+            stack.append((i + 1, low, low_high))
+            stack.append((self.hi_child[i], high_low, high))
+        return rectangles
+
+    # Finds the regions of many points
+    # Params:
+        # x, y - arrays of coordinates in meters, like Node.location
+    # Returns:
+        # an int32 array with the region id of every point, -1 if its leaf has no region
+    def get_region_ids(self, x, y):
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        cx = np.floor((x - self.min_x) / self.cell_size)
+        cy = np.floor((y - self.min_y) / self.cell_size)
+        inside = (cx >= 0) & (cx < self.num_x) & (cy >= 0) & (cy < self.num_y)
+        region_ids = np.empty(len(x), dtype=np.int32)
+        region_ids.fill(MIXED_CELL)
+        region_ids[inside] = self.cells[cx[inside].astype(np.int64),
+                                        cy[inside].astype(np.int64)]
+
+        # Exact lookups for the rest
+        exact = np.flatnonzero(region_ids == MIXED_CELL)
+        if(len(exact) > 0):
+            leaves = find_leaves(self.split_dim, self.split_val, self.hi_child,
+                                 np.column_stack((x[exact], y[exact])))
+            region_ids[exact] = self.region_of_leaf[leaves]
+        return region_ids
+
+    # Returns the fraction of cells that need an exact lookup
+    def get_mixed_fraction(self):
+        return np.mean(self.cells == MIXED_CELL)
+
+    # Writes the raster, with the tree arrays that it needs for exact lookups, into a
+    # snapshot file (see snapshot.save_snapshot()).  It can be used without the Map.
+    # Params:
+        # filename - the file to write
+    def save(self, filename):
+        arrays = {"split_dim": self.split_dim, "split_val": self.split_val,
+                  "hi_child": self.hi_child, "region_of_leaf": self.region_of_leaf,
+                  "cells": self.cells}
+        attrs = {"min_x": self.min_x, "min_y": self.min_y, "cell_size": self.cell_size}
+        snapshot.save_snapshot(filename, arrays, attrs)
+
+    # Loads a raster which was written by save()
+    # Params:
+        # filename - the file to read
+        # mmap - if True, the cells are memory-mapped read-only instead of read
+    # Returns:
+        # a new RegionRaster
+    @staticmethod
+    def load(filename, mmap=False):
+        (arrays, attrs) = snapshot.load_snapshot(filename, mmap=mmap)
+        raster = RegionRaster.__new__(RegionRaster)
+        raster.split_dim = arrays["split_dim"]
+        raster.split_val = arrays["split_val"]
+        raster.hi_child = arrays["hi_child"]
+        raster.region_of_leaf = arrays["region_of_leaf"]
+        raster.cells = arrays["cells"]
+        (raster.num_x, raster.num_y) = raster.cells.shape
+        raster.min_x = attrs["min_x"]
+        raster.min_y = attrs["min_y"]
+        raster.cell_size = attrs["cell_size"]
+        return raster
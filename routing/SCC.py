@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 """
 Methods for finding the strongly-connected-components of a graph stored in a Map object.
+kosaraju() works on the Node objects, and tarjan() works on the compact ArrayGraph
+in linear time.
 Created on Wed Jan 28 16:00:30 2015
 
 @author: brian
@@ -8,6 +10,7 @@ Created on Wed Jan 28 16:00:30 2015
 import Map
 from datetime import datetime
 import csv
+import numpy as np
 
 # Helper method which performs depth-first search and returns nodes in their expanded order
 # Params:
@@ -15,11 +18,14 @@ import csv
     # forward - If True, will search on the forward graph, if False, will search
         # on the backward garph
     # visited_set - A set of nodes which have already been visited.  Nodes in this
-    # set will be ignored.  Nodes will be added to this set as they are discovered
+    # set will be ignored.  Nodes will be added to this set as they are discovered.
+    # A new set is used if None
 # Returns: A list of nodes in the order that they FINISH.  A node is only finished
     # once all of its children in the search tree are finished.  So the start_node
     # will be the last to finish
-def dfs(start_node, forward=True, visited_set = set()):
+def dfs(start_node, forward=True, visited_set = None):
+    if(visited_set is None):
+        visited_set = set()
 
     # The stack of nodes to expand, used for DFS
     stack = [start_node]
@@ -94,17 +100,92 @@ def kosaraju(nodes):
     discovered_nodes = set()
     for node in ordered_nodes:
         if node not in discovered_nodes:
-            # The DFS returns a strongly connected component
-            scc = dfs(node, forward=False, visited_set = set(discovered_nodes))
-            
-            # But this SCC will be ignored in subsequent calls
-            discovered_nodes.update(scc)
+            # The DFS returns a strongly connected component.  It adds the SCC to
+            # discovered_nodes, so it will be ignored in subsequent calls
+            scc = dfs(node, forward=False, visited_set = discovered_nodes)
             
             # Add the SCC to the output list
             scc_list.append(scc)
     
     return scc_list
 
+
+# Finds the strongly connected components of an ArrayGraph, using an iterative version
+# of Tarjan's Algorithm.  Every node and link is visited once, so it runs in linear
+# time.  The recursion is replaced by an explicit stack of (node, position in its CSR
+# row), so a node's links are never re-scanned.
+# Params:
+    # graph - an ArrayGraph
+# Returns:
+    # scc_ids - an int32 array with the SCC number of every node index.  SCCs are
+        # numbered in the order that they are completed, which is a reverse topological
+        # order of the SCCs
+    # num_sccs - the number of SCCs
+def tarjan(graph):
+    offsets = graph.forward_offsets.tolist()
+    neighbors = graph.forward_neighbors.tolist()
+    num_nodes = graph.num_nodes
+
+    # The order in which each node was discovered, and the smallest discovery order
+    # that it can reach among the nodes on the SCC stack
+    order = [-1] * num_nodes
+    low = [0] * num_nodes
+    on_stack = [False] * num_nodes
+    scc_ids = [-1] * num_nodes
+    scc_stack = []
+    num_discovered = 0
+    num_sccs = 0
+
+    for root in xrange(num_nodes):
+        if(order[root] >= 0):
+            continue
+        order[root] = low[root] = num_discovered
+        num_discovered += 1
+        scc_stack.append(root)
+        on_stack[root] = True
+        call_stack = [(root, offsets[root])]
+
+        while(len(call_stack) > 0):
+            (node, pos) = call_stack[-1]
+            end = offsets[node + 1]
+            # Scan the remaining links of the node until an undiscovered neighbor is found
+            descended = False
+            while(pos < end):
+                neighbor = neighbors[pos]
+                pos += 1
+                if(order[neighbor] < 0):
+                    # Descend into the neighbor, and come back to this position later
+                    call_stack[-1] = (node, pos)
+                    order[neighbor] = low[neighbor] = num_discovered
+                    num_discovered += 1
+                    scc_stack.append(neighbor)
+                    on_stack[neighbor] = True
+                    call_stack.append((neighbor, offsets[neighbor]))
+                    descended = True
+                    break
+                if(on_stack[neighbor] and order[neighbor] < low[node]):
+                    low[node] = order[neighbor]
+            if(descended):
+                continue
+
+            # All of the links of this node are done
+            call_stack.pop()
+            if(len(call_stack) > 0):
+                parent = call_stack[-1][0]
+                if(low[node] < low[parent]):
+                    low[parent] = low[node]
+            if(low[node] == order[node]):
+                # The node is the root of an SCC, which is on top of the SCC stack
+                while(True):
+                    member = scc_stack.pop()
+                    on_stack[member] = False
+                    scc_ids[member] = num_sccs
+                    if(member == node):
+                        break
+                num_sccs += 1
+
+    return np.array(scc_ids, dtype=np.int32), num_sccs
+
     
 def test_kosaraju():
     print("Loading map...")
@@ -146,4 +227,20 @@ def test_clean_graph():
     for scc in sccs:
         print("--- %d" % len(scc))
 
-    
\ No newline at end of file
+    
+def test_tarjan():
+    print("Loading map...")
+    m = Map.Map("nyc_map4/nodes.csv", "nyc_map4/links.csv")
+    print("Num nodes : " + str(len(m.nodes)))
+    print("running tarjan")
+    d1 = datetime.now()
+    (scc_ids, num_sccs) = tarjan(m.graph)
+    d2 = datetime.now()
+    print("Done %s" % str(d2 - d1))
+
+    # Both algorithms should find the same SCCs
+    sccs = kosaraju(m.nodes)
+    same = len(sccs) == num_sccs
+    for scc in sccs:
+        same = same and len(set(scc_ids[node.node_index] for node in scc)) == 1
+    print("Same SCCs as kosaraju : " + str(same))
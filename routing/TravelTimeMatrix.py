@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Origin x destination travel time tables, computed without running one
+point-to-point search per pair (see Map.travel_time_matrix()).
+
+With a contraction hierarchy, the bucket-based many-to-many algorithm is used: one
+backward upward search per destination leaves (destination, time) entries in buckets
+at every node that it reaches, and one forward upward search per origin scans the
+buckets at the nodes that it reaches.  Every shortest path has a highest node, which
+both searches reach, so the best combination is exact.
+
+For more information, see:
+"Computing Many-to-Many Shortest Paths Using Highway Hierarchies", Knopp et al., 2007
+
+Without a hierarchy, one Dijkstra search is grown from each distinct origin, and
+stopped as soon as all of the destinations are settled.
+"""
+import numpy as np
+from ArraySearch import shortest_path_tree
+
+
+# Computes a travel time table with a contraction hierarchy
+# Params:
+    # ch - a ContractionHierarchy or a (customized) CustomizableCH
+    # origins - a list of distinct node indices
+    # dests - a list of distinct node indices
+# Returns:
+    # a len(origins) x len(dests) array of travel times (inf where there is no path)
+def bucket_many_to_many(ch, origins, dests):
+    inf = float('inf')
+    buckets = {}
+    for (j, dest) in enumerate(dests):
+        for (node, time) in ch.upward_search(dest, backward=True).iteritems():
+            buckets.setdefault(node, []).append((j, time))
+
+    matrix = np.empty((len(origins), len(dests)), dtype=np.float64)
+    for (i, origin) in enumerate(origins):
+        row = [inf] * len(dests)
+        for (node, time) in ch.upward_search(origin).iteritems():
+            if(node in buckets):
+                for (j, dest_time) in buckets[node]:
+                    if(time + dest_time < row[j]):
+                        row[j] = time + dest_time
+        matrix[i] = row
+    return matrix
+
+
+# Computes a travel time table with one (truncated) Dijkstra search per origin
+# Params:
+    # graph - an ArrayGraph
+    # origins - a list of distinct node indices
+    # dests - a list of distinct node indices
+    # link_time - the travel time of every link.  Uses graph.link_time if None
+# Returns:
+    # a len(origins) x len(dests) array of travel times (inf where there is no path)
+def dijkstra_many_to_many(graph, origins, dests, link_time=None):
+    dests = np.asarray(dests, dtype=np.int64)
+    matrix = np.empty((len(origins), len(dests)), dtype=np.float64)
+    for (i, origin) in enumerate(origins):
+        (dist, _, _) = shortest_path_tree(graph, origin, link_time, targets=dests.tolist())
+        matrix[i] = dist[dests]
+    return matrix
+
+
+# Computes a travel time table between two lists of nodes.  Repeated nodes are only
+# searched once.
+# Params:
+    # graph - an ArrayGraph
+    # origins - an array-like of node indices (the rows)
+    # dests - an array-like of node indices (the columns)
+    # ch - a ContractionHierarchy or CustomizableCH.  If None, one Dijkstra search is
+        # run per distinct origin instead
+    # link_time - the travel time of every link, for the Dijkstra searches.  Uses
+        # graph.link_time if None
+# Returns:
+    # a len(origins) x len(dests) array of travel times (inf where there is no path)
+def travel_time_matrix(graph, origins, dests, ch=None, link_time=None):
+    (unique_origins, origin_pos) = np.unique(np.asarray(origins, dtype=np.int64),
+                                             return_inverse=True)
+    (unique_dests, dest_pos) = np.unique(np.asarray(dests, dtype=np.int64),
+                                         return_inverse=True)
+    if(ch is None):
+        matrix = dijkstra_many_to_many(graph, unique_origins.tolist(), unique_dests.tolist(),
+                                       link_time)
+    else:
+        matrix = bucket_many_to_many(ch, unique_origins.tolist(), unique_dests.tolist())
+    return matrix[np.ix_(origin_pos, dest_pos)]
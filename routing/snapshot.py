@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+A simple versioned binary container for named NumPy arrays, used to save and load
+Map snapshots (see Map.save_snapshot() and Map.load_snapshot()).
+
+File layout:
+    8 bytes   - the magic string "TAXISNAP"
+    4 bytes   - format version (little-endian uint32)
+    4 bytes   - length of the JSON header (little-endian uint32)
+    N bytes   - JSON header, with the scalar attributes and, for every array,
+                its name, dtype, shape, and byte offset in the file
+    ...       - raw array data, each array aligned to ALIGNMENT bytes
+
+Since every array is stored raw at a known offset, a snapshot can either be read
+into memory, or memory-mapped read-only so that several processes share one copy.
+"""
+import json
+import struct
+import numpy as np
+
+
+MAGIC = "TAXISNAP"
+SNAPSHOT_VERSION = 1
+ALIGNMENT = 64
+
+
+# Rounds an offset up to the next multiple of ALIGNMENT
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+# Writes a set of arrays and scalar attributes into a single snapshot file
+# Params:
+    # filename - the file to write
+    # arrays - a dictionary which maps names to NumPy arrays
+    # attrs - a dictionary of JSON-serializable scalar attributes
+def save_snapshot(filename, arrays, attrs=None):
+    if(attrs is None):
+        attrs = {}
+    names = sorted(arrays)
+    arrays = dict((name, np.ascontiguousarray(arrays[name])) for name in names)
+
+    # The header size depends on the offsets, which depend on the header size.
+    # Grow the space reserved for the header until it fits
+    def build_header(data_start):
+        entries = []
+        offset = data_start
+        for name in names:
+            arr = arrays[name]
+            entries.append([name, arr.dtype.str, list(arr.shape), offset])
+            offset = align(offset + arr.nbytes)
+        return json.dumps({"attrs": attrs, "arrays": entries})
+
+    data_start = 0
+    while(True):
+        header = build_header(data_start)
+        if(16 + len(header) <= data_start):
+            break
+        data_start = align(16 + len(header) + ALIGNMENT)
+
+    with open(filename, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<II", SNAPSHOT_VERSION, len(header)))
+        f.write(header)
+        for [name, _, _, offset] in json.loads(header)["arrays"]:
+            f.seek(offset)
+            arrays[name].tofile(f)
+
+
+# Reads the header of a snapshot file
+# Params:
+    # filename - the file to read
+# Returns:
+    # attrs - the dictionary of scalar attributes
+    # entries - a list of [name, dtype, shape, offset] for every array
+def read_header(filename):
+    with open(filename, "rb") as f:
+        magic = f.read(len(MAGIC))
+        if(magic != MAGIC):
+            raise Exception("%s is not a Map snapshot." % filename)
+        (version, header_len) = struct.unpack("<II", f.read(8))
+        if(version != SNAPSHOT_VERSION):
+            raise Exception("Snapshot %s has version %d, but version %d is required."
+                            % (filename, version, SNAPSHOT_VERSION))
+        header = json.loads(f.read(header_len))
+    return header["attrs"], header["arrays"]
+
+
+# Loads a snapshot file
+# Params:
+    # filename - the file to read
+    # mmap - if True, arrays are memory-mapped read-only instead of read into memory
+# Returns:
+    # arrays - a dictionary which maps names to NumPy arrays
+    # attrs - the dictionary of scalar attributes
+def load_snapshot(filename, mmap=False):
+    attrs, entries = read_header(filename)
+    arrays = {}
+    with open(filename, "rb") as f:
+        for [name, dtype, shape, offset] in entries:
+            dtype = np.dtype(str(dtype))
+            shape = tuple(shape)
+            count = int(np.prod(shape))
+            if(count == 0):
+                arrays[name] = np.zeros(shape, dtype=dtype)
+            elif(mmap):
+                arrays[name] = np.memmap(filename, dtype=dtype, mode='r',
+                                         offset=offset, shape=shape)
+            else:
+                f.seek(offset)
+                arrays[name] = np.fromfile(f, dtype=dtype, count=count).reshape(shape)
+    return arrays, attrs
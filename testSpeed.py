@@ -32,7 +32,7 @@ def draw_graphs(trips_none, trips_arc, arc_flags_map, i):
 	pace_dict = {}
 
 	for link in arc_flags_map.links:
-		if link.forward_arc_flags_vector[end_region_id] == False:
+		if arc_flags_map.arc_flags.get_flag(link.link_id, end_region_id) == False:
 			pace_dict[(link.origin_node_id, link.connecting_node_id)] = -5
 		else:
 			pace_dict[(link.origin_node_id, link.connecting_node_id)] = 5
@@ -41,7 +41,7 @@ def draw_graphs(trips_none, trips_arc, arc_flags_map, i):
 
 	pace_dict = {}
 	for link in arc_flags_map.links:
-		if link.backward_arc_flags_vector[start_region_id] == True:
+		if arc_flags_map.arc_flags.get_flag(link.link_id, start_region_id, backward=True) == True:
 			pace_dict[(link.origin_node_id, link.connecting_node_id)] = 5
 		else:
 			pace_dict[(link.origin_node_id, link.connecting_node_id)] = -5
@@ -159,11 +159,9 @@ def region_graph_generator(road_map):
 def draw_arc_flags(road_map, region, forward_arc_flags = True):
 	pace_dict = {}
 	for link in road_map.links:
-		if forward_arc_flags == True:
-			vector = link.forward_arc_flags_vector
-		else:
-			vector = link.backward_arc_flags_vector
-		if vector[region] == False:
+		flag = road_map.arc_flags.get_flag(link.link_id, region,
+		                                   backward=(forward_arc_flags != True))
+		if flag == False:
 			pace_dict[(link.origin_node_id, link.connecting_node_id)] = -5
 		else:
 			pace_dict[(link.origin_node_id, link.connecting_node_id)] = 5
@@ -246,7 +244,7 @@ def graph_arc_flags(node, arc_flags_map, i):
 
 	pace_dict = {}
 	for link in arc_flags_map.links:
-		if link.backward_arc_flags_vector[failed_trips[i].path_links[0].origin_node.region_id] == False:
+		if arc_flags_map.arc_flags.get_flag(link.link_id, failed_trips[i].path_links[0].origin_node.region_id, backward=True) == False:
 			pace_dict[(link.origin_node_id, link.connecting_node_id)] = -5
 		else:
 			pace_dict[(link.origin_node_id, link.connecting_node_id)] = 5
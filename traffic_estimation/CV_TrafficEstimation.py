@@ -47,7 +47,7 @@ def split_train_test(full_data, fold_id, num_folds):
 # Params: Note that this is passed as a single tuple
     # train - a list of Trips, which will be used as the training set
     # test - a list of Trips, which will be used as the test set
-    # road_map - a Map object containing the road network.  Should already be flatten()'ed
+    # map_fn - a snapshot of the road network, from Map.get_shared_snapshot()
     # distance_weighting - the method for computing the weight.  see compute_weight()
 # Returns:
     # iter_avg_errors - a list of average absolute training errors at each iteration
@@ -58,11 +58,11 @@ def split_train_test(full_data, fold_id, num_folds):
         # (may be a subset of input due to duplicates, invalids)
     # train - the modified Trip objects from the test set, now with .estimated_time attribute
         # (may be a subset of input due to duplicates, invalids)
-def run_fold((train, test, road_map, distance_weighting, model_idle_time, initial_idle_time)):
+def run_fold((train, test, map_fn, distance_weighting, model_idle_time, initial_idle_time)):
 
     #print("Running fold - " + str(len(train)) + " train vs. " + str(len(test)) + " test " + str(use_distance_weighting))
-    # Prepare the map for use
-    road_map.unflatten()
+    # Load the map - the graph arrays are shared with the other workers
+    road_map = Map.load_snapshot(map_fn, mmap=True)
        
     
     # Run the traffic estimation algorithm
@@ -89,10 +89,10 @@ def run_fold((train, test, road_map, distance_weighting, model_idle_time, initia
 # Params: - the output from fold_iterator()
     # train - a list of trips
     # test - a list of trips
-    # road_map - a Map object, can be flattened
+    # map_fn - a snapshot of the road network, from Map.get_shared_snapshot()
     # distance_weighting - see TrafficEstimation.compute_weight()
-def run_fold_learning_curve((train, test, road_map, distance_weighting)):
-    road_map.unflatten()
+def run_fold_learning_curve((train, test, map_fn, distance_weighting, _, __)):
+    road_map = Map.load_snapshot(map_fn, mmap=True)
     
     
     
@@ -130,12 +130,12 @@ def run_fold_learning_curve((train, test, road_map, distance_weighting)):
 
 # Simple iterator, produces inputs for the run_fold function
     # Params:
-    # road_map - a Map object containing the road network.
+    # map_fn - a snapshot of the road network, from Map.get_shared_snapshot()
     # distance_weighting - the method for computing the weight.  see compute_weight()
-def fold_iterator(full_data, road_map,  num_folds, distance_weighting=None,model_idle_time=False, initial_idle_time=0):
+def fold_iterator(full_data, map_fn,  num_folds, distance_weighting=None,model_idle_time=False, initial_idle_time=0):
     for i in range(num_folds):
         train, test = split_train_test(full_data, i, num_folds)
-        yield (train, test, road_map, distance_weighting, model_idle_time, initial_idle_time)
+        yield (train, test, map_fn, distance_weighting, model_idle_time, initial_idle_time)
 
 
 # Takes a list of list, and produces an average list (by averaging the inner lists)
@@ -202,8 +202,9 @@ def perform_cv(full_data, nodes_fn, links_fn, num_folds, pool, fn_prefix= "", di
 
     print("Loading map")
     road_map = Map(nodes_fn, links_fn)
-    road_map.flatten()
-    it = fold_iterator(full_data, road_map, num_folds, distance_weighting=distance_weighting, model_idle_time=model_idle_time, initial_idle_time=initial_idle_time)
+    # The workers load the map from a shared snapshot, instead of unpickling a copy
+    map_fn = road_map.get_shared_snapshot()
+    it = fold_iterator(full_data, map_fn, num_folds, distance_weighting=distance_weighting, model_idle_time=model_idle_time, initial_idle_time=initial_idle_time)
 
     output_list = pool.map(run_fold, it)
     (train_avg, train_perc, test_avg, test_perc, train_set, test_set) = combine_outputs(output_list)
@@ -326,8 +327,8 @@ def perform_learning_curve(full_data, nodes_fn, links_fn, num_folds, num_cpus =
     
     
     road_map = Map(nodes_fn, links_fn)
-    road_map.flatten()
-    it = fold_iterator(full_data, road_map, num_folds, distance_weighting=distance_weighting)
+    map_fn = road_map.get_shared_snapshot()
+    it = fold_iterator(full_data, map_fn, num_folds, distance_weighting=distance_weighting)
     
     pool = Pool(num_cpus)
     output_list = pool.map(run_fold_learning_curve, it)
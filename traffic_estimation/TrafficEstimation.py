@@ -8,6 +8,7 @@ from routing.BiDirectionalSearch import bidirectional_search
 from routing.Map import Map
 
 from Trip import Trip
+from TripBatch import TripBatch
 
 from datetime import datetime
 import csv
@@ -93,6 +94,9 @@ def compute_weight(distance_weighting, true_dist, est_dist):
     # max_speed - the maximum speed of any Link.  Will be computed if None (a little costly).
         # This is used by the A* heuristic - only important if route=True
     # distance_weighting - the method for computing the weight.  see compute_weight()
+    # ch - an optional ContractionHierarchy or CustomizableCH (see Map.get_contraction_hierarchy()
+        # and Map.get_customizable_ch()).  If given, it is used to compute the shortest paths
+        # instead of bidirectional_search()
 # Returns:
     # trip - the same trip that was given as input
     # error - the value of the error metric (which we are trying to minimize)
@@ -100,7 +104,8 @@ def compute_weight(distance_weighting, true_dist, est_dist):
     # sum_perc_error - the (positive) percentage error
     # num_trips - the number of trips represented by this one "unique trip"
 def predict_trip_time(trip, road_map, route=True, proposed=False, max_speed = None,
-                       distance_weighting=None, flatten_after = False, model_idle_time=True):
+                       distance_weighting=None, flatten_after = False, model_idle_time=True,
+                       ch=None):
     try:
         
         if(flatten_after):
@@ -112,7 +117,9 @@ def predict_trip_time(trip, road_map, route=True, proposed=False, max_speed = No
         l1_error = 0.0
         sum_perc_error = 0
         num_trips = 0
-        if(route):
+        if(route and ch is not None):
+            trip.path_links = road_map.find_path_with_ch(ch, trip.origin_node, trip.dest_node)
+        elif(route):
             trip.path_links = bidirectional_search(trip.origin_node, trip.dest_node, use_astar=True, max_speed=max_speed)
 
         
@@ -146,56 +153,54 @@ def predict_trip_time(trip, road_map, route=True, proposed=False, max_speed = No
 
 
 # Predicts the travel times for many trips, can make use of parallel processing
+# If a pool is given, the routing is done by the worker processes, which attach to a
+# shared, memory-mapped copy of the graph (see Map.route_trips_with_pool()).  Only the
+# link travel times and the origin/destination indices are sent to them.
+# If use_ch is True, the trips are routed with a Contraction Hierarchy instead, which
+# is rebuilt whenever the link travel times have changed.  If use_cch is True, they are
+# routed with a Customizable Contraction Hierarchy, which is only re-customized (fast).
+# If use_alt is True, they are routed with exact bidirectional A* search, using landmark
+# lower bounds whose tables are recomputed whenever the link travel times have changed.
+# Otherwise, if group_by_origin is True, the trips are grouped by origin node and all of
+# the trips from one origin are routed with a single shortest path tree (see
+# Map.route_trips_by_origin()).  Many unique trips share an origin, so this is much
+# cheaper than one bidirectional search per trip.  It is off by default: the trees are
+# exact Dijkstra/A* searches, which may pick a different path than bidirectional search
+# when there are ties, so callers must opt in.
 def predict_trip_times(road_map, trips, route=True, proposed=False, max_speed = None,
-                       distance_weighting=None, model_idle_time=True, pool=None):
-    if(max_speed==None):
+                       distance_weighting=None, model_idle_time=True, pool=None, use_ch=False,
+                       use_cch=False, use_alt=False, group_by_origin=False):
+    ch = None
+    if(route and use_cch):
+        ch = road_map.get_customizable_ch()
+    elif(route and use_ch):
+        ch = road_map.get_contraction_hierarchy()
+    elif(max_speed==None and not (route and use_alt)):
         max_speed = road_map.get_max_speed()
     
-    if(pool==None):
-        # Create a partial function, which only takes a Trip as input (all of the others are given constants)
-        # This makes it easy to use with the map() function
-        trip_func = partial(predict_trip_time, road_map=road_map,route=route, proposed=proposed,
-                        max_speed=max_speed, distance_weighting=distance_weighting,
-                        model_idle_time=model_idle_time, flatten_after=False)        
-        
-        # Predict the travel times for all of the trips
-        output_list = map(trip_func, trips)
-
-    else:
-        # If we are using several cpus, we will use Pool.map() instead
-        # However, the Trips and Map must be flattened before they can be sent to worker processes
-        print("Flattening everything.")
-        for trip in trips:
-            trip.flatten()
-        road_map.flatten()
-        
-        print("Splitting")
-        
-        # Create a partial function, which only takes a Trip as input (all of the others are given constants)
-        # This makes it easy to use with the map() function.
-        # The trips must be flattened, since they are being sent across processes
-        trip_func = partial(predict_trip_time, road_map=road_map,route=route, proposed=proposed,
-                        max_speed=max_speed, distance_weighting=distance_weighting, 
-                        model_idle_time=model_idle_time, flatten_after=True)         
-        
-        
-        # create the multiprocessing pool to route the Trips in parallel
-        
-        # Perform the routing with one chunk per CPU
-        ideal_chunksize = (len(trips) / pool._processes) + 1
-        output_list = pool.map(trip_func, trips, chunksize=ideal_chunksize)
-        pool.terminate()
-        
-        print("Unflattening trips")
-        routed_trips = [trip for trip, error, l1_error, sum_perc_error, num_trips in output_list]
-        
-        # The Pool returns a new copy of the trips - the relevant data must be copied back to the originals
-        # The Trip must also be unflattened, for use with the current Map
-        for i in xrange(len(trips)):
-            trips[i].path_link_ids = routed_trips[i].path_link_ids
-            trips[i].estimated_time = routed_trips[i].estimated_time
-            trips[i].estimated_dist = routed_trips[i].estimated_dist
-            trips[i].unflatten(road_map)
+    if(route and use_alt and ch is None):
+        if(pool!=None):
+            road_map.route_trips_with_pool(trips, pool, alt_used=True)
+        else:
+            road_map.routeTrips(trips, alt_used=True)
+        route = False
+    elif(route and group_by_origin and ch is None):
+        road_map.route_trips_by_origin(trips, pool=pool, max_speed=max_speed, astar_used=True)
+        route = False
+    elif(pool!=None and route and ch is None):
+        # Route all of the trips in parallel.  The remaining work is cheap, so it is
+        # done here with the paths that the workers found
+        road_map.route_trips_with_pool(trips, pool, max_speed=max_speed, astar_used=True)
+        route = False
+    
+    # Create a partial function, which only takes a Trip as input (all of the others are given constants)
+    # This makes it easy to use with the map() function
+    trip_func = partial(predict_trip_time, road_map=road_map,route=route, proposed=proposed,
+                    max_speed=max_speed, distance_weighting=distance_weighting,
+                    model_idle_time=model_idle_time, flatten_after=False, ch=ch)
+    
+    # Predict the travel times for all of the trips
+    output_list = map(trip_func, trips)
             
     total_error = 0.0
     total_l1 = 0.0
@@ -263,12 +268,19 @@ def compute_link_offsets(road_map, unique_trips, distance_weighting=None):
     # test_set - an optional hold-out test set to assess how well the model generalizes.
     # distance_weighting - the method for computing the weight.  see compute_weight()
     # model_idle_time - Assumes that each trip includes a fixed amount of idle time (which will be estimated)
+    # use_ch - route the trips with a Contraction Hierarchy (see predict_trip_times())
+    # use_cch - route the trips with a Customizable Contraction Hierarchy, which is
+        # re-customized after every accepted step (see predict_trip_times())
+    # use_alt - route the trips with the landmark (ALT) heuristic (see predict_trip_times())
+    # group_by_origin - route the trips with one shortest path tree per origin node
+        # (see predict_trip_times())
 # Returns:
     # iter_avg_errors - A list of the average absolute errors at each iteration
     # iter_perc_errors - A list of average percent errors at each iteration
     # test_avg_errors - A list of average absolute errors on the test set at each iteration
     # test_perc_errors - A list of average percent errors on the test set at each iteration
-def estimate_travel_times(road_map, trips, max_iter=20, test_set=None, distance_weighting=None, model_idle_time=False, initial_idle_time=0):
+def estimate_travel_times(road_map, trips, max_iter=20, test_set=None, distance_weighting=None, model_idle_time=False, initial_idle_time=0,
+                          use_ch=False, use_cch=False, use_alt=False, group_by_origin=False):
     #print("Estimating traffic.  use_distance_weighting=" + str(use_distance_weighting))
     DEBUG = False
     #Collapse identical trips
@@ -304,23 +316,24 @@ def estimate_travel_times(road_map, trips, max_iter=20, test_set=None, distance_
 
         
         t1 = datetime.now()
-        max_speed = road_map.get_max_speed()
         if(DEBUG):
-            print("max speed = " + str(max_speed))
+            print("max speed = " + str(road_map.get_max_speed()))
         
         # Determine optimal routes for all trips, and predict the travel times
         # This is the most costly part of each iteration
         # l1_error stores the sum of all absolute errors
         error_metric, avg_trip_error, avg_perc_error = predict_trip_times(road_map,
                 unique_trips, route=True, distance_weighting=distance_weighting,
-                model_idle_time=model_idle_time)
+                model_idle_time=model_idle_time, use_ch=use_ch, use_cch=use_cch, use_alt=use_alt,
+                group_by_origin=group_by_origin)
         iter_avg_errors.append(avg_trip_error)
         iter_perc_errors.append(avg_perc_error)
         
         # If we have a test set, also evaluate the map on it
         if(test_set != None):
             test_l1_error, test_avg_trip_error, test_perc_error = predict_trip_times(
-                road_map, unique_test_trips, route=True, model_idle_time=model_idle_time)
+                road_map, unique_test_trips, route=True, model_idle_time=model_idle_time,
+                use_ch=use_ch, use_cch=use_cch, use_alt=use_alt, group_by_origin=group_by_origin)
             test_avg_errors.append(test_avg_trip_error)
             test_perc_errors.append(test_perc_error)
         
@@ -393,7 +406,9 @@ def estimate_travel_times(road_map, trips, max_iter=20, test_set=None, distance_
     iter_perc_errors.append(avg_perc_error)
     # If we have a test set, also evaluate the map on it
     if(test_set != None):
-        test_l1_error, test_avg_trip_error, test_perc_error = predict_trip_times(road_map, unique_test_trips, route=True)
+        test_l1_error, test_avg_trip_error, test_perc_error = predict_trip_times(road_map, unique_test_trips, route=True,
+                                                                                 use_ch=use_ch, use_cch=use_cch, use_alt=use_alt,
+                                                                                 group_by_origin=group_by_origin)
         test_avg_errors.append(test_avg_trip_error)
         test_perc_errors.append(test_perc_error)
                 
@@ -407,16 +422,7 @@ def estimate_travel_times(road_map, trips, max_iter=20, test_set=None, distance_
         
 
 def load_trips(filename, limit=float('inf')):
-    trips = []
-    with open(filename, "r") as f:
-        reader = csv.reader(f)
-        reader.next()
-        for line in reader:
-            trips.append(Trip(line))
-            if(len(trips) >= limit):
-                break
-        
-    return trips
+    return TripBatch.from_csv(filename, limit).get_trips()
         
         
 
@@ -11,6 +11,28 @@ from routing.Node import approx_distance
 
 
 
+#The thresholds that Trip.isValid() applies, in the units of the Trip's attributes
+#(degrees, meters, seconds, seconds/meter).  Pairs are (low, high) limits.  Pass a modified
+#copy to isValid() or TripBatch.get_error_codes() to filter with different limits.
+VALIDITY_THRESHOLDS = {
+    "bad_months" : [(2010, 8), (2010, 9)], #(year, month) of pickup
+    "err_lat" : (40.4, 41.1),
+    "err_lon" : (-74.25, -73.5),
+    "err_straightline" : (.001*1609.34, 20*1609.34),
+    "err_dist" : (.001*1609.34, 20*1609.34),
+    "err_lo_wind" : .95,
+    "err_time" : (10, 7200),
+    "err_pace" : (10/1609.34, 7200/1609.34),
+    "bad_lat" : (40.6, 40.9),
+    "bad_lon" : (-74.05, -73.7),
+    "bad_hi_straightline" : 8*1609.34,
+    "bad_hi_dist" : 15*1609.34,
+    "bad_hi_wind" : 5,
+    "bad_time" : (60, 3600),
+    "bad_pace" : (40/1609.34, 3600/1609.34),
+}
+
+
 #A single taxi trip - contains information such as coordinates, times, etc...
 #Can be parsed from a line of a CSV file via the constructor
 #Some trips contain obvious errors - the isValid() method reveals this
@@ -26,10 +48,22 @@ class Trip:
         for i in range(len(header)):
             Trip.header[header[i].strip()] = i
     
-    #Constructs a Trip object using a line from a CSV file.  Assumes that Trip.initHeader() has already been called
+    #Constructs a Trip object using a record from the trip table.
     #Arguments:
-        #csvLine - A list, which has been parsed from a CSV data file
-    def __init__(self, record):
+        #record - A tuple, which has been read from the database.  If None, the features
+            #are left unset, and must be filled in by the caller (see TripBatch.get_trips())
+    def __init__(self, record=None):
+        #For traffic estimation algorithm
+        self.path_links = None
+        self.path_link_ids = None
+        self.dup_times = None
+        self.estimated_time = 0.0
+        self.estimate_distance = 0.0
+        self.has_other_error=False
+
+        if(record is None):
+            return
+
         #Store the actual data in case we need it later...
         #self.csvLine = csvLine
         
@@ -52,17 +86,6 @@ class Trip:
         duration = self.dropoff_time - self.pickup_time  #Dropoff time is used to compute duration (timedelta object)
         self.time = int(duration.total_seconds()) #Time stores the duration as seconds
         
-        #For traffic estimation algorithm
-        self.path_links = None
-        self.path_link_ids = None
-        self.dup_times = None
-        self.estimated_time = 0.0
-        self.estimate_distance = 0.0
-  
-
-  
-  
-  
         #Compute pace (if possible)
         if(self.dist==0):
             self.pace = 0
@@ -78,8 +101,6 @@ class Trip:
             self.winding_factor = 1
         else:
             self.winding_factor = self.dist / self.straight_line_dist
-        
-        self.has_other_error=False
 
     def displayTrip(self):
         print "Medallion:\t\t\t\t", self.medallion, "\nHack license:\t\t\t\t", self.hack_license, "\nVendor ID:\t\t\t\t", self.vendor_id, rate_code, "\nRate code:\t\t\t\t", self.rate_code, "\nStore and fwd flag:\t\t\t", self.store_and_fwd_flag, "\nPickup datetime:\t\t\t", self.pickup_datetime, "\nDropoff datetime:\t\t\t", self.dropoff_datetime, "\nPassenger count:\t\t\t", self.passenger_count, "\nTrip time in secs:\t\t\t", self.trip_time_in_secs, "\nTrip distance:\t\t\t\t", self.trip_distance, "\nPickup longitude:\t\t\t", self.pickup_longitude, "\nPickup latitude:\t\t\t", self.pickup_latitude, "\nDropoff longitude:\t\t\t", self.dropoff_longitude, "\nDropoff latitude:\t\t\t", self.dropoff_latitude, "\nPayment type:\t\t\t\t", self.payment_type, "\nFare amount:\t\t\t\t", self.fare_amount, "\nSurcharge:\t\t\t\t", self.surcharge, "\nMTA tax:\t\t\t\t", self.mta_tax, "\nTip amount:\t\t\t\t", self.tip_amount, "\nTolls amount:\t\t\t\t", self.tolls_amount
@@ -115,54 +136,59 @@ class Trip:
     
     #This method implements data filtering
     #Tells whether the trip is valid, by applying various thresholds to the features.
+    #TripBatch.get_error_codes() applies the same checks, in the same order, to a whole batch.
+    #Arguments:
+        #thresholds - a dictionary of thresholds, with the same keys as VALIDITY_THRESHOLDS
     #Returns: An integer error code.  0 means it is a valid trip, 1-24 are different types of errors, listed above
-    def isValid(self):
-        #These two months contain a very high number of errors, so they cannot be trusted
-        if(self.pickup_time.year==2010 and self.pickup_time.month==8):
-            return Trip.ERR_DATE
-        if(self.pickup_time.year==2010 and self.pickup_time.month==9):
+    def isValid(self, thresholds=None):
+        if(thresholds is None):
+            thresholds = VALIDITY_THRESHOLDS
+        t = thresholds
+
+        #These months contain a very high number of errors, so they cannot be trusted
+        if((self.pickup_time.year, self.pickup_time.month) in t["bad_months"]):
             return Trip.ERR_DATE
         
         
         #First filter obvious errors
         
         #GPS coordinates (in degrees) not reasonable
-        if(self.toLat < 40.4 or self.fromLat < 40.4):
+        if(self.toLat < t["err_lat"][0] or self.fromLat < t["err_lat"][0]):
             return Trip.ERR_GPS
-        if(self.toLat > 41.1 or self.fromLat > 41.1):
+        if(self.toLat > t["err_lat"][1] or self.fromLat > t["err_lat"][1]):
             return Trip.ERR_GPS
-        if(self.toLon < -74.25 or self.fromLon < -74.25):
+        if(self.toLon < t["err_lon"][0] or self.fromLon < t["err_lon"][0]):
             return Trip.ERR_GPS
-        if(self.toLon > -73.5 or self.fromLon > -73.5):
+        if(self.toLon > t["err_lon"][1] or self.fromLon > t["err_lon"][1]):
             return Trip.ERR_GPS
 
-        #Distance between start and end coordinates (in miles) not reasonable
-        if(self.straight_line_dist < .001*1609.34):
+        #Distance between start and end coordinates (in meters) not reasonable
+        if(self.straight_line_dist < t["err_straightline"][0]):
             return Trip.ERR_LO_STRAIGHTLINE
-        if(self.straight_line_dist > 20*1609.34):
+        if(self.straight_line_dist > t["err_straightline"][1]):
             return Trip.ERR_HI_STRAIGHTLINE
                 
-        #Metered distance (in miles) not reasonable
-        if(self.dist < .001*1609.34):
+        #Metered distance (in meters) not reasonable
+        if(self.dist < t["err_dist"][0]):
             return Trip.ERR_LO_DIST
-        if(self.dist > 20*1609.34):
+        if(self.dist > t["err_dist"][1]):
             return Trip.ERR_HI_DIST
         
         #In euclidean space, the winding factor (metered dist / straightline dist) must be >= 1
         #We allow some small room for rounding errors and GPS noise
-        if(self.winding_factor < .95):
+        if(self.winding_factor < t["err_lo_wind"]):
             return Trip.ERR_LO_WIND
 
         #Unreasonable trip time (in seconds)
-        if(self.time < 10):
+        if(self.time < t["err_time"][0]):
             return Trip.ERR_LO_TIME
-        if(self.time > 7200):
+        if(self.time > t["err_time"][1]):
             return Trip.ERR_HI_TIME
         
         #Unreasonable pace (in second/meter)
-        if(self.pace < 10/1609.34):
+        if(self.pace < t["err_pace"][0]):
             return Trip.ERR_LO_PACE
-        if(self.pace > 7200/1609.34):
+        if(self.pace > t["err_pace"][1]):
             return Trip.ERR_HI_PACE
         
         
@@ -170,37 +196,37 @@ class Trip:
         #But is still not useful for the analysis
         
         #Restrict analysis to Manhattan and a small surrounding area
-        if(self.toLat < 40.6 or self.fromLat < 40.6):
+        if(self.toLat < t["bad_lat"][0] or self.fromLat < t["bad_lat"][0]):
             return Trip.BAD_GPS
-        if(self.toLat > 40.9 or self.fromLat > 40.9):
+        if(self.toLat > t["bad_lat"][1] or self.fromLat > t["bad_lat"][1]):
             return Trip.BAD_GPS
-        if(self.toLon < -74.05 or self.fromLon < -74.05):
+        if(self.toLon < t["bad_lon"][0] or self.fromLon < t["bad_lon"][0]):
             return Trip.BAD_GPS
-        if(self.toLon > -73.7 or self.fromLon > -73.7):
+        if(self.toLon > t["bad_lon"][1] or self.fromLon > t["bad_lon"][1]):
             return Trip.BAD_GPS
         
-        #Really long trips (in miles) are not representative
-        if(self.straight_line_dist > 8*1609.34):
+        #Really long trips (in meters) are not representative
+        if(self.straight_line_dist > t["bad_hi_straightline"]):
             return Trip.BAD_HI_STRAIGHTLINE
                 
-        if(self.dist > 15*1609.34):
+        if(self.dist > t["bad_hi_dist"]):
             return Trip.BAD_HI_DIST
         
         #A high winding factor indicates that the taxi did not proceed directly to its destination
         #So it is not representative of its start and end regions
-        if(self.winding_factor > 5):
+        if(self.winding_factor > t["bad_hi_wind"]):
             return Trip.BAD_HI_WIND
             
         #Really short or really long trips are not representative
-        if(self.time < 60):
+        if(self.time < t["bad_time"][0]):
             return Trip.BAD_LO_TIME
-        if(self.time > 3600):
+        if(self.time > t["bad_time"][1]):
             return Trip.BAD_HI_TIME
         
         #These speeds are technically possible, but not indicative of overall traffic
-        if(self.pace < 40/1609.34):
+        if(self.pace < t["bad_pace"][0]):
             return Trip.BAD_LO_PACE
-        if(self.pace > 3600/1609.34):
+        if(self.pace > t["bad_pace"][1]):
             return Trip.BAD_HI_PACE
 
         
@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+"""
+Contains the TripBatch class, which stores many taxi trips as columns of NumPy arrays.
+
+Building one Trip object per row means doing the float conversions, the datetime math
+and the distance computations in Python for every trip.  A TripBatch does all of them
+with a handful of array operations, and only creates Trip objects when they are asked
+for (see get_trip() and get_trips()).
+"""
+import csv
+import numpy as np
+from routing.ArrayGraph import LAT_METERS, LON_METERS
+from Trip import Trip, VALIDITY_THRESHOLDS
+
+# The columns of the trip table, in the order of the database records (see Trip.__init__())
+TRIP_COLUMNS = ("medallion", "hack_license", "vendor_id", "rate_code", "store_and_fwd_flag",
+                "pickup_datetime", "dropoff_datetime", "passenger_count", "trip_time_in_secs",
+                "trip_distance", "pickup_longitude", "pickup_latitude", "dropoff_longitude",
+                "dropoff_latitude", "payment_type", "fare_amount", "surcharge", "mta_tax",
+                "tip_amount", "tolls_amount", "pickup_geom", "dropoff_geom", "day_of_week",
+                "hours_of_day")
+
+METERS_PER_MILE = 1609.34
+
+# The names of the error codes of Trip.isValid().  ERR_LO_DIST and BAD_HI_DIST share
+# the code 8, so code 9 never occurs.
+ERROR_CODE_NAMES = {}
+for (name, code) in sorted(vars(Trip).items()):
+    if(name == "VALID" or name.startswith("BAD_") or name.startswith("ERR_")):
+        ERROR_CODE_NAMES[code] = "/".join(filter(None, [ERROR_CODE_NAMES.get(code), name]))
+
+
+# Converts a column of values to floats.  Values which cannot be converted (None, empty
+# strings, ...) become nan.
+# Params:
+    # values - a sequence of numbers or strings
+# Returns:
+    # floats - a float64 array
+    # unreadable - a boolean array, True where float() fails on the value.  Values which
+        # are read as nan (like "nan") are not unreadable.
+def to_float_array(values):
+    try:
+        floats = np.array(values, dtype=np.float64)
+        # NumPy reads None as nan, so the nan values are checked one at a time
+        unreadable = np.zeros(len(floats), dtype=bool)
+        candidates = np.flatnonzero(np.isnan(floats))
+    except (ValueError, TypeError):
+        floats = np.empty(len(values))
+        floats.fill(np.nan)
+        unreadable = np.zeros(len(floats), dtype=bool)
+        candidates = xrange(len(values))
+    for i in candidates:
+        try:
+            floats[i] = float(values[i])
+        except (ValueError, TypeError):
+            unreadable[i] = True
+    return floats, unreadable
+
+
+# Counts how many trips got each error code
+# Params:
+    # codes - an array of error codes, from TripBatch.get_error_codes()
+# Returns:
+    # a dictionary which maps the name of each code that occurs (see ERROR_CODE_NAMES)
+    # to its number of trips
+def count_error_codes(codes):
+    counts = np.bincount(codes, minlength=max(ERROR_CODE_NAMES) + 1)
+    return dict((ERROR_CODE_NAMES[code], int(counts[code]))
+                for code in np.flatnonzero(counts))
+
+
+# Converts a column of times to datetime64[us]
+# Params:
+    # values - a sequence of datetimes, of strings in ISO format, or of numbers of
+        # seconds since 1970-01-01 (e.g. from EXTRACT(EPOCH FROM ...) in the database)
+# Returns:
+    # a datetime64[us] array
+def to_datetime64(values):
+    values = np.asarray(values)
+    if(values.dtype.kind in "fiu"):
+        return np.round(values * 1e6).astype(np.int64).astype("datetime64[us]")
+    return values.astype("datetime64[us]")
+
+
+# The same approximation as Node.approx_distance(), for whole arrays of coordinates.  The
+# operations are the same, in the same order, so the distances are identical to the last
+# bit (np.hypot() would round differently).
+# Params:
+    # lat1, lon1, lat2, lon2 - arrays of coordinates, in degrees
+# Returns:
+    # an array of distances, in meters
+def approx_distances(lat1, lon1, lat2, lon2):
+    lat_meters = (lat1 - lat2) * LAT_METERS
+    lon_meters = (lon1 - lon2) * LON_METERS
+    return np.sqrt(lat_meters * lat_meters + lon_meters * lon_meters)
+
+
+# A batch of taxi trips, stored column by column.  Every column has one entry per trip,
+# and the columns hold the same values as the attributes of the same name on Trip.
+class TripBatch:
+
+    # Builds a batch from columns of raw values, and computes the derived features
+    # Params:
+        # medallion - a sequence of medallions
+        # pickup_time, dropoff_time - sequences of times (see to_datetime64())
+        # fromLon, fromLat, toLon, toLat - sequences of coordinates, in degrees
+        # dist - a sequence of metered distances, in miles
+    def __init__(self, medallion, pickup_time, dropoff_time, fromLon, fromLat, toLon, toLat,
+                 dist):
+        self.medallion = np.array(medallion, dtype=object)
+        self.pickup_time = to_datetime64(pickup_time)
+        self.dropoff_time = to_datetime64(dropoff_time)
+
+        # As in Trip, a row with any unreadable coordinate or distance gets zeros for all
+        # five of them
+        columns = [to_float_array(values) for values in (fromLon, fromLat, toLon, toLat,
+                                                         dist)]
+        coords = np.vstack([floats for (floats, _) in columns])
+        unreadable = np.vstack([unreadable for (_, unreadable) in columns])
+        coords[:, unreadable.any(axis=0)] = 0.0
+        (self.fromLon, self.fromLat, self.toLon, self.toLat, self.dist) = coords
+        self.dist *= METERS_PER_MILE # convert to meters
+
+        # The duration in whole seconds, truncated like int(timedelta.total_seconds())
+        duration = (self.dropoff_time - self.pickup_time).astype(np.int64)
+        self.time = np.trunc(duration / 1e6).astype(np.int64)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.pace = np.where(self.dist == 0, 0.0, self.time / self.dist)
+            self.straight_line_dist = approx_distances(self.fromLat, self.fromLon,
+                                                       self.toLat, self.toLon)
+            self.winding_factor = np.where(self.straight_line_dist <= 0, 1.0,
+                                           self.dist / self.straight_line_dist)
+
+        # The matched node indices, -1 until they are set (see set_matched_nodes())
+        self.origin_node = np.repeat(np.int64(-1), len(self.medallion))
+        self.dest_node = self.origin_node.copy()
+
+    # Builds a batch from database records of the trip table
+    # Params:
+        # records - a list of tuples, in the order of TRIP_COLUMNS (e.g. from cursor.fetchall())
+    # Returns:
+        # a TripBatch
+    @staticmethod
+    def from_records(records):
+        if(len(records) == 0):
+            return TripBatch([], [], [], [], [], [], [], [])
+        columns = zip(*records)
+        get = lambda name: columns[TRIP_COLUMNS.index(name)]
+        return TripBatch(get("medallion"), get("pickup_datetime"), get("dropoff_datetime"),
+                         get("pickup_longitude"), get("pickup_latitude"),
+                         get("dropoff_longitude"), get("dropoff_latitude"),
+                         get("trip_distance"))
+
+    # Builds a batch from a CSV file of trips.  The columns are found by name in the
+    # header line, which must contain the names used by TRIP_COLUMNS.
+    # Params:
+        # filename - the CSV file
+        # limit - read at most this many trips
+    # Returns:
+        # a TripBatch
+    @staticmethod
+    def from_csv(filename, limit=float('inf')):
+        with open(filename, "r") as f:
+            reader = csv.reader(f)
+            header = [name.strip() for name in reader.next()]
+            lines = []
+            for line in reader:
+                if(len(lines) >= limit):
+                    break
+                lines.append(line)
+
+        if(len(lines) == 0):
+            return TripBatch([], [], [], [], [], [], [], [])
+        columns = zip(*lines)
+        get = lambda name: columns[header.index(name)]
+        return TripBatch(get("medallion"), get("pickup_datetime"), get("dropoff_datetime"),
+                         get("pickup_longitude"), get("pickup_latitude"),
+                         get("dropoff_longitude"), get("dropoff_latitude"),
+                         get("trip_distance"))
+
+    def __len__(self):
+        return len(self.medallion)
+
+    # Indexing with an integer creates a Trip, and indexing with a slice, a boolean mask
+    # or an array of indices gives a smaller TripBatch
+    def __getitem__(self, key):
+        if(isinstance(key, (int, long, np.integer))):
+            return self.get_trip(key)
+        return self.select(key)
+
+    # Creates the Trips a chunk at a time, so a loop that stops early does not pay for all
+    # of them
+    def __iter__(self):
+        for lo in xrange(0, len(self), 1024):
+            for trip in self.get_trips(indices=slice(lo, lo + 1024)):
+                yield trip
+
+    # Selects a subset of the trips
+    # Params:
+        # key - a slice, a boolean mask or an array of indices
+    # Returns:
+        # a new TripBatch with the selected rows
+    def select(self, key):
+        subset = TripBatch([], [], [], [], [], [], [], [])
+        for (name, column) in self.__dict__.iteritems():
+            setattr(subset, name, column[key])
+        return subset
+
+    # Applies the checks of Trip.isValid() to every trip at once.  The checks are made in
+    # the same order, so every trip gets the code of the first check that it fails, exactly
+    # as isValid() would give it.
+    # Params:
+        # thresholds - a dictionary of thresholds, with the same keys as VALIDITY_THRESHOLDS
+    # Returns:
+        # an int8 array with one error code per trip (Trip.VALID, Trip.ERR_GPS, ...)
+    def get_error_codes(self, thresholds=None):
+        if(thresholds is None):
+            thresholds = VALIDITY_THRESHOLDS
+        t = thresholds
+        lats = (self.fromLat, self.toLat)
+        lons = (self.fromLon, self.toLon)
+        outside = lambda values, (lo, hi): (values[0] < lo) | (values[1] < lo) | (
+            values[0] > hi) | (values[1] > hi)
+
+        # (year, month) as a number of months since year 0
+        months = self.pickup_time.astype("datetime64[M]").astype(np.int64) + 1970 * 12
+        bad_months = [year * 12 + month - 1 for (year, month) in t["bad_months"]]
+
+        # Comparisons with nan are False, as in isValid()
+        with np.errstate(invalid="ignore"):
+            checks = [
+                (np.in1d(months, bad_months), Trip.ERR_DATE),
+                (outside(lats, t["err_lat"]) | outside(lons, t["err_lon"]), Trip.ERR_GPS),
+                (self.straight_line_dist < t["err_straightline"][0], Trip.ERR_LO_STRAIGHTLINE),
+                (self.straight_line_dist > t["err_straightline"][1], Trip.ERR_HI_STRAIGHTLINE),
+                (self.dist < t["err_dist"][0], Trip.ERR_LO_DIST),
+                (self.dist > t["err_dist"][1], Trip.ERR_HI_DIST),
+                (self.winding_factor < t["err_lo_wind"], Trip.ERR_LO_WIND),
+                (self.time < t["err_time"][0], Trip.ERR_LO_TIME),
+                (self.time > t["err_time"][1], Trip.ERR_HI_TIME),
+                (self.pace < t["err_pace"][0], Trip.ERR_LO_PACE),
+                (self.pace > t["err_pace"][1], Trip.ERR_HI_PACE),
+                (outside(lats, t["bad_lat"]) | outside(lons, t["bad_lon"]), Trip.BAD_GPS),
+                (self.straight_line_dist > t["bad_hi_straightline"], Trip.BAD_HI_STRAIGHTLINE),
+                (self.dist > t["bad_hi_dist"], Trip.BAD_HI_DIST),
+                (self.winding_factor > t["bad_hi_wind"], Trip.BAD_HI_WIND),
+                (self.time < t["bad_time"][0], Trip.BAD_LO_TIME),
+                (self.time > t["bad_time"][1], Trip.BAD_HI_TIME),
+                (self.pace < t["bad_pace"][0], Trip.BAD_LO_PACE),
+                (self.pace > t["bad_pace"][1], Trip.BAD_HI_PACE)]
+
+        # Apply the checks from last to first, so that the first failed check wins
+        codes = np.empty(len(self), dtype=np.int8)
+        codes.fill(Trip.VALID)
+        for (failed, code) in reversed(checks):
+            codes[failed] = code
+        return codes
+
+    # Stores the nodes that the trips were matched to
+    # Params:
+        # origin_node, dest_node - arrays of node indices (see Map.nodes), -1 where a
+            # trip was not matched
+    def set_matched_nodes(self, origin_node, dest_node):
+        self.origin_node = np.asarray(origin_node, dtype=np.int64)
+        self.dest_node = np.asarray(dest_node, dtype=np.int64)
+
+    # Creates a Trip object from one row.  The Trip is a copy, so changes to it are not
+    # written back to the batch.
+    # Params:
+        # i - the index of the trip
+        # road_map - a Map.  If given, the Trip's origin_node and dest_node are set to
+            # the matched Nodes
+    # Returns:
+        # a Trip
+    def get_trip(self, i, road_map=None):
+        [trip] = self.get_trips(road_map, [i])
+        return trip
+
+    # Creates Trip objects for many rows.  The columns are converted to Python values
+    # once, instead of once per Trip.
+    # Params:
+        # road_map - see get_trip()
+        # indices - the rows to create Trips for.  All of them if None.
+    # Returns:
+        # a list of Trips
+    def get_trips(self, road_map=None, indices=None):
+        if(indices is None):
+            indices = slice(None)
+        names = ["medallion", "fromLon", "fromLat", "toLon", "toLat", "dist", "time",
+                 "pace", "straight_line_dist", "winding_factor"]
+        columns = [getattr(self, name)[indices].tolist() for name in names]
+        # datetime64[us] converts to datetime objects, like the database returns
+        columns.append(self.pickup_time[indices].astype(object).tolist())
+        columns.append(self.dropoff_time[indices].astype(object).tolist())
+        names.extend(["pickup_time", "dropoff_time"])
+        origin_nodes = self.origin_node[indices].tolist()
+        dest_nodes = self.dest_node[indices].tolist()
+
+        trips = []
+        for (row, origin_node, dest_node) in zip(zip(*columns), origin_nodes, dest_nodes):
+            trip = Trip()
+            trip.__dict__.update(zip(names, row))
+            if(road_map is not None and origin_node >= 0 and dest_node >= 0):
+                trip.origin_node = road_map.nodes[origin_node]
+                trip.dest_node = road_map.nodes[dest_node]
+            trips.append(trip)
+        return trips
+
+
+# Checks that get_error_codes() gives exactly the same codes as Trip.isValid(), on random
+# records which are concentrated around the thresholds.  Some of the values are exactly
+# at a threshold, and some of them cannot be read.
+# Params:
+    # num_trips - the number of random records
+    # seed - the random seed
+# Returns:
+    # the number of trips whose codes are different
+def test_error_codes(num_trips=200000, seed=0):
+    from datetime import datetime, timedelta
+    rng = np.random.RandomState(seed)
+    t = VALIDITY_THRESHOLDS
+
+    # Coordinates inside, outside and exactly on the borders of the boxes
+    def coordinates(center, spread, bounds):
+        values = center + rng.randn(num_trips) * spread
+        exact = rng.rand(num_trips) < .1
+        values[exact] = rng.choice(bounds, exact.sum())
+        return values
+    lat_bounds = list(t["err_lat"] + t["bad_lat"])
+    lon_bounds = list(t["err_lon"] + t["bad_lon"])
+    from_lats = coordinates(40.75, .15, lat_bounds)
+    from_lons = coordinates(-73.95, .15, lon_bounds)
+    # Short trips, so that the straight line distance and the winding factor are near
+    # their thresholds
+    to_lats = np.where(rng.rand(num_trips) < .5, from_lats + rng.randn(num_trips) * .02,
+                       coordinates(40.75, .15, lat_bounds))
+    to_lons = np.where(rng.rand(num_trips) < .5, from_lons + rng.randn(num_trips) * .02,
+                       coordinates(-73.95, .15, lon_bounds))
+    straight_line_miles = (approx_distances(from_lats, from_lons, to_lats, to_lons) /
+                           METERS_PER_MILE)
+    miles = np.concatenate(([0, .001, 8, 15, 20],
+                            np.array(t["err_straightline"]) / METERS_PER_MILE))
+    dists = np.where(rng.rand(num_trips) < .5,
+                     straight_line_miles * rng.choice([.95, 1, 1.5, 5, 5.01], num_trips),
+                     rng.choice(miles, num_trips) * rng.choice([1, 1, 1.0001], num_trips))
+
+    start = datetime(2010, 7, 1)
+    pickup_times = [start + timedelta(days=int(day), seconds=int(second))
+                    for (day, second) in zip(rng.randint(0, 760, num_trips),
+                                             rng.randint(0, 86400, num_trips))]
+    seconds = rng.choice([-5, 0, 9, 10, 59, 60, 61, 600, 3600, 3601, 7200, 7201], num_trips)
+    dropoff_times = [pickup + timedelta(seconds=int(second) + .5 * (second % 2))
+                     for (pickup, second) in zip(pickup_times, seconds)]
+
+    records = []
+    for i in xrange(num_trips):
+        record = [None] * len(TRIP_COLUMNS)
+        record[TRIP_COLUMNS.index("medallion")] = str(i)
+        record[TRIP_COLUMNS.index("pickup_datetime")] = pickup_times[i]
+        record[TRIP_COLUMNS.index("dropoff_datetime")] = dropoff_times[i]
+        record[TRIP_COLUMNS.index("trip_distance")] = dists[i]
+        record[TRIP_COLUMNS.index("pickup_longitude")] = from_lons[i]
+        record[TRIP_COLUMNS.index("pickup_latitude")] = from_lats[i]
+        record[TRIP_COLUMNS.index("dropoff_longitude")] = to_lons[i]
+        record[TRIP_COLUMNS.index("dropoff_latitude")] = to_lats[i]
+        # Some values cannot be read
+        if(i % 97 == 0):
+            record[TRIP_COLUMNS.index("trip_distance")] = None
+        elif(i % 89 == 0):
+            record[TRIP_COLUMNS.index("pickup_latitude")] = ""
+        elif(i % 83 == 0):
+            record[TRIP_COLUMNS.index("dropoff_longitude")] = "nan"
+        elif(i % 79 == 0):
+            record[TRIP_COLUMNS.index("pickup_longitude")] = str(from_lons[i])
+        records.append(tuple(record))
+
+    codes = TripBatch.from_records(records).get_error_codes()
+    expected = np.array([Trip(record).isValid() for record in records])
+    num_mismatches = int((codes != expected).sum())
+    print("Codes : " + str(count_error_codes(expected)))
+    print("Number of mismatches : %d / %d" % (num_mismatches, num_trips))
+    return num_mismatches
+
+
+if(__name__ == "__main__"):
+    test_error_codes()
@@ -93,8 +93,9 @@ def plot_speed(road_map, dt, filename, pace_dict=None):
 
     #remove(filename + ".csv")
 
-def plot_group_of_speeds((dts, pace_dicts), road_map, tmp_dir):
-    road_map.unflatten()
+def plot_group_of_speeds((dts, pace_dicts), map_fn, tmp_dir):
+    # The graph arrays are memory-mapped, and shared with the other workers
+    road_map = Map.load_snapshot(map_fn, mmap=True)
     db_main.connect("db_functions/database.conf")
     for i in range(len(dts)):
         dt = dts[i]
@@ -109,8 +110,8 @@ def plot_group_of_speeds((dts, pace_dicts), road_map, tmp_dir):
 
 
 def plot_speeds_in_parallel(road_map, dts, speed_dicts=None, tmp_dir="analysis/tmp", pool=DefaultPool()):
-    road_map.flatten()
-    plt_speeds_fun = partial(plot_group_of_speeds, road_map=road_map, tmp_dir = tmp_dir)
+    map_fn = road_map.get_shared_snapshot()
+    plt_speeds_fun = partial(plot_group_of_speeds, map_fn=map_fn, tmp_dir = tmp_dir)
     
     list_it = splitLists(dts, speed_dicts, pool._processes)
     pool.map(plt_speeds_fun, list_it)